@@ -10,11 +10,21 @@ IPA command objects to execute during FreeIPA update.
 
 import re
 
-from core import FreeIPAManagerCore
-from errors import CommandError
+from core import ClassLogger, FreeIPAManagerCore
+from errors import CommandError, RetryableCommandError
+
+# execution order of commands by name (additions first, deletions last)
+RANK_PATTERNS = tuple(re.compile(pattern) for pattern in (
+    '.+_add$', '.+_add_.+', '.+_mod$', '.+_remove_.+', '.+_del$'))
 
 
 class Command(FreeIPAManagerCore):
+    # no instance dictionary, as a plan may have ~100k commands
+    __slots__ = ('command', 'entity_name', 'entity_id_type', 'payload',
+                 'rank', '_description', '_sort_key')
+    lg = ClassLogger()
+    _ranks = dict()  # rank cache by command name
+
     def __init__(self, command, payload, entity_name, entity_id_type):
         """
         Create a FreeIPA API command instance.
@@ -24,14 +34,14 @@ class Command(FreeIPAManagerCore):
         :param str entity_id_type: type of entity ID attribute (cn/uid)
         :param FreeIPAEntity entity: entity modified by the command
         """
-        super(Command, self).__init__()
+        # no super() call, the logger is shared (see `lg`) & errs unused
         self.command = command
         self.entity_name = entity_name
         self.entity_id_type = entity_id_type
         self.payload = payload
         self.payload[self.entity_id_type] = self.entity_name
         self._encode_payload()
-        self._create_description()
+        self._description = self._sort_key = None
         self._calculate_rank()
 
     def _encode_payload(self):
@@ -48,21 +58,48 @@ class Command(FreeIPAManagerCore):
             encoded[key.lower()] = new_value
         self.payload = encoded
 
-    def _create_description(self):
-        desc_data = [
-            '%s=%s' % (k, v) for k, v
-            in sorted(self.payload.items()) if k != self.entity_id_type]
-        self.description = '%s %s (%s)' % (
-            self.command, self.entity_name, '; '.join(desc_data))
+    @property
+    def description(self):
+        """
+        Description of the command (created on first access, as it is
+        only needed when the command is logged).
+        """
+        if self._description is None:
+            desc_data = [
+                '%s=%s' % (k, v) for k, v
+                in sorted(self.payload.items()) if k != self.entity_id_type]
+            self._description = '%s %s (%s)' % (
+                self.command, self.entity_name, '; '.join(desc_data))
+        return self._description
+
+    @description.setter
+    def description(self, value):
+        self._description = value
+
+    @property
+    def sort_key(self):
+        """
+        Key to sort commands by for correct execution order: by rank,
+        then by command, entity and payload (deterministic order
+        without creating descriptions). It is created on first access,
+        so that comparisons of commands (`__lt__`) do not rebuild it.
+        """
+        if self._sort_key is None:
+            self._sort_key = (
+                self.rank, self.command, self.entity_name, sorted(
+                    (k, v) for k, v in self.payload.iteritems()
+                    if k != self.entity_id_type))
+        return self._sort_key
 
     def update(self, data):
         """
-        Update the command's payload and refresh its description.
+        Update the command's payload and refresh its description
+        & sort key.
         :param dict data: data to update payload with
         :rtype: None
         """
         self.payload.update(data)
-        self._create_description()
+        self._description = self._sort_key = None
 
     def execute(self, api):
         self.lg.info('Executing %s', self.description)
@@ -72,7 +109,11 @@ class Command(FreeIPAManagerCore):
         except KeyError:
             raise CommandError('Non-existent command %s' % self.command)
         except Exception as e:
-            raise CommandError('Error executing %s: %s' % (self.command, e))
+            error = CommandError
+            if isinstance(e, RetryableCommandError) or is_transient(
+                    type(e).__name__, unicode(e)):
+                error = RetryableCommandError
+            raise error('Error executing %s: %s' % (self.command, e))
 
     def _handle_output(self, output):
         """
@@ -103,16 +144,29 @@ class Command(FreeIPAManagerCore):
         return self.description
 
     def __lt__(self, other):
-        if self.rank == other.rank:
-            return self.description < other.description
-        return self.rank < other.rank
+        return self.sort_key < other.sort_key
 
     def _calculate_rank(self):
-        patterns = ('.+_add$', '.+_add_.+', '.+_mod$',
-                    '.+_remove_.+', '.+_del$')
-        rank = 0
-        while rank < len(patterns):
-            if re.match(patterns[rank], self.command):
-                break
-            rank += 1
+        rank = self._ranks.get(self.command)
+        if rank is None:
+            rank = 0
+            while rank < len(RANK_PATTERNS):
+                if RANK_PATTERNS[rank].match(self.command):
+                    break
+                rank += 1
+            self._ranks[self.command] = rank
         self.rank = rank
+
+
+def is_transient(name, message):
+    """
+    Check whether an API error is transient & the command was provably
+    not applied (a busy LDAP server refused it), so that it may be retried.
+    Timeouts & network errors are not transient in this sense: the server
+    may have applied the command before the connection failed, and a resent
+    `*_add` or `*_del` would then fail (e.g., with DuplicateEntry).
+    :param str name: name of the error (ipalib exception class)
+    :param str message: error message
+    :rtype: bool
+    """
+    return name == 'DatabaseError' and 'busy' in message.lower()
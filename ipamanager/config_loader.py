@@ -14,6 +14,7 @@ import os
 import yaml
 
 from core import FreeIPAManagerCore
+from entities import clear_interned
 from errors import ConfigError
 from utils import ENTITY_CLASSES, check_ignored
 
@@ -36,41 +37,60 @@ class ConfigLoader(FreeIPAManagerCore):
         self.ignore = ignore
         self.entities = dict()
 
-    def load(self):
+    def load(self, groups_callback=None):
         """
         Parse FreeIPA entity configurations from the given paths.
+        :param function groups_callback: function to call with the parsed
+            user group names as soon as groups are loaded (user groups are
+            then parsed first, before the other entity types); this enables
+            starting work that only needs group names (like Okta loading)
+            while the rest of the repository is still being parsed
         """
         self.lg.info('Checking local configuration at %s', self.basepath)
+        clear_interned()
         paths = self._retrieve_paths()
-        for entity_class in ENTITY_CLASSES:
-            self.entities[entity_class.entity_name] = dict()
-            entity_paths = paths.get(entity_class.entity_name, [])
-            if not entity_paths:
-                continue
-            self.lg.debug('Loading %s configs', entity_class.entity_name)
-            errcount = 0
-            for path in entity_paths:
-                fname = os.path.relpath(path, self.basepath)
-                self.lg.debug('Loading config from %s', fname)
-                try:
-                    with open(path, 'r') as confsource:
-                        contents = confsource.read()
-                    data = yaml.safe_load(contents)
-                    self._parse(data, entity_class, path)
-                except (IOError, ConfigError, yaml.YAMLError) as e:
-                    self.lg.error('%s: %s', fname, e)
-                    self.errs.append(fname)
-                    errcount += 1
-            self.lg.info(
-                'Parsed %d %s%s', len(self.entities[entity_class.entity_name]),
-                '%ss' % entity_class.entity_name,
-                ' (%d errors encountered)' % errcount if errcount else '')
+        entity_classes = ENTITY_CLASSES
+        if groups_callback:
+            entity_classes = sorted(
+                ENTITY_CLASSES, key=lambda cls: cls.entity_name != 'group')
+        for entity_class in entity_classes:
+            self._load_type(entity_class, paths.get(entity_class.entity_name))
+            if groups_callback and entity_class.entity_name == 'group':
+                groups_callback(self.entities['group'].keys())
         if self.errs:
             raise ConfigError(
                 'There have been errors in %d configuration files: [%s]' %
                 (len(self.errs), ', '.join(sorted(self.errs))))
         return self.entities
 
+    def _load_type(self, entity_class, entity_paths):
+        """
+        Parse entities of a single type from their configuration files.
+        :param FreeIPAEntity entity_class: entity class to create instances of
+        :param [str] entity_paths: paths of the type's configuration files
+        """
+        self.entities[entity_class.entity_name] = dict()
+        if not entity_paths:
+            return
+        self.lg.debug('Loading %s configs', entity_class.entity_name)
+        errcount = 0
+        for path in entity_paths:
+            fname = os.path.relpath(path, self.basepath)
+            self.lg.debug('Loading config from %s', fname)
+            try:
+                with open(path, 'r') as confsource:
+                    contents = confsource.read()
+                data = yaml.safe_load(contents)
+                self._parse(data, entity_class, path)
+            except (IOError, ConfigError, yaml.YAMLError) as e:
+                self.lg.error('%s: %s', fname, e)
+                self.errs.append(fname)
+                errcount += 1
+        self.lg.info(
+            'Parsed %d %s%s', len(self.entities[entity_class.entity_name]),
+            '%ss' % entity_class.entity_name,
+            ' (%d errors encountered)' % errcount if errcount else '')
+
     def _parse(self, data, entity_class, path):
         """
         Parse entity instances from loaded YAML dictionary.
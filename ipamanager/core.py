@@ -15,10 +15,23 @@ class FreeIPAManagerCore(object):
     """
     Core abstract class providing logging functionality
     and serving as a base for other modules of the app.
+    Subclasses may define `__slots__` (e.g., entities, created in large
+    numbers), as the class does not need an instance dictionary itself.
     """
+    __slots__ = ()
+
     def __init__(self):
         self.configure_logger()
         self.errs = []
 
     def configure_logger(self):
         self.lg = logging.getLogger(self.__class__.__name__)
+
+
+class ClassLogger(object):
+    """
+    Logger shared by all instances of a class and named after the class.
+    Used instead of `configure_logger` by classes with many instances.
+    """
+    def __get__(self, instance, owner):
+        return logging.getLogger(owner.__name__)
@@ -16,9 +16,78 @@ from abc import ABCMeta, abstractproperty
 
 import schemas
 from command import Command
-from core import FreeIPAManagerCore
+from core import ClassLogger, FreeIPAManagerCore
 from errors import ConfigError, ManagerError, IntegrityError
 
+# interned names & membership tuples shared by entities of one config load
+# (cleared by `clear_interned`, as unicode & tuples cannot be weakly referenced)
+_names = dict()
+_memberships = dict()
+
+
+class _IpaKeys(dict):
+    """
+    Mapping of repo attribute names to IPA ones (as per `key_mapping`,
+    lowercased), computed & memoized on first lookup of each name.
+    """
+    def __init__(self, key_mapping):
+        super(_IpaKeys, self).__init__()
+        self.key_mapping = key_mapping
+
+    def __missing__(self, key):
+        value = self[key] = self.key_mapping.get(key, key).lower()
+        return value
+
+
+def _scalar_to_ipa(value):
+    return (unicode(value),)
+
+
+# conversion of repo attribute values to IPA format by value type
+_VALUE_TO_IPA = {
+    bool: lambda value: value,
+    list: lambda value: tuple(unicode(i) for i in value)
+}
+
+
+def _normalize(value):
+    """
+    Normalise an IPA attribute value for order-insensitive comparison.
+    """
+    if isinstance(value, bool):
+        return value
+    return tuple(sorted(value))
+
+
+def _intern(name):
+    """
+    Intern an entity name, so that the name of an entity and its occurrences
+    in memberships of other entities share one string object.
+    (The `intern` builtin does not accept unicode strings.)
+    """
+    if isinstance(name, str):
+        return intern(name)
+    return _names.setdefault(name, name)
+
+
+def _intern_members(members):
+    """
+    Intern a tuple of member names, so that entities with the same
+    members (e.g., users of the same groups) share one tuple.
+    """
+    members = tuple(_intern(i) for i in members)
+    return _memberships.setdefault(members, members)
+
+
+def clear_interned():
+    """
+    Drop the interned names & membership tuples. Called at the start
+    of each config load, so that long-running processes reloading
+    the config do not keep those of removed entities alive.
+    """
+    _names.clear()
+    _memberships.clear()
+
 
 class FreeIPAEntity(FreeIPAManagerCore):
     """
@@ -26,6 +95,10 @@ class FreeIPAEntity(FreeIPAManagerCore):
     Can only be used via subclasses, not directly.
     """
     __metaclass__ = ABCMeta
+    # no instance dictionary, as there may be ~100k entities in memory
+    __slots__ = ('name', 'path', 'metaparams', '_data_ipa', '_data_repo',
+                 '_fingerprint')
+    lg = ClassLogger()
     entity_id_type = 'cn'  # entity name identificator in FreeIPA
     key_mapping = {}  # attribute name mapping between local config and FreeIPA
     ignored = []  # list of ignored entities for each entity type
@@ -33,17 +106,22 @@ class FreeIPAEntity(FreeIPAManagerCore):
 
     def __init__(self, name, data, path=None, okta=False):
         """
+        Only the data in the format it was created from (repository format
+        for Git/Okta entities, IPA format for FreeIPA entities) is stored;
+        the other format is converted on first access (see `data_repo`
+        and `data_ipa`), as most runs only need one of them.
         :param str name: entity name (user login, group name etc.)
         :param dict data: dictionary of entity configuration values
         :param str path: path to file the entity was parsed from;
                          if None, indicates creation of entity from FreeIPA
         """
-        super(FreeIPAEntity, self).__init__()
+        # no super() call, the logger is shared (see `lg`) & errs unused
         if not data:  # may be None; we want to ensure dictionary
             data = dict()
-        self.name = name
+        self.name = _intern(name)
         self.path = path
         self.metaparams = data.pop('metaparams', dict())
+        self._data_ipa = self._data_repo = self._fingerprint = None
         if self.path:  # created from Git
             try:
                 self.validation_schema(data)
@@ -54,11 +132,78 @@ class FreeIPAEntity(FreeIPAManagerCore):
                 self.path = '%s.yaml' % os.path.join(
                     path, name.replace('-', '_'))
         if self.path or okta:  # created from Git/Okta
-            self.data_ipa = self._convert_to_ipa(data)
-            self.data_repo = data
+            if 'memberOf' in data:  # checked eagerly to fail on load
+                self._check_memberof(data['memberOf'])
+            self._data_repo = data
         else:  # created from FreeIPA
-            self.data_ipa = data
-            self.data_repo = self._convert_to_repo(data)
+            self._data_ipa = data
+        self._intern_membership(data)
+
+    @property
+    def data_repo(self):
+        """
+        Entity data in repository format (converted on first access).
+        """
+        if self._data_repo is None:
+            self._data_repo = self._convert_to_repo(self._data_ipa)
+        return self._data_repo
+
+    @data_repo.setter
+    def data_repo(self, value):
+        self._data_repo = value
+
+    @property
+    def data_ipa(self):
+        """
+        Entity data in IPA format (converted on first access).
+        """
+        if self._data_ipa is None:
+            self._data_ipa = self._convert_to_ipa(self._data_repo)
+        return self._data_ipa
+
+    @data_ipa.setter
+    def data_ipa(self, value):
+        self._data_ipa = value
+        self._fingerprint = None
+
+    def _intern_membership(self, data):
+        """
+        Intern member names & membership tuples of the entity's data.
+        The memberOf lists are interned in place, as they are shared
+        by the repo & IPA data (and may be updated when pulling).
+        :param dict data: entity data (in the format it was created from)
+        """
+        for key, value in data.iteritems():
+            if key == 'memberOf':
+                for target_list in value.itervalues():
+                    target_list[:] = [_intern(i) for i in target_list]
+            elif key.startswith('member') and isinstance(value, tuple):
+                data[key] = _intern_members(value)
+
+    @classmethod
+    def _conversion_tables(cls):
+        """
+        Get the class's data conversion tables, compiled on first use
+        and cached on the class (not inherited, as subclasses may have
+        their own `key_mapping` & managed attributes).
+        :returns: repo -> IPA key mapping (filled in on lookup), (IPA key,
+                  repo key) pairs of the attributes converted to repo format
+                  & IPA keys of the attributes compared when pushing
+        :rtype: (dict, tuple, tuple)
+        """
+        tables = cls.__dict__.get('_tables')
+        if tables is None:
+            reverse = dict()
+            for key, ipa_key in cls.key_mapping.iteritems():
+                reverse.setdefault(ipa_key, key)
+            pull = cls.managed_attributes_pull
+            if isinstance(pull, property):  # defaults to push attributes
+                pull = cls.managed_attributes_push
+            tables = (_IpaKeys(cls.key_mapping), tuple(
+                (attr.lower(), reverse.get(attr, attr)) for attr in pull),
+                tuple(attr.lower() for attr in cls.managed_attributes_push))
+            cls._tables = tables
+        return tables
 
     def _convert_to_ipa(self, data):
         """
@@ -67,18 +212,17 @@ class FreeIPAEntity(FreeIPAManagerCore):
         :returns: dictionary of data in IPA format
         :rtype: dict
         """
+        ipa_keys = self._conversion_tables()[0]
         result = dict()
         for key, value in data.iteritems():
-            new_key = self.key_mapping.get(key, key).lower()
+            new_key = ipa_keys[key]
             if new_key == 'memberof':
-                self._check_memberof(value)
-                result[new_key] = value
-            elif isinstance(value, bool):
                 result[new_key] = value
-            elif isinstance(value, list):
-                result[new_key] = tuple(unicode(i) for i in value)
-            else:
-                result[new_key] = (unicode(value),)
+                continue
+            value = _VALUE_TO_IPA.get(type(value), _scalar_to_ipa)(value)
+            if type(value) is tuple and new_key.startswith('member'):
+                value = _intern_members(value)
+            result[new_key] = value
         return result
 
     def _convert_to_repo(self, data):
@@ -89,22 +233,12 @@ class FreeIPAEntity(FreeIPAManagerCore):
         :rtype: dict
         """
         result = dict()
-        for attr in self.managed_attributes_pull:
-            if attr.lower() in data:
-                key = attr
-                # find reverse (IPA -> repo) attribute name mapping
-                for k, v in self.key_mapping.iteritems():
-                    if v == attr:
-                        key = k
-                        break
-                value = data[attr.lower()]
+        for ipa_key, key in self._conversion_tables()[1]:
+            if ipa_key in data:
+                value = data[ipa_key]
                 if isinstance(value, tuple):
-                    if len(value) > 1:
-                        result[key] = list(value)
-                    else:
-                        result[key] = value[0]
-                else:
-                    result[key] = value
+                    value = list(value) if len(value) > 1 else value[0]
+                result[key] = value
         return result
 
     def _check_memberof(self, member_of):
@@ -116,32 +250,58 @@ class FreeIPAEntity(FreeIPAManagerCore):
                     'Cannot be a member of non-existent entity type %s'
                     % entity_type)
 
-    def create_commands(self, remote_entity=None):
+    def create_commands(self, remote_entity=None, skip=None):
         """
         Create commands to execute in order
         to sync entity with its FreeIPA counterpart.
         :param FreeIPAEntity remote_entity: remote entity
+        :param function skip: predicate telling whether a command (by name)
+                              should be skipped, i.e., not created at all
         :returns: list of Command objects to execute
         :rtype: list(Command)
         """
+        keys = self._conversion_tables()[2]
         diff = dict()
-        for key in self.managed_attributes_push:
-            local_value = self.data_ipa.get(key.lower(), ())
-            if not remote_entity:
+        if not remote_entity:
+            for key in keys:
+                local_value = self.data_ipa.get(key, ())
                 if local_value:
-                    diff[key.lower()] = local_value
-            else:
-                remote_value = remote_entity.data_ipa.get(key.lower(), ())
-                if sorted(local_value) != sorted(remote_value):
-                    diff[key.lower()] = local_value
+                    diff[key] = local_value
+        else:
+            local = self.fingerprint(keys)
+            remote = remote_entity.fingerprint(keys)
+            if local != remote:  # hashes compared first, values if equal
+                for key, local_value, remote_value in zip(
+                        keys, local[1], remote[1]):
+                    if local_value != remote_value:
+                        diff[key] = self.data_ipa.get(key, ())
         if diff or not remote_entity:  # create entity even without params
             if remote_entity:  # modify existing entity
                 command = '%s_mod' % self.entity_name
             else:  # add new entity
                 command = '%s_add' % self.entity_name
+            if skip and skip(command):
+                return []
             return [Command(command, diff, self.name, self.entity_id_type)]
         return []
 
+    def fingerprint(self, keys):
+        """
+        Get the normalised values of the given attributes (sorted tuples,
+        so that they compare equal regardless of value order) & their hash.
+        The result is cached for the last tuple of keys used, as these are
+        the same for all entities of a type (see `_conversion_tables`).
+        :param tuple keys: IPA keys of the attributes (e.g., push attributes)
+        :returns: hash of normalised values & the values (in order of keys)
+        :rtype: (int, tuple)
+        """
+        cached = self._fingerprint
+        if cached is None or cached[0] is not keys:
+            data = self.data_ipa
+            values = tuple(_normalize(data.get(key, ())) for key in keys)
+            cached = self._fingerprint = (keys, (hash(values), values))
+        return cached[1]
+
     def update_repo_data(self, additional):
         """
         Update repo-format data with additional attributes.
@@ -195,14 +355,7 @@ class FreeIPAEntity(FreeIPAManagerCore):
 
     @staticmethod
     def get_entity_class(name):
-        for entity_class in [
-                FreeIPAHBACRule, FreeIPAHBACService,
-                FreeIPAHBACServiceGroup, FreeIPAHostGroup, FreeIPAPermission,
-                FreeIPAPrivilege, FreeIPARole, FreeIPAService,
-                FreeIPASudoRule, FreeIPAUser, FreeIPAUserGroup]:
-            if entity_class.entity_name == name:
-                return entity_class
-        raise KeyError(name)
+        return _entity_classes[name]
 
     @abstractproperty
     def validation_schema(self):
@@ -263,6 +416,7 @@ class FreeIPAEntity(FreeIPAManagerCore):
 
 class FreeIPAGroup(FreeIPAEntity):
     """Abstract representation a FreeIPA group entity (host/user group)."""
+    __slots__ = ()
     managed_attributes_push = ['description']
 
     @abstractproperty
@@ -275,6 +429,7 @@ class FreeIPAGroup(FreeIPAEntity):
 
 class FreeIPAHostGroup(FreeIPAGroup):
     """Representation of a FreeIPA host group entity."""
+    __slots__ = ()
     entity_name = 'hostgroup'
     allowed_members = ['hostgroup']
     validation_schema = voluptuous.Schema(schemas.schema_hostgroups)
@@ -282,6 +437,7 @@ class FreeIPAHostGroup(FreeIPAGroup):
 
 class FreeIPAUserGroup(FreeIPAGroup):
     """Representation of a FreeIPA user group entity."""
+    __slots__ = ('posix',)
     entity_name = 'group'
     managed_attributes_pull = ['description', 'posix']
     allowed_members = ['user', 'group']
@@ -297,7 +453,7 @@ class FreeIPAUserGroup(FreeIPAGroup):
         if not path:  # entity created from FreeIPA, not from config
             data['posix'] = u'posixgroup' in data.get(u'objectclass', [])
         super(FreeIPAUserGroup, self).__init__(name, data, path)
-        self.posix = self.data_repo.get('posix', True)
+        self.posix = data.get('posix', True)
 
     def can_contain_users(self, pattern):
         """
@@ -331,18 +487,23 @@ class FreeIPAUserGroup(FreeIPAGroup):
             posix_diff = {u'nonposix': True}
         return (posix_diff, description)
 
-    def create_commands(self, remote_entity=None):
+    def create_commands(self, remote_entity=None, skip=None):
         """
         Create commands to execute in order to update the rule.
         Extends the basic command creation with POSIX/non-POSIX setting.
         :param dict remote_entity: remote rule data
+        :param function skip: predicate telling whether a command (by name)
+                              should be skipped, i.e., not created at all
         :returns: list of commands to execute
         :rtype: list(Command)
         """
-        commands = super(FreeIPAUserGroup, self).create_commands(remote_entity)
+        commands = super(FreeIPAUserGroup, self).create_commands(
+            remote_entity, skip)
         posix_diff, description = self._process_posix_setting(remote_entity)
         if posix_diff:
             if not commands:  # no diff but POSIX setting, new command needed
+                if skip and skip('group_mod'):
+                    return []
                 cmd = Command('group_mod', posix_diff,
                               self.name, self.entity_id_type)
                 cmd.description = description
@@ -354,6 +515,7 @@ class FreeIPAUserGroup(FreeIPAGroup):
 
 class FreeIPAUser(FreeIPAEntity):
     """Representation of a FreeIPA user entity."""
+    __slots__ = ()
     entity_name = 'user'
     entity_id_type = 'uid'
     managed_attributes_push = ['givenName', 'sn', 'initials', 'mail',
@@ -370,6 +532,7 @@ class FreeIPAUser(FreeIPAEntity):
 
 class FreeIPAOktaUser(FreeIPAUser):
     """Representation of a FreeIPA user fetched from Okta."""
+    __slots__ = ()
     managed_attributes_push = [
         attr for attr in FreeIPAUser.managed_attributes_push
         if attr != 'mail'] + ['ipaSshPubKey']
@@ -400,50 +563,60 @@ class FreeIPAOktaUser(FreeIPAUser):
         result = super(FreeIPAOktaUser, self)._convert_to_ipa(data)
         return dict((k, v) for k, v in result.iteritems() if v != (u'',))
 
-    def create_commands(self, remote_entity=None):
+    def create_commands(self, remote_entity=None, skip=None):
         """
         On top of attribute diff, handle disabling the user.
         :param dict remote_entity: remote rule data
+        :param function skip: predicate telling whether a command (by name)
+                              should be skipped, i.e., not created at all
         :returns: list of commands to execute
         :rtype: list(Command)
         """
-        result = super(FreeIPAOktaUser, self).create_commands(remote_entity)
+        result = super(FreeIPAOktaUser, self).create_commands(
+            remote_entity, skip)
         suspended_okta = self.data_ipa.get('nsaccountlock', False)
         try:
             disabled_ipa = remote_entity.data_ipa['nsaccountlock']
         except (AttributeError, KeyError):
             disabled_ipa = False
+        command = None
         if suspended_okta and not disabled_ipa:
-            result.append(
-                Command('user_disable', {}, self.name, self.entity_id_type))
+            command = 'user_disable'
         elif disabled_ipa and not suspended_okta:
+            command = 'user_enable'
+        if command and not (skip and skip(command)):
             result.append(
-                Command('user_enable', {}, self.name, self.entity_id_type))
+                Command(command, {}, self.name, self.entity_id_type))
         return result
 
 
 class FreeIPARule(FreeIPAEntity):
     """Abstract class covering HBAC and sudo rules."""
+    __slots__ = ()
 
-    def create_commands(self, remote_entity=None):
+    def create_commands(self, remote_entity=None, skip=None):
         """
         Create commands to execute in order to update the rule.
         Extends the basic command creation
         to account for adding/removing rule members.
         :param dict remote_entity: remote rule data
+        :param function skip: predicate telling whether a command (by name)
+                              should be skipped, i.e., not created at all
         :returns: list of commands to execute
         :rtype: list(Command)
         """
-        result = super(FreeIPARule, self).create_commands(remote_entity)
-        result.extend(self._process_rule_membership(remote_entity))
+        result = super(FreeIPARule, self).create_commands(remote_entity, skip)
+        result.extend(self._process_rule_membership(remote_entity, skip))
         return result
 
-    def _process_rule_membership(self, remote_entity):
+    def _process_rule_membership(self, remote_entity, skip=None):
         """
         Prepare a command for a hbac/sudo rule membership update.
         If the rule previously had any members, these are removed
         as a rule can only have one usergroup and one hostgroup as members.
         :param FreeIPArule remote_entity: remote entity data (may be None)
+        :param function skip: predicate telling whether a command (by name)
+                              should be skipped (see `create_commands`)
         """
         commands = []
         for key, member_type, cmd_key in (
@@ -459,11 +632,15 @@ class FreeIPARule(FreeIPAEntity):
                 remote_members = set()
             command = '%s_add_%s' % (self.entity_name, cmd_key)
             for member in local_members - remote_members:
+                if skip and skip(command):
+                    continue
                 diff = {member_type: member}
                 commands.append(
                     Command(command, diff, self.name, self.entity_id_type))
             command = '%s_remove_%s' % (self.entity_name, cmd_key)
             for member in remote_members - local_members:
+                if skip and skip(command):
+                    continue
                 diff = {member_type: member}
                 commands.append(
                     Command(command, diff, self.name, self.entity_id_type))
@@ -472,6 +649,7 @@ class FreeIPARule(FreeIPAEntity):
 
 class FreeIPAHBACRule(FreeIPARule):
     """Representation of a FreeIPA HBAC (host-based access control) rule."""
+    __slots__ = ()
     entity_name = 'hbacrule'
     default_attributes = ['serviceCategory']
     managed_attributes_push = ['description', 'serviceCategory']
@@ -496,6 +674,7 @@ class FreeIPAHBACRule(FreeIPARule):
 
 class FreeIPASudoRule(FreeIPARule):
     """Representation of a FreeIPA sudo rule."""
+    __slots__ = ()
     entity_name = 'sudorule'
     default_attributes = [
         'cmdCategory', 'options', 'runAsGroupCategory', 'runAsUserCategory']
@@ -530,24 +709,29 @@ class FreeIPASudoRule(FreeIPARule):
             result['options'] = [result['options']]
         return result
 
-    def create_commands(self, remote_entity=None):
+    def create_commands(self, remote_entity=None, skip=None):
         """
         Create commands to execute in order to update the rule.
         Extends the basic command creation with sudorule option update.
         :param dict remote_entity: remote rule data
+        :param function skip: predicate telling whether a command (by name)
+                              should be skipped, i.e., not created at all
         :returns: list of commands to execute
         :rtype: list(Command)
         """
-        result = super(FreeIPASudoRule, self).create_commands(remote_entity)
-        result.extend(self._parse_sudo_options(remote_entity))
+        result = super(FreeIPASudoRule, self).create_commands(
+            remote_entity, skip)
+        result.extend(self._parse_sudo_options(remote_entity, skip))
         return result
 
-    def _parse_sudo_options(self, remote_entity):
+    def _parse_sudo_options(self, remote_entity, skip=None):
         """
         Prepare commands for sudo rule options update. This includes
         deletion of old options that are no longer in configuration
         as well as addition of new options.
         :param dict remote_entity: remote entity data (can be None)
+        :param function skip: predicate telling whether a command (by name)
+                              should be skipped (see `create_commands`)
         :returns: list of sudorule option update commands to execute
         :rtype: list(Command)
         """
@@ -559,11 +743,15 @@ class FreeIPASudoRule(FreeIPARule):
             remote_options = set()
         command = 'sudorule_add_option'
         for opt in local_options - remote_options:
+            if skip and skip(command):
+                continue
             diff = {'ipasudoopt': [opt]}
             commands.append(
                 Command(command, diff, self.name, self.entity_id_type))
         command = 'sudorule_remove_option'
         for opt in remote_options - local_options:
+            if skip and skip(command):
+                continue
             diff = {'ipasudoopt': [opt]}
             commands.append(
                 Command(command, diff, self.name, self.entity_id_type))
@@ -572,6 +760,7 @@ class FreeIPASudoRule(FreeIPARule):
 
 class FreeIPAHBACService(FreeIPAEntity):
     """Entity to hold the info about FreeIPA HBACServices"""
+    __slots__ = ()
     entity_name = 'hbacsvc'
     managed_attributes_push = ['description']
     managed_attributes_pull = managed_attributes_push
@@ -580,6 +769,7 @@ class FreeIPAHBACService(FreeIPAEntity):
 
 class FreeIPAHBACServiceGroup(FreeIPAEntity):
     """Entity to hold the info about FreeIPA HBACServiceGroups"""
+    __slots__ = ()
     entity_name = 'hbacsvcgroup'
     managed_attributes_push = ['description']
     managed_attributes_pull = managed_attributes_push
@@ -589,6 +779,7 @@ class FreeIPAHBACServiceGroup(FreeIPAEntity):
 
 class FreeIPARole(FreeIPAEntity):
     """Entity to hold the info about FreeIPA Roles"""
+    __slots__ = ()
     entity_name = 'role'
     managed_attributes_pull = ['description']
     managed_attributes_push = managed_attributes_pull
@@ -598,6 +789,7 @@ class FreeIPARole(FreeIPAEntity):
 
 class FreeIPAPrivilege(FreeIPAEntity):
     """Entity to hold the info about FreeIPA Privilege"""
+    __slots__ = ()
     entity_name = 'privilege'
     managed_attributes_pull = ['description']
     managed_attributes_push = managed_attributes_pull
@@ -607,6 +799,7 @@ class FreeIPAPrivilege(FreeIPAEntity):
 
 class FreeIPAPermission(FreeIPAEntity):
     """Entity to hold the info about FreeIPA Permission"""
+    __slots__ = ()
     entity_name = 'permission'
     managed_attributes_pull = ['description', 'subtree', 'attrs',
                                'ipapermlocation', 'ipapermright',
@@ -628,6 +821,7 @@ class FreeIPAService(FreeIPAEntity):
     Entity to hold the info about FreeIPA Services
     PUSH NOT SUPPORTED yet
     """
+    __slots__ = ()
     entity_name = 'service'
     entity_id_type = 'krbcanonicalname'
     managed_attributes_push = []  # Empty because we don't support push
@@ -648,6 +842,13 @@ class FreeIPAService(FreeIPAEntity):
         super(FreeIPAService, self).write_to_file()
 
 
+# entity type registry (e.g., 'hostgroup' -> FreeIPAHostGroup)
+_entity_classes = dict((cls.entity_name, cls) for cls in (
+    FreeIPAHBACRule, FreeIPAHBACService, FreeIPAHBACServiceGroup,
+    FreeIPAHostGroup, FreeIPAPermission, FreeIPAPrivilege, FreeIPARole,
+    FreeIPAService, FreeIPASudoRule, FreeIPAUser, FreeIPAUserGroup))
+
+
 class EntityDumper(yaml.SafeDumper):
     """YAML dumper subclass used to fix under-indent of lists when dumping."""
     def __init__(self, *args, **kwargs):
@@ -15,6 +15,10 @@ class CommandError(ManagerError):
     """Error raised in case of API command execution error."""
 
 
+class RetryableCommandError(CommandError):
+    """Error raised in case of transient API command execution error."""
+
+
 class ConfigError(ManagerError):
     """Error raised in case of encountering an invalid configuration."""
 
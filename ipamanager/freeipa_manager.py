@@ -11,7 +11,10 @@ Main entry point of the tooling, responsible for delegating the tasks.
 
 import importlib
 import logging
+import os
 import sys
+import threading
+import yaml
 
 import utils
 from core import FreeIPAManagerCore
@@ -46,6 +49,7 @@ class FreeIPAManager(FreeIPAManagerCore):
             {
                 'check': self.check,
                 'push': self.push,
+                'plan': self.plan,
                 'pull': self.pull,
                 'diff': self.diff,
                 'template': self.template,
@@ -91,30 +95,62 @@ class FreeIPAManager(FreeIPAManagerCore):
     def load(self, apply_ignored=True):
         """
         Load configurations from configuration repository at the given path.
+        If Okta users are enabled, Okta users & groups are loaded concurrently
+        with the repository; the loading starts as soon as user groups
+        are parsed, because group names are all that Okta loading needs.
         :param bool apply_ignored: whether 'ignored' settings
                                    should be taken into account
         """
         self.config_loader = ConfigLoader(
             self.args.config, self.settings, apply_ignored)
-        self.entities = self.config_loader.load()
-
-        if self.okta_users:
-            if self.args.action == 'check':
+        if not self.okta_users or self.args.action == 'check':
+            self.entities = self.config_loader.load()
+            if self.okta_users:
                 self.lg.info('Okta user loading not supported in test')
                 self.entities['user'] = {}
                 self.okta_groups = []
-                return
+            return
+
+        pending = dict()
+
+        def load_okta():
+            # parse Okta groups first (to use for constructing diff), so
+            # that the group listing is cached for user filtering; both
+            # run in one thread as the loader's HTTP session is shared
+            try:
+                pending['result'] = (
+                    self.okta_loader.load_groups(), self.okta_loader.load())
+            except Exception as e:
+                pending['error'] = e
 
+        def start_okta_loading(ipa_groups):
+            if self.config_loader.errs:  # the load is going to fail anyway
+                self.lg.debug('Not loading Okta, config has errors')
+                return
             # only groups defined both in IPA & Okta are taken for Okta users
-            ipa_groups = self.entities.get('group', []).keys()
+            self.lg.debug('Starting Okta loading in background')
             self.okta_loader = OktaLoader(self.settings, ipa_groups)
-            if self.entities.get('user'):
-                self.lg.warning(
-                    '%d users parsed from Git but will be overwritten by Okta',
-                    len(self.entities['user']))
-            self.entities['user'] = self.okta_loader.load()
-            # parse Okta groups to use for constructing diff
-            self.okta_groups = self.okta_loader.load_groups()
+            # daemon thread, so that a loading abandoned because of a config
+            # error delays neither reporting the error nor exiting
+            pending['thread'] = threading.Thread(target=load_okta)
+            pending['thread'].daemon = True
+            pending['thread'].start()
+
+        try:
+            self.entities = self.config_loader.load(
+                groups_callback=start_okta_loading)
+        except Exception:
+            if 'thread' in pending:
+                self.lg.debug('Abandoning background Okta loading')
+            raise
+        if self.entities.get('user'):
+            self.lg.warning(
+                '%d users parsed from Git but will be overwritten by Okta',
+                len(self.entities['user']))
+        pending['thread'].join()
+        if 'error' in pending:
+            raise pending['error']
+        self.okta_groups, self.entities['user'] = pending['result']
 
     def check(self):
         """
@@ -142,8 +178,110 @@ class FreeIPAManager(FreeIPAManagerCore):
         self.uploader = IpaUploader(
             self.settings, self.entities, self.args.threshold,
             self.args.force, self.args.deletion, self.okta_users,
-            self.okta_groups if self.okta_users else [])
-        self.uploader.push()
+            self.okta_groups if self.okta_users else [],
+            processes=self.args.processes)
+        if self.args.changed or self.args.git_range:
+            self.uploader.push(self._resolve_changes())
+        else:
+            self.uploader.push()
+
+    def _resolve_changes(self):
+        """
+        Resolve config files changed as per the `--changed` or `--git-range`
+        arguments into entities to push. Entities defined in removed files,
+        or in previous versions of changed files but no longer in the config,
+        are returned as removed. Previous versions are taken from the base
+        of the git range (A of A..B, the merge base of A & B for A...B),
+        whose end (B) must be the checked-out HEAD, or from HEAD for the `--changed` paths (changed paths that do not
+        exist are considered removed).
+        :returns: changed repository entities & (type, name) of removed ones
+        :rtype: ([FreeIPAEntity], [(str, str)])
+        :raises ManagerError: if the changes cannot be resolved from git
+        """
+        if self.args.git_range:
+            changed, removed = utils.git_changed_files(
+                self.args.config, self.args.git_range)
+            base = utils.git_range_base(self.args.config, self.args.git_range)
+            # the entities pushed are loaded from the working tree
+            end = utils.git_range_end(self.args.config, self.args.git_range)
+            if end != utils.git_revision(self.args.config, 'HEAD'):
+                raise ManagerError(
+                    'End of git range %s is not the checked-out HEAD'
+                    % self.args.git_range)
+        else:
+            changed, removed = [], []
+            for path in self.args.changed:
+                exists = os.path.exists(os.path.join(self.args.config, path))
+                (changed if exists else removed).append(path)
+            base = 'HEAD'
+        by_path = dict()
+        for entity_dict in self.entities.itervalues():
+            for entity in entity_dict.itervalues():
+                if entity.path:
+                    by_path.setdefault(
+                        os.path.realpath(entity.path), []).append(entity)
+        changed_entities = []
+        for path in changed:
+            changed_entities.extend(by_path.get(os.path.realpath(
+                os.path.join(self.args.config, path)), []))
+        folders = dict(('%ss' % cls.entity_name, cls)
+                       for cls in utils.ENTITY_CLASSES)
+        if self.okta_users:  # users are not managed in the config
+            del folders['users']
+        removed_entities = set()
+        for path in changed + removed:
+            folder = os.path.normpath(path).split(os.sep)[0]
+            entity_class = folders.get(folder)
+            if not entity_class:
+                self.lg.debug('%s is not an entity config file, skipping',
+                              path)
+                continue
+            try:
+                contents = utils.git_file_contents(
+                    self.args.config, base, path)
+            except ManagerError:
+                if path in removed:
+                    raise
+                self.lg.debug('%s not present in %s', path, base)
+                continue
+            entity_type = entity_class.entity_name
+            for name in yaml.safe_load(contents) or ():
+                if name in self.entities.get(entity_type, {}):
+                    continue
+                if utils.check_ignored(
+                        entity_class, name, self.settings.get('ignore', {})):
+                    continue
+                removed_entities.add((entity_type, name))
+        self.lg.info('%d changed & %d removed entities to push',
+                     len(changed_entities), len(removed_entities))
+        return changed_entities, sorted(removed_entities)
+
+    def plan(self):
+        """
+        Print the commands that pushing the config at the `--new` revision
+        (working tree by default) would execute on a FreeIPA server that is
+        exactly at the `--old` revision of the config. The push planner
+        is used with the old revision standing in for FreeIPA entities,
+        so no FreeIPA access is needed.
+        :raises ConfigError: in case of configuration syntax errors
+        :raises IntegrityError: in case of config entity integrity violations
+        :raises ManagerError: if a revision cannot be checked out
+        """
+        states = []
+        for revision in (self.args.old, self.args.new):
+            self.lg.info('Loading revision %s', revision or 'working tree')
+            with utils.checkout_revision(self.args.config, revision) as path:
+                states.append(ConfigLoader(path, self.settings).load())
+        self.integrity_checker = IntegrityChecker(states[1], self.settings)
+        self.integrity_checker.check()
+        from ipa_connector import IpaUploader
+        self.uploader = IpaUploader(
+            self.settings, states[1], 100, enable_deletion=self.args.deletion,
+            processes=self.args.processes)
+        commands = self.uploader.plan(states[0])
+        for command in commands:
+            sys.stdout.write('%s\n' % command.description)
+        self.lg.info('%d commands planned', len(commands))
 
     def pull(self):
         """
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - execution governor module
+
+Pacing of IPA command execution, so that pushes do not overload
+the FreeIPA master & its replication: transient command failures
+are retried with jittered exponential backoff, and the concurrency
+& batch size of parallel execution are adapted to a target latency
+(additive increase while the server keeps up, multiplicative decrease
+when it gets slow or fails transiently).
+"""
+
+import random
+import threading
+import time
+
+from core import FreeIPAManagerCore
+from errors import CommandError, RetryableCommandError
+
+
+class ExecutionGovernor(FreeIPAManagerCore):
+    """
+    Governor of command execution.
+    :attr int concurrency: number of commands to execute in parallel
+    :attr int batch_size: number of entity batches per worker in a wave
+    """
+    def __init__(self, settings, max_concurrency=1):
+        """
+        :param dict settings: parsed contents of the settings file
+        :param int max_concurrency: maximal number of parallel commands
+        """
+        super(ExecutionGovernor, self).__init__()
+        execution = settings.get('execution', dict())
+        self.target_latency = execution.get('target_latency', 1.0)
+        self.retries = execution.get('retries', 3)
+        self.backoff = execution.get('backoff', 0.5)
+        self.max_backoff = execution.get('max_backoff', 30)
+        self.max_batch_size = execution.get('max_batch_size', 16)
+        self.max_concurrency = max_concurrency
+        self.concurrency = 1
+        self.batch_size = 1
+        self._lock = threading.Lock()
+        self._latencies = []  # latencies of the current wave
+        self._transient = 0  # transient errors in the current wave
+        self.stats = {'commands': 0, 'attempts': 0, 'retries': 0,
+                      'errors': 0, 'time': 0.0}
+
+    def execute(self, command, api):
+        """
+        Execute a command, retrying it in case of transient errors.
+        Other errors are raised right away.
+        :param Command command: command to execute
+        :param api: API object to execute the command with
+        :raises CommandError: if the command fails (after all retries)
+        """
+        attempt = 0
+        try:
+            while True:
+                start = time.time()
+                try:
+                    command.execute(api)
+                    self._record(time.time() - start)
+                    return
+                except RetryableCommandError as e:
+                    self._record(time.time() - start, transient=True)
+                    if attempt >= self.retries:
+                        raise
+                    attempt += 1
+                    delay = random.uniform(0, min(
+                        self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+                    self.lg.warning(
+                        '%s failed transiently, retry %d/%d in %.2f s: %s',
+                        command.description, attempt, self.retries, delay, e)
+                    time.sleep(delay)
+                except CommandError:
+                    self._record(time.time() - start)
+                    raise
+        except CommandError:
+            with self._lock:
+                self.stats['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                self.stats['commands'] += 1
+                self.stats['retries'] += attempt
+
+    def _record(self, latency, transient=False):
+        with self._lock:
+            self._latencies.append(latency)
+            self._transient += transient
+            self.stats['attempts'] += 1
+            self.stats['time'] += latency
+
+    def adjust(self):
+        """
+        Adapt concurrency & batch size after a wave of commands: halve
+        them if the wave was slower than the target latency (on average)
+        or had transient errors, increase them by one otherwise.
+        """
+        with self._lock:
+            latencies, transient = self._latencies, self._transient
+            self._latencies, self._transient = [], 0
+        if not latencies:
+            return
+        latency = sum(latencies) / len(latencies)
+        if transient or latency > self.target_latency:
+            self.concurrency = max(1, self.concurrency // 2)
+            self.batch_size = max(1, self.batch_size // 2)
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.batch_size = min(self.max_batch_size, self.batch_size + 1)
+        self.lg.debug(
+            'Mean latency %.3f s, %d transient errors; concurrency %d, '
+            'batch size %d', latency, transient, self.concurrency,
+            self.batch_size)
+
+    def log_stats(self):
+        if not self.stats['commands']:
+            return
+        self.lg.info(
+            'Executed %d commands (%d retries, %d errors), '
+            'mean latency %.3f s', self.stats['commands'],
+            self.stats['retries'], self.stats['errors'],
+            self.stats['time'] / self.stats['attempts'])
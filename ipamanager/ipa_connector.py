@@ -9,27 +9,72 @@ Tool for updating a FreeIPA server via API
 from local entity configuration.
 """
 
+import hashlib
+import itertools
+import json
+import multiprocessing
 import re
 import os
-from ipalib import api
+import time
+from operator import attrgetter
+try:
+    from ipalib import api, errors as ipa_errors
+except ImportError:  # not on a FreeIPA node, only offline planning possible
+    api = ipa_errors = None
 
 import entities
 from command import Command
 from core import FreeIPAManagerCore
 from entities import FreeIPAEntity
 from errors import CommandError, ConfigError, ManagerError
+from governor import ExecutionGovernor
+from rpc_client import IpaRpcClient
 from utils import ENTITY_CLASSES, check_ignored
 
+# uploader & entity queue shared with planner worker processes (via fork)
+_planning_uploader = None
+
 
 class IpaConnector(FreeIPAManagerCore):
     """
     Responsible for updating FreeIPA server with changed configuration.
     """
-    def __init__(self, parsed, settings):
+    def __init__(self, parsed, settings, ipa_api=None, api_errors=None):
+        """
+        :param dict parsed: dictionary of entities from `IntegrityChecker`
+        :param dict settings: parsed contents of the settings file
+        :param ipa_api: object to use as the API instead of `ipalib.api`
+            (e.g., `ipamanager.tools.fake_ipa.FakeIpa`)
+        :param api_errors: module of the exceptions raised by `ipa_api`
+            to use instead of `ipalib.errors`
+        """
         super(IpaConnector, self).__init__()
+        self.api = ipa_api if ipa_api is not None else api
+        self.api_errors = api_errors if api_errors is not None else ipa_errors
         self.ignored = settings.get('ignore', dict())
         self.repo_entities = parsed
         self.ipa_entities = dict()
+        self._membership_index = None
+        self._prefetched = dict()
+
+    def _find_entities(self, entity_type):
+        """
+        Load data of all entities of a type via API.
+        :param str entity_type: entity type (e.g., 'hostgroup')
+        :returns: entity data as returned by the API
+        :rtype: [dict]
+        :raises ManagerError: if there is an error communicating with the API
+        """
+        command = '%s_find' % entity_type
+        self.lg.debug('Running API command %s', command)
+        try:
+            parsed = self.api.Command[command](all=True, sizelimit=0)
+        except KeyError:
+            raise ManagerError('Undefined API command %s' % command)
+        except Exception as e:
+            raise ManagerError('Error loading %s entities from API: %s'
+                               % (entity_type, e))
+        return parsed['result']
 
     def load_ipa_entities(self):
         """
@@ -41,19 +86,17 @@ class IpaConnector(FreeIPAManagerCore):
         :returns: None (entities saved in the `self.ipa_entities` dict)
         """
         self.lg.info('Loading entities from FreeIPA API')
+        self._membership_index = None
+        # entities already loaded for the push state check, if any
+        prefetched, self._prefetched = self._prefetched, dict()
         for entity_class in ENTITY_CLASSES:
             entity_type = entity_class.entity_name
             self.ipa_entities[entity_type] = dict()
-            command = '%s_find' % entity_type
-            self.lg.debug('Running API command %s', command)
-            try:
-                parsed = api.Command[command](all=True, sizelimit=0)
-            except KeyError:
-                raise ManagerError('Undefined API command %s' % command)
-            except Exception as e:
-                raise ManagerError('Error loading %s entities from API: %s'
-                                   % (entity_type, e))
-            for data in parsed['result']:
+            if entity_type in prefetched:
+                found = prefetched[entity_type]
+            else:
+                found = self._find_entities(entity_type)
+            for data in found:
                 name = data[entity_class.entity_id_type][0]
                 if check_ignored(entity_class, name, self.ignored):
                     self.lg.debug(
@@ -72,7 +115,8 @@ class IpaConnector(FreeIPAManagerCore):
 
 class IpaUploader(IpaConnector):
     def __init__(self, settings, parsed, threshold, force=False,
-                 enable_deletion=False, okta_users=False, okta_groups=[]):
+                 enable_deletion=False, okta_users=False, okta_groups=[],
+                 processes=None, ipa_api=None, api_errors=None):
         """
         Initialize an IPA connector object.
         :param dict settings: parsed contents of the settings file
@@ -82,15 +126,30 @@ class IpaUploader(IpaConnector):
         :param bool enable_deletion: enable deleting entities
         :param bool okta_users: push users from Okta instead of Git
         :param [str] okta_groups: list of Okta groups to use for diff
+        :param int processes: number of planner worker processes
+                              (plan in a single process if None)
+        :param ipa_api: object to use as the API instead of `ipalib.api`
+        :param api_errors: module to use instead of `ipalib.errors`
         """
-        super(IpaUploader, self).__init__(parsed, settings)
+        super(IpaUploader, self).__init__(
+            parsed, settings, ipa_api, api_errors)
         self.threshold = threshold
         self.force = force
         self.enable_deletion = enable_deletion
+        self.processes = processes
         # deletion patterns used to filter commands in add-only mode
         self.deletion_patterns = settings.get(
             'deletion-patterns',
             ['.+_del$', '.+_remove_member$', '.+_remove_option$'])
+        self._init_deletion_filter()
+
+        # execute commands over JSON-RPC instead of ipalib if configured
+        self.rpc_client = IpaRpcClient(settings) if 'rpc' in settings else None
+        self.governor = ExecutionGovernor(settings)
+
+        # state of the last successful push for the "nothing changed" check
+        self.state_file = settings.get('push-state-file')
+        self.state_max_age = settings.get('push-state-max-age', 86400)
 
         # parse Okta-related settings
         okta_settings = settings.get('okta', dict())
@@ -108,32 +167,98 @@ class IpaUploader(IpaConnector):
         """
         self.lg.debug('Preparing IPA update commands')
         self.commands = []
+        self._init_deletion_filter()
+        queue = []
         for entity_type in self.repo_entities:
-            self.lg.debug('Processing %s entities', entity_type)
             if entity_type == 'service':
                 if self.repo_entities[entity_type]:
                     self.lg.warning('Service push not supported yet, skipping')
                     continue
-            for entity in self.repo_entities[entity_type].itervalues():
-                self.lg.debug('Processing entity %s', entity)
-                self._parse_entity_diff(entity)
+            queue.extend(self.repo_entities[entity_type].itervalues())
+        if self.processes and self.processes > 1 and queue:
+            self._plan_parallel(queue)
+        else:
+            self._plan_entities(queue)
         self._prepare_del_commands()
-        self._filter_deletion_commands()
-        self.lg.info('%d commands to execute', len(self.commands))
+        self._log_plan()
+
+    def _plan_entities(self, queue):
+        """
+        Prepare update commands for the given entities.
+        :param [FreeIPAEntity] queue: local entities to process
+        :returns: created commands & number of skipped deletion commands
+        :rtype: ([Command], int)
+        """
+        for entity in queue:
+            self.lg.debug('Processing entity %s', entity)
+            self._parse_entity_diff(entity)
+        return self.commands, self.skipped_deletions
+
+    def _plan_parallel(self, queue):
+        """
+        Prepare update commands for the given entities in a pool of worker
+        processes. The entities are split into contiguous shards, which
+        are planned by the workers from the remote state inherited from
+        the parent process (shared copy-on-write after fork). Commands
+        of the shards are joined in the shard order, so the result is
+        the same as planning all entities in a single process.
+        :param [FreeIPAEntity] queue: local entities to process
+        """
+        global _planning_uploader
+        processes = min(self.processes, len(queue))
+        size = -(-len(queue) // processes)  # ceiling division
+        # only shard bounds are sent to the workers, not the entities
+        shards = [(i, i + size) for i in range(0, len(queue), size)]
+        self.lg.debug('Planning %d entities in %d processes',
+                      len(queue), len(shards))
+        # build the shared membership index once, before forking the workers
+        self._ipa_memberships()
+        _planning_uploader = (self, queue)
+        pool = multiprocessing.Pool(len(shards))
+        try:
+            results = pool.map(_plan_entities, shards)
+        finally:
+            pool.terminate()
+            _planning_uploader = None
+        self.commands.extend(itertools.chain.from_iterable(
+            commands for commands, _ in results))
+        self.skipped_deletions += sum(skipped for _, skipped in results)
+
+    def _init_deletion_filter(self):
+        """
+        Prepare filtering of deletion commands (in case deletion mode
+        is not enabled) for a new plan: compile the deletion patterns
+        and reset the count of skipped deletion commands.
+        """
+        self._deletion_regexes = [re.compile(i) for i in self.deletion_patterns]
+        self._deletions = dict()  # command name -> matches a pattern
+        self.skipped_deletions = 0
 
-    def _filter_deletion_commands(self):
+    def _skip_deletion(self, command):
         """
-        Filter commands to execute in case deletion mode is not enabled.
+        Check whether a command should be skipped (not created) because
+        it is a deletion and deletion mode is not enabled. Patterns are
+        only matched once per command name; skipped commands are counted.
+        :param str command: name of the command (e.g., group_del)
+        :returns: True if the command should be skipped
+        :rtype: bool
         """
         if self.enable_deletion:  # all commands should be executed
-            return
-        filtered_commands = []
-        for command in self.commands:
-            cmd = command.command
-            if any(re.match(regex, cmd) for regex in self.deletion_patterns):
-                continue
-            filtered_commands.append(command)
-        self.commands = filtered_commands
+            return False
+        deletion = self._deletions.get(command)
+        if deletion is None:
+            deletion = any(regex.match(command)
+                           for regex in self._deletion_regexes)
+            self._deletions[command] = deletion
+        if deletion:
+            self.skipped_deletions += 1
+        return deletion
+
+    def _log_plan(self):
+        if self.skipped_deletions:
+            self.lg.info('%d deletion commands skipped (deletion disabled)',
+                         self.skipped_deletions)
+        self.lg.info('%d commands to execute', len(self.commands))
 
     def _parse_entity_diff(self, entity):
         """
@@ -147,9 +272,9 @@ class IpaUploader(IpaConnector):
         remote_entity = self.ipa_entities[entity.entity_name].get(entity.name)
         if not isinstance(entity, entities.FreeIPARule):
             self._process_membership(entity)
-        commands = entity.create_commands(remote_entity)
-        if commands:
-            self.commands.extend(commands)
+        # deletions are skipped before their commands are created
+        self.commands.extend(
+            entity.create_commands(remote_entity, self._skip_deletion))
 
     def _process_membership(self, entity):
         """
@@ -161,13 +286,12 @@ class IpaUploader(IpaConnector):
         """
         self.lg.debug('Processing membership for %s', entity)
         member_of = entity.data_repo.get('memberOf', dict())
-        key = 'member_%s' % entity.entity_name
+        ipa_member_of = self._ipa_memberships().get(
+            (entity.entity_name, entity.name), ())
         for target_type in member_of:
             for target_name in member_of[target_type]:
                 repo_group = self.repo_entities[target_type][target_name]
-                ipa_group = self.ipa_entities[target_type].get(target_name)
-                if ipa_group and entity.name in ipa_group.data_ipa.get(
-                        key, []):
+                if (target_type, target_name) in ipa_member_of:
                     self.lg.debug(
                         '%s already member of %s', entity, repo_group)
                     continue
@@ -176,75 +300,414 @@ class IpaUploader(IpaConnector):
                     Command(command, {entity.entity_name: (entity.name,)},
                             repo_group.name, repo_group.entity_id_type))
 
-        target_types = [cls.entity_name for cls in ENTITY_CLASSES
-                        if entity.entity_name in cls.allowed_members]
-        for target_type in target_types:
+        for target_type, target in sorted(ipa_member_of):
+            target_class = FreeIPAEntity.get_entity_class(target_type)
+            if entity.entity_name not in target_class.allowed_members:
+                continue
             if (entity.entity_name == 'user' and target_type == 'group'
-                    and self.okta_users):
-                targets = [gr for gr in self.okta_groups
-                           if gr in self.ipa_entities[target_type]]
-            else:
-                targets = self.ipa_entities[target_type].keys()
-            for target in targets:
-                members = self.ipa_entities[target_type][target].data_ipa.get(
-                    'member_%s' % entity.entity_name, [])
-                if entity.name in members:
-                    if target not in member_of.get(target_type, []):
-                        command = '%s_remove_member' % target_type
-                        diff = {entity.entity_name: (entity.name,)}
-                        self.commands.append(
-                            Command(command, diff, target, 'cn'))
+                    and self.okta_users and target not in self.okta_groups):
+                continue
+            if target not in member_of.get(target_type, []):
+                command = '%s_remove_member' % target_type
+                if self._skip_deletion(command):
+                    continue
+                diff = {entity.entity_name: (entity.name,)}
+                self.commands.append(Command(command, diff, target, 'cn'))
+
+    def _ipa_memberships(self):
+        """
+        Get the index of memberships defined on FreeIPA, built from
+        the member_<type> attributes of loaded entities on first use
+        (the index is reset whenever entities are loaded), so that
+        membership checks do not scan the member lists of all groups.
+        :returns: (member type, member name) -> set of (type, name)
+                  of entities the member is a direct member of
+        :rtype: dict
+        """
+        if self._membership_index is None:
+            index = dict()
+            for target_type, target_dict in self.ipa_entities.iteritems():
+                for target_name, target in target_dict.iteritems():
+                    for key, members in target.data_ipa.iteritems():
+                        if not key.startswith('member_'):
+                            continue
+                        member_type = key[len('member_'):]
+                        for member in members:
+                            index.setdefault((member_type, member), set()).add(
+                                (target_type, target_name))
+            self._membership_index = index
+        return self._membership_index
 
     def _prepare_del_commands(self):
         """
         Prepare commands handling entity deletion (.+_del).
-        These entities may then be filtered out based on the setting
-        of `deletion_patterns` attribute & the value of `enable_deletion` flag.
+        These commands are skipped based on the setting of
+        `deletion_patterns` attribute & the value of `enable_deletion` flag.
         """
         for entity_type in self.ipa_entities:
             entity_class = FreeIPAEntity.get_entity_class(entity_type)
             self.lg.debug('Preparing deletion of %s entities', entity_type)
+            command = '%s_del' % entity_type
             for name, entity in self.ipa_entities[entity_type].iteritems():
                 if name not in self.repo_entities.get(entity_type, dict()):
+                    if self._skip_deletion(command):
+                        continue
                     self.lg.debug('Marking %s for deletion', name)
-                    command = '%s_del' % entity_type
                     self.commands.append(
                         Command(
                             command, {}, name, entity_class.entity_id_type))
 
-    def push(self):
+    def load_ipa_entities_from_repo(self, parsed):
+        """
+        Stand a repository state in for the entities defined on FreeIPA,
+        as if FreeIPA was exactly at that state (for offline planning).
+        Entity data is converted to the format returned by the API,
+        including the membership attributes of groups & rules.
+        :param dict parsed: dictionary of entities of the repository state
+        :returns: None (entities saved in the `self.ipa_entities` dict)
+        """
+        self.lg.info('Loading FreeIPA entities from repository state')
+        self._membership_index = None
+        members = dict()
+        for entity_type, entity_dict in parsed.iteritems():
+            for entity in entity_dict.itervalues():
+                for target_type, target_list in entity.data_repo.get(
+                        'memberOf', dict()).iteritems():
+                    for target in target_list:
+                        members.setdefault((target_type, target), dict())\
+                            .setdefault('member_%s' % entity_type, [])\
+                            .append(unicode(entity.name))
+        for entity_class in ENTITY_CLASSES:
+            entity_type = entity_class.entity_name
+            self.ipa_entities[entity_type] = dict()
+            for name, entity in parsed.get(entity_type, dict()).iteritems():
+                data = dict((k, v) for k, v in entity.data_ipa.iteritems()
+                            if k != 'memberof')
+                if isinstance(entity, entities.FreeIPARule):
+                    for key, member_type in (('memberhost', 'hostgroup'),
+                                             ('memberuser', 'group'),
+                                             ('memberservice', 'hbacsvc')):
+                        if key in data:
+                            data['%s_%s' % (key, member_type)] = data.pop(key)
+                elif isinstance(entity, entities.FreeIPAUserGroup):
+                    if entity.posix:
+                        data['objectclass'] = (u'posixgroup',)
+                for key, value in members.get(
+                        (entity_type, name), dict()).iteritems():
+                    data[key] = tuple(sorted(value))
+                self.ipa_entities[entity_type][name] = entity_class(name, data)
+        self.ipa_entity_count = sum(
+            len(i) for i in self.ipa_entities.itervalues())
+        self.lg.info(
+            'Loaded %d entities from repository state', self.ipa_entity_count)
+
+    def plan(self, parsed):
+        """
+        Plan the commands that a push would execute on a FreeIPA server
+        exactly at the given repository state, without any API access.
+        :param dict parsed: dictionary of entities of the repository state
+        :returns: commands in the order of execution
+        :rtype: [Command]
+        """
+        self.load_ipa_entities_from_repo(parsed)
+        self._prepare_push()
+        return sorted(self.commands, key=attrgetter('sort_key'))
+
+    def _load_ipa_entity(self, entity_type, name):
+        """
+        Load a single entity defined on the FreeIPA via API (unless loaded
+        already) and save it in the `self.ipa_entities` nested dictionary.
+        :param str entity_type: type of the entity (e.g., 'hostgroup')
+        :param str name: name of the entity
+        :returns: the loaded entity (None if it does not exist or is ignored)
+        :rtype: FreeIPAEntity
+        :raises ManagerError: if there is an error communicating with the API
+        """
+        entity_class = FreeIPAEntity.get_entity_class(entity_type)
+        loaded = self.ipa_entities.setdefault(entity_type, dict())
+        if name in loaded or (entity_type, name) in self._not_found:
+            return loaded.get(name)
+        if check_ignored(entity_class, name, self.ignored):
+            self.lg.debug('Not loading ignored %s %s', entity_type, name)
+            return None
+        command = '%s_show' % entity_type
+        self.lg.debug('Running API command %s %s', command, name)
+        try:
+            data = self.api.Command[command](
+                all=True, **{entity_class.entity_id_type: name})['result']
+        except KeyError:
+            raise ManagerError('Undefined API command %s' % command)
+        except self.api_errors.NotFound:
+            self.lg.debug('%s %s does not exist in FreeIPA', entity_type, name)
+            self._not_found.add((entity_type, name))
+            return None
+        except Exception as e:
+            raise ManagerError('Error loading %s %s from API: %s'
+                               % (entity_type, name, e))
+        loaded[name] = entity_class(name, data)
+        return loaded[name]
+
+    def load_ipa_entities_targeted(self, changed, removed):
+        """
+        Load only the FreeIPA entities affected by a change via `_show`
+        commands instead of listing all entities of all types. These are
+        the changed entities, the entities removed from the config,
+        the groups/rules the changed entities should be members of
+        (as per their memberOf) and those they are members of in FreeIPA.
+        :param [FreeIPAEntity] changed: changed repository entities
+        :param [(str, str)] removed: types & names of removed entities
+        :raises ManagerError: if there is an error communicating with the API
+        """
+        self.lg.info('Loading %d changed & %d removed entities from FreeIPA',
+                     len(changed), len(removed))
+        self.ipa_entities = dict(
+            (cls.entity_name, dict()) for cls in ENTITY_CLASSES)
+        self._membership_index = None
+        self._not_found = set()
+        for entity_type, name in removed:
+            self._load_ipa_entity(entity_type, name)
+        for entity in changed:
+            if entity.entity_name == 'service':
+                continue
+            remote = self._load_ipa_entity(entity.entity_name, entity.name)
+            targets = set()
+            for target_type, target_list in entity.data_repo.get(
+                    'memberOf', dict()).iteritems():
+                targets.update((target_type, i) for i in target_list)
+            if remote:
+                for cls in ENTITY_CLASSES:
+                    if entity.entity_name in cls.allowed_members:
+                        targets.update(
+                            (cls.entity_name, i) for i in remote.data_ipa.get(
+                                'memberof_%s' % cls.entity_name, ()))
+            for target_type, target_name in sorted(targets):
+                self._load_ipa_entity(target_type, target_name)
+        # threshold is checked against the whole config, as FreeIPA
+        # is not listed; it matches the FreeIPA entity count when in sync
+        self.ipa_entity_count = sum(
+            len(i) for i in self.repo_entities.itervalues())
+        self.lg.info('Loaded %d entities from FreeIPA API', sum(
+            len(i) for i in self.ipa_entities.itervalues()))
+
+    def _prepare_push_targeted(self, changed, removed):
+        """
+        Prepare the queue of commands for the changed & removed entities only
+        (see `_prepare_push`). Only entities removed from the config
+        are considered for deletion.
+        :param [FreeIPAEntity] changed: changed repository entities
+        :param [(str, str)] removed: types & names of removed entities
+        """
+        self.lg.debug('Preparing IPA update commands for changed entities')
+        self.commands = []
+        self._init_deletion_filter()
+        for entity in changed:
+            if entity.entity_name == 'service':
+                self.lg.warning('Service push not supported yet, skipping')
+                continue
+            self.lg.debug('Processing entity %s', entity)
+            self._parse_entity_diff(entity)
+        for entity_type, name in removed:
+            if name in self.repo_entities.get(entity_type, dict()):
+                continue
+            if name in self.ipa_entities[entity_type]:
+                if self._skip_deletion('%s_del' % entity_type):
+                    continue
+                self.lg.debug('Marking %s for deletion', name)
+                entity_class = FreeIPAEntity.get_entity_class(entity_type)
+                self.commands.append(Command(
+                    '%s_del' % entity_type, {}, name,
+                    entity_class.entity_id_type))
+        self._log_plan()
+
+    def push(self, changes=None):
         """
         Execute update by running commands from the execution queue
         prepared by the `prepare_update` method.
         Commands will only be executed if their total number does not
         exceed the `threshold` attribute.
+        :param tuple changes: changed repository entities & (type, name)
+                              of removed entities; if given, only these
+                              entities are loaded from FreeIPA & pushed
         :raises ManagerError: in case of exceeded threshold/API error
         """
-        self.load_ipa_entities()
-        self._prepare_push()
+        if changes is not None:
+            self.load_ipa_entities_targeted(*changes)
+            self._prepare_push_targeted(*changes)
+        else:
+            if self.state_file:
+                state = self._current_state()
+                if self._state_unchanged(state):
+                    self.lg.info('Neither config nor FreeIPA changed since '
+                                 'last push, nothing to do')
+                    return
+            self.load_ipa_entities()
+            self._prepare_push()
         if not self.commands:
             self.lg.info('FreeIPA consistent with local config, nothing to do')
+            if self.state_file and changes is None:
+                self._save_state(state)
             return
         if not self.force:  # dry run
             self.lg.info('Would execute commands:')
-            for command in sorted(self.commands):
+            for command in sorted(self.commands,
+                                  key=attrgetter('sort_key')):
                 self.lg.info('- %s', command)
         self._check_threshold()
 
         if self.force:
-            # command sorting really important here for correct update!
-            for command in sorted(self.commands):
-                try:
-                    command.execute(api)
-                except CommandError as e:
-                    err = 'Error executing %s: %s' % (command.description, e)
-                    self.lg.error(err)
-                    # only added here to count the number of errors
-                    self.errs.append(err)
+            if self.rpc_client:
+                # commands are sorted & executed by rank by the client
+                self.errs.extend(self.rpc_client.execute(self.commands))
+            else:
+                self._execute_commands()
 
             if self.errs:
                 raise ManagerError(
                     'There were %d errors executing update' % len(self.errs))
+            if self.state_file and changes is None:
+                # only the types that the commands changed are listed again
+                state['remote'].update(
+                    self._remote_indicators(types=self._affected_types()))
+                self._save_state(state)
+
+    def _execute_commands(self):
+        # command sorting really important here for correct update!
+        for command in sorted(self.commands, key=attrgetter('sort_key')):
+            try:
+                self.governor.execute(command, self.api)
+            except CommandError as e:
+                err = 'Error executing %s: %s' % (command.description, e)
+                self.lg.error(err)
+                # only added here to count the number of errors
+                self.errs.append(err)
+        self.governor.log_stats()
+
+    def _current_state(self):
+        """
+        Compute the fingerprint of the current push state. It consists of
+        a hash of the repository entities (and settings affecting the push)
+        and of indicators of the FreeIPA state (see below).
+        :returns: state with `repository` and `remote` keys
+        :rtype: dict
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps([
+            self.enable_deletion, sorted(self.deletion_patterns),
+            sorted(self.okta_groups)]))
+        for entity_type in sorted(self.repo_entities):
+            for name, entity in sorted(
+                    self.repo_entities[entity_type].iteritems()):
+                # YAML may parse values into non-JSON types (e.g., dates)
+                digest.update(json.dumps(
+                    [entity_type, name, entity.data_repo], sort_keys=True,
+                    default=unicode))
+        return {'repository': digest.hexdigest(),
+                'remote': self._remote_indicators(keep=True)}
+
+    def _remote_indicators(self, keep=False, types=None):
+        """
+        Collect indicators of FreeIPA state from the data that a full push
+        would load (`*_find` with all attributes): per entity type, the count
+        of (non-ignored) entities, a hash of their names & attribute values
+        (so any attribute or membership change made directly in FreeIPA
+        changes it) and their max `modifytimestamp` (None if not returned).
+        This is not a cheap probe: all entities are listed with all their
+        attributes (`*_find` cannot return only some of them, and direct
+        membership changes are only visible in the full data). The data are
+        kept for the full push, so the check costs the same API load as
+        a full push; what it saves is the planning of the push.
+        :param bool keep: keep the loaded data for `load_ipa_entities`
+                          (so that a full push does not load it again)
+        :param set types: entity types to collect indicators of (all if None)
+        :returns: entity type -> [count, data hash, max modifytimestamp]
+        :rtype: dict
+        :raises ManagerError: if there is an error communicating with the API
+        """
+        result = dict()
+        prefetched = dict()
+        for entity_class in ENTITY_CLASSES:
+            entity_type = entity_class.entity_name
+            if types is not None and entity_type not in types:
+                continue
+            found = prefetched[entity_type] = self._find_entities(entity_type)
+            digest = hashlib.sha256()
+            count = 0
+            timestamps = []
+            for data in sorted(
+                    found, key=lambda i: i[entity_class.entity_id_type]):
+                name = data[entity_class.entity_id_type][0]
+                if check_ignored(entity_class, name, self.ignored):
+                    continue
+                count += 1
+                digest.update(json.dumps(
+                    [name, _normalize_remote(data)], sort_keys=True))
+                timestamps.extend(
+                    unicode(i) for i in data.get('modifytimestamp', ()))
+            result[entity_type] = [count, digest.hexdigest(),
+                                   max(timestamps) if timestamps else None]
+        if keep:
+            self._prefetched = prefetched
+        return result
+
+    def _affected_types(self):
+        """
+        Get types of entities whose FreeIPA data the executed commands
+        changed: types of the modified entities and, for membership
+        commands, types of the members (their `memberof_*` attributes
+        change as well).
+        :rtype: set
+        """
+        entity_types = set(cls.entity_name for cls in ENTITY_CLASSES)
+        affected = set()
+        for command in self.commands:
+            affected.add(command.command.split('_', 1)[0])
+            affected.update(entity_types.intersection(command.payload))
+        return affected
+
+    def _state_unchanged(self, state):
+        """
+        Compare the current push state with the one saved after the last
+        successful push. Any difference (or a missing/outdated saved state)
+        means that the full push has to run.
+        :param dict state: current state (see `_current_state`)
+        :returns: True if nothing has changed since the last push
+        :rtype: bool
+        """
+        try:
+            with open(self.state_file) as src:
+                saved = json.load(src)
+        except (IOError, ValueError) as e:
+            self.lg.debug('Cannot read push state from %s: %s',
+                          self.state_file, e)
+            return False
+        if self.state_max_age is not None and (
+                time.time() - saved.get('time', 0) > self.state_max_age):
+            self.lg.info('Push state older than %d seconds, running full push',
+                         self.state_max_age)
+            return False
+        if saved.get('repository') != state['repository']:
+            self.lg.debug('Config changed since last push')
+            return False
+        if saved.get('remote') != state['remote']:
+            self.lg.info('FreeIPA changed since last push, running full push')
+            return False
+        return True
+
+    def _save_state(self, state):
+        """
+        Save the push state after a successful push (called only when
+        changes were executed or FreeIPA was already consistent).
+        :param dict state: state to save (see `_current_state`)
+        """
+        state = dict(state, time=time.time())
+        try:
+            with open(self.state_file, 'w') as target:
+                json.dump(state, target)
+        except IOError as e:
+            self.lg.warning('Cannot save push state to %s: %s',
+                            self.state_file, e)
+            return
+        self.lg.debug('Push state saved to %s', self.state_file)
 
     def _check_threshold(self):
         try:
@@ -264,7 +727,8 @@ class IpaUploader(IpaConnector):
 
 class IpaDownloader(IpaConnector):
     def __init__(self, settings, parsed, repo_path,
-                 dry_run=False, add_only=False, pull_types=['user']):
+                 dry_run=False, add_only=False, pull_types=['user'],
+                 ipa_api=None, api_errors=None):
         """
         Initialize an IPA connector object.
         :param dict settings: parsed contents of the settings file
@@ -272,8 +736,11 @@ class IpaDownloader(IpaConnector):
         :param str repo_path: path to configuration repository
         :param bool force: execute changes (dry run if False)
         :param bool enable_deletion: enable deleting entities
+        :param ipa_api: object to use as the API instead of `ipalib.api`
+        :param api_errors: module to use instead of `ipalib.errors`
         """
-        super(IpaDownloader, self).__init__(parsed, settings)
+        super(IpaDownloader, self).__init__(
+            parsed, settings, ipa_api, api_errors)
         self.basepath = repo_path
         self.dry_run = dry_run
         self.add_only = add_only
@@ -382,3 +849,26 @@ class IpaDownloader(IpaConnector):
             raise ConfigError('%s filename already used' % fname)
         self.lg.debug('Setting %s file path to %s', entity, fname)
         entity.path = os.path.join(self.basepath, fname)
+
+
+def _normalize_remote(data):
+    """
+    Normalize entity data returned by the API for hashing (values as sorted
+    lists of strings, as the order of LDAP attribute values is arbitrary).
+    """
+    return dict(
+        (key, sorted(unicode(i) for i in value)
+         if isinstance(value, (list, tuple)) else unicode(value))
+        for key, value in data.iteritems())
+
+
+def _plan_entities(bounds):
+    """
+    Worker function of the planner process pool. Plans a shard (given
+    by its bounds) of the entity queue of the uploader instance
+    inherited from the parent process.
+    """
+    uploader, queue = _planning_uploader
+    uploader.commands = []
+    uploader.skipped_deletions = 0
+    return uploader._plan_entities(queue[bounds[0]:bounds[1]])
@@ -22,10 +22,13 @@ class OktaLoader(FreeIPAManagerCore):
     Responsible for loading users from Okta.
     :attr dict users: Structure of users loaded from Okta
     """
-    def __init__(self, settings, groups):
+    def __init__(self, settings, groups, transport=None):
         """
         :param dict settings: parsed contents of the settings file
         :param list(str) groups: current groups defined for FreeIPA
+        :param requests.adapters.BaseAdapter transport: transport adapter
+            to use for Okta API requests instead of the default HTTP one
+            (e.g., `ipamanager.tools.okta_replay.OktaReplayAdapter`)
         """
         super(OktaLoader, self).__init__()
         self.ignored = {'user': settings['okta'].get('ignore', [])}
@@ -38,15 +41,20 @@ class OktaLoader(FreeIPAManagerCore):
         self.okta_org = okta_auth['org']
         self.okta_token = self._load_okta_token(okta_auth['token_path'])
         self.okta_url = 'https://%s.okta.com/api/v1' % self.okta_org
+        self.okta_groups = None
+        self.filtered = False
+        self._managers = dict()
 
-        self._setup_okta_session()
+        self._setup_okta_session(transport)
 
     def _load_okta_token(self, path):
         with open(path) as tokenfile:
             return tokenfile.read().strip()
 
-    def _setup_okta_session(self):
+    def _setup_okta_session(self, transport=None):
         self.session = requests.Session()
+        if transport:
+            self.session.mount('https://', transport)
         self.session.headers = {
             'Accept': 'application/json',
             'Content-Type': 'application/json',
@@ -63,11 +71,29 @@ class OktaLoader(FreeIPAManagerCore):
         if not manager_id:
             self.lg.warning('User %s has no manager defined', uid)
             return
-        for other in self.okta_users:
-            if other['profile'].get('employeeNumber') == manager_id:
-                return self._parse_uid(other['profile']['login'], uid_regex)
+        if manager_id not in self._managers:  # misses are cached as well
+            self._managers[manager_id] = self._find_manager(manager_id)
+        manager = self._managers[manager_id]
+        if manager:
+            return self._parse_uid(manager['profile']['login'], uid_regex)
         self.lg.warning('User %s manager (ID %s) not found', uid, manager_id)
 
+    def _find_manager(self, manager_id):
+        """
+        Look up a manager who is not among the loaded users (which may
+        happen if users are filtered by groups) by employee number.
+        :param str manager_id: employee number of the manager
+        :returns: Okta user record of the manager (None if not found)
+        :rtype: dict
+        """
+        if not self.filtered:
+            return None
+        query = 'profile.employeeNumber eq "%s"' % (
+            unicode(manager_id).replace('"', '\\"'))
+        found = self._get_okta_api_pages(
+            '%s/users' % self.okta_url, params={'search': query})
+        return found[0] if found else None
+
     def load(self):
         """
         Parse Okta users and attributes.
@@ -77,7 +103,14 @@ class OktaLoader(FreeIPAManagerCore):
         uid_regex = self.settings['okta']['user_id_regex']
         group_filter = self.settings['okta'].get('user_group_filter', [])
 
-        self.okta_users = self._get_okta_api_pages('%s/users' % self.okta_url)
+        self.filtered = bool(group_filter)
+        self.okta_users = self._load_okta_users(group_filter)
+        # employee number -> user record, to look up managers
+        self._managers = dict()
+        for user in self.okta_users:
+            employee_number = user['profile'].get('employeeNumber')
+            if employee_number:
+                self._managers.setdefault(employee_number, user)
 
         for user in self.okta_users:
             try:
@@ -138,18 +171,56 @@ class OktaLoader(FreeIPAManagerCore):
         self.lg.info('%d users loaded from Okta', len(users))
         return users
 
+    def _load_okta_users(self, group_filter):
+        """
+        Download Okta users to parse. If a group filter is configured,
+        only members of the filter groups are fetched from the server,
+        so that users outside of the filter cost no API requests.
+        :param [str] group_filter: names of groups to filter users by
+        :returns: list of Okta user records
+        :rtype: [dict]
+        """
+        if not group_filter:
+            return self._get_okta_api_pages('%s/users' % self.okta_url)
+        users = []
+        seen = set()
+        for group in self._get_okta_groups():
+            if group['profile']['name'] not in group_filter:
+                continue
+            self.lg.debug('Reading members of Okta group %s',
+                          group['profile']['name'])
+            for user in self._get_okta_api_pages(
+                    '%s/groups/%s/users' % (self.okta_url, group['id'])):
+                if user['id'] not in seen:
+                    seen.add(user['id'])
+                    users.append(user)
+        self.lg.debug('%d users found in filter groups', len(users))
+        return users
+
+    def _get_okta_groups(self):
+        """
+        Download the list of Okta groups (cached after the first call,
+        as it is needed both for user filtering and for `load_groups`).
+        :returns: list of Okta group records
+        :rtype: [dict]
+        """
+        if self.okta_groups is None:
+            self.okta_groups = self._get_okta_api_pages(
+                '%s/groups' % self.okta_url)
+        return self.okta_groups
+
     def load_groups(self):
-        okta_groups = [group['profile']['name'] for group in
-                       self._get_okta_api_pages('%s/groups' % self.okta_url)]
+        okta_groups = [group['profile']['name'] for group
+                       in self._get_okta_groups()]
         # only take groups that are both in Okta & IPA
         filtered_groups = list(set(okta_groups).intersection(self.ipa_groups))
         self.lg.debug('Groups loaded from Okta: %s', filtered_groups)
         self.lg.info('%d groups loaded from Okta', len(filtered_groups))
         return filtered_groups
 
-    def _get_okta_api_pages(self, url):
+    def _get_okta_api_pages(self, url, params=None):
         self.lg.debug('Getting Okta API response from %s', url)
-        resp = self.session.get(url)
+        resp = self.session.get(url, params=params)
         if not resp.ok:
             raise OktaError('Error reading Okta API: %s' % resp.text)
         results = resp.json()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - JSON-RPC client module
+
+An alternative backend for executing IPA commands: instead of the ipalib
+API (one request in flight at a time), commands are sent to the server's
+`/ipa/session/json` endpoint by a pool of worker threads sharing one
+HTTP session (session cookie & keep-alive connections are reused).
+The number of commands in flight is adapted by an `ExecutionGovernor`.
+"""
+
+import itertools
+import requests
+import threading
+from multiprocessing.pool import ThreadPool
+from operator import attrgetter
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+try:
+    from requests_kerberos import HTTPKerberosAuth, OPTIONAL
+except ImportError:  # only needed for Kerberos login
+    HTTPKerberosAuth = OPTIONAL = None
+
+from command import is_transient
+from core import FreeIPAManagerCore
+from errors import CommandError, ManagerError, RetryableCommandError
+from governor import ExecutionGovernor
+
+# HTTP statuses of servers refusing requests when overloaded/unavailable
+# (worth retrying; 502/504 are not, the request may have been processed)
+RETRYABLE_STATUSES = (429, 503)
+
+
+class IpaRpcClient(FreeIPAManagerCore):
+    """
+    JSON-RPC client of the FreeIPA API. Provides the `Command[name]`
+    interface of `ipalib.api`, so that `Command.execute` can use it
+    in place of the API object.
+    """
+    def __init__(self, settings, transport=None):
+        """
+        :param dict settings: parsed contents of the settings file
+        :param requests.adapters.BaseAdapter transport: transport adapter
+            to use for API requests instead of the default HTTP one
+        """
+        super(IpaRpcClient, self).__init__()
+        rpc_settings = settings['rpc']
+        self.url = rpc_settings['url'].rstrip('/')
+        self.workers = rpc_settings.get('workers', 4)
+        self.timeout = rpc_settings.get('timeout', 60)
+        self.user = rpc_settings.get('user')
+        self.password_path = rpc_settings.get('password_path')
+        self.Command = _RpcCommands(self)
+        self._login_lock = threading.Lock()
+        self._logins = 0  # number of logins (sessions obtained) so far
+        self._ids = itertools.count()
+        self._setup_session(rpc_settings.get('ca_cert', True), transport)
+        self.governor = ExecutionGovernor(settings, self.workers)
+
+    def _setup_session(self, verify, transport=None):
+        self.session = requests.Session()
+        self.session.verify = verify
+        # keep a connection per worker alive between requests
+        adapter = transport or requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Referer': '%s/ipa' % self.url
+        })
+
+    def login(self):
+        """
+        Log in to the API & obtain a session cookie (which is then
+        reused by all requests). Password login is used if `user` is set,
+        Kerberos login (using the default credential cache) otherwise.
+        :raises ManagerError: if login fails
+        """
+        if self.user:
+            try:
+                with open(self.password_path) as src:
+                    password = src.read().strip()
+            except (IOError, TypeError) as e:
+                raise ManagerError('Cannot read API password: %s' % e)
+            url = '%s/ipa/session/login_password' % self.url
+            kwargs = {'data': {'user': self.user, 'password': password}}
+        else:
+            if HTTPKerberosAuth is None:
+                raise ManagerError(
+                    'Kerberos login requires the requests-kerberos package')
+            url = '%s/ipa/session/login_kerberos' % self.url
+            kwargs = {'auth': HTTPKerberosAuth(mutual_authentication=OPTIONAL)}
+        self.lg.debug('Logging in to %s', url)
+        try:
+            response = self.session.post(url, **kwargs)
+        except requests.RequestException as e:
+            raise ManagerError('Error logging in to %s: %s' % (self.url, e))
+        if not response.ok:
+            raise ManagerError('Error logging in to %s: HTTP %d'
+                               % (self.url, response.status_code))
+        self._logins += 1
+
+    def _ensure_login(self, expired=0):
+        """
+        Log in unless there is a session already (newer than the expired
+        one, so that workers hitting an expired session only log in once).
+        :param int expired: number of logins when the session expired
+        """
+        with self._login_lock:
+            if self._logins <= expired:
+                self.login()
+
+    def call(self, method, **params):
+        """
+        Call an API method. The session is renewed (once) if it expired.
+        :param str method: name of the API command (e.g., user_add)
+        :param params: options of the command
+        :returns: result of the command (as returned by `ipalib.api`)
+        :rtype: dict
+        :raises CommandError: if the server responds with an error
+        :raises RetryableCommandError: in case of a transient error
+        """
+        self._ensure_login()
+        data = {'method': method, 'params': [[], params],
+                'id': next(self._ids)}
+        session = self._logins
+        response = self._post(data)
+        if response.status_code == 401:
+            self.lg.debug('API session expired, logging in again')
+            self._ensure_login(expired=session)
+            response = self._post(data)
+        if response.status_code in RETRYABLE_STATUSES:
+            raise RetryableCommandError('HTTP %d' % response.status_code)
+        if not response.ok:
+            raise CommandError('HTTP %d' % response.status_code)
+        try:
+            output = response.json()
+        except ValueError as e:
+            raise CommandError('Invalid API response: %s' % e)
+        if output.get('error'):
+            name = output['error'].get('name')
+            message = output['error'].get('message') or ''
+            error = RetryableCommandError if is_transient(
+                name, message) else CommandError
+            raise error('%s: %s' % (name, message))
+        return output['result']
+
+    def _post(self, data):
+        try:
+            return self.session.post('%s/ipa/session/json' % self.url,
+                                     json=data, timeout=self.timeout)
+        except requests.ConnectionError as e:
+            # retried only if the request provably was not sent, as the
+            # server may have applied a command whose response got lost
+            error = RetryableCommandError if _not_sent(e) else CommandError
+            raise error('Error communicating with API: %s' % e)
+        except requests.RequestException as e:
+            raise CommandError('Error communicating with API: %s' % e)
+
+    def execute(self, commands):
+        """
+        Execute commands in the order of their rank (additions first,
+        deletions last). Commands of the same rank are executed in parallel
+        by the worker threads, except that commands modifying the same entity
+        are executed one after another in the order of sorting. They are
+        executed in waves of (governor's) `concurrency` workers, each taking
+        `batch_size` entities; both are adapted after each wave.
+        :param [Command] commands: commands to execute
+        :returns: errors of failed commands
+        :rtype: [str]
+        :raises ManagerError: if login fails
+        """
+        self._ensure_login()
+        errs = []
+        pool = ThreadPool(self.workers)
+        try:
+            commands = sorted(commands, key=attrgetter('sort_key'))
+            for rank, rank_commands in itertools.groupby(
+                    commands, attrgetter('rank')):
+                batches = dict()
+                for command in rank_commands:
+                    key = (command.command.split('_', 1)[0],
+                           command.entity_name)
+                    batches.setdefault(key, []).append(command)
+                self.lg.debug('Executing %d rank %d commands',
+                              sum(len(i) for i in batches.itervalues()), rank)
+                queue = [batches[i] for i in sorted(batches)]
+                while queue:
+                    concurrency = self.governor.concurrency
+                    size = self.governor.batch_size
+                    wave = queue[:concurrency * size]
+                    queue = queue[concurrency * size:]
+                    for wave_errs in pool.map(
+                            self._execute_batches,
+                            [wave[i:i + size]
+                             for i in range(0, len(wave), size)]):
+                        errs.extend(wave_errs)
+                    self.governor.adjust()
+        finally:
+            pool.terminate()
+        self.governor.log_stats()
+        return errs
+
+    def _execute_batches(self, batches):
+        errs = []
+        for command in itertools.chain.from_iterable(batches):
+            try:
+                self.governor.execute(command, self)
+            except CommandError as e:
+                err = 'Error executing %s: %s' % (command.description, e)
+                self.lg.error(err)
+                errs.append(err)
+        return errs
+
+
+def _not_sent(error):
+    """
+    Check whether a connection error occured before sending the request
+    (connecting timed out or failed), not while waiting for the response.
+    :param requests.ConnectionError error: error to check
+    :rtype: bool
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0] if error.args else None, 'reason', None)
+    return isinstance(reason, NewConnectionError)
+
+
+class _RpcCommands(object):
+    """
+    Mapping of API command names to functions calling them.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def __getitem__(self, method):
+        def call(**params):
+            return self.client.call(method, **params)
+        return call
@@ -33,6 +33,23 @@ schema_settings = {
             'hbacsvc', 'hbacsvcgroup'): [str]
     },
     'nesting-limit': int,
+    'push-state-file': str,
+    'push-state-max-age': int,
+    'rpc': {
+        Required('url'): str,
+        'workers': int,
+        'ca_cert': str,
+        'user': str,
+        'password_path': str,
+        'timeout': Any(int, float)
+    },
+    'execution': {
+        'target_latency': Any(int, float),
+        'retries': int,
+        'backoff': Any(int, float),
+        'max_backoff': Any(int, float),
+        'max_batch_size': int
+    },
     'user-group-pattern': str,
     'okta': {
         'enabled': bool,
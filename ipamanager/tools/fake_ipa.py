@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - fake IPA tool
+
+A stateful in-memory stand-in of the FreeIPA API (`ipalib.api`), so that
+`IpaUploader` and `IpaDownloader` can be tested and benchmarked end-to-end
+locally, at any scale, without a FreeIPA server. It implements the
+commands used by the tool for all entity types (`*_find`, `*_show`,
+`*_add`, `*_mod`, `*_del`, `*_add_member`/`*_remove_member`, rule member
+& sudo rule option commands, `user_enable`/`user_disable`) as well as
+`batch`, with configurable per-call latency and failure injection.
+
+Entities are stored in the format returned by the API with `all=True`
+(lowercase attribute names, tuples of values) and memberships are kept
+consistent on both sides (`member_<type>` & `memberof_<type>`).
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from ipamanager.config_loader import ConfigLoader
+from ipamanager.integrity_checker import IntegrityChecker
+from ipamanager.ipa_connector import IpaDownloader, IpaUploader
+from ipamanager.tools.core import FreeIPAManagerToolCore
+from ipamanager.utils import ENTITY_CLASSES, load_settings, _type_verbosity
+
+# first timestamp of entity modifications (2020-01-01 00:00:00 UTC)
+EPOCH = 1577836800
+# rule commands (e.g., sudorule_add_user) -> attribute holding the members
+RULE_MEMBER_COMMANDS = {
+    'user': 'memberuser', 'host': 'memberhost', 'service': 'memberservice'}
+
+
+class NotFound(Exception):
+    pass
+
+
+class DuplicateEntry(Exception):
+    pass
+
+
+class EmptyModlist(Exception):
+    pass
+
+
+class AlreadyActive(Exception):
+    pass
+
+
+class AlreadyInactive(Exception):
+    pass
+
+
+class DatabaseError(Exception):
+    """Default injected failure (transient, see `command.is_transient`)."""
+
+
+class FakeIpa(object):
+    """
+    In-memory FreeIPA API stand-in providing the `Command[name]`
+    interface of `ipalib.api`.
+    :attr dict entities: entity type -> name -> entity data
+    :attr dict calls: number of calls by command name (for measurements)
+    """
+    def __init__(self, latency=0, failure_rate=0, failure=DatabaseError,
+                 seed=0):
+        """
+        :param float latency: seconds to wait before each call
+        :param float failure_rate: probability of a modifying call failing
+            (0-1); loading of entities (`*_find`/`*_show`) never fails
+        :param type failure: exception class raised by failing calls
+        :param int seed: random seed for reproducible failures
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure = failure
+        self.random = random.Random(seed)
+        self.entities = dict(
+            (cls.entity_name, dict()) for cls in ENTITY_CLASSES)
+        self.id_types = dict(
+            (cls.entity_name, cls.entity_id_type) for cls in ENTITY_CLASSES)
+        self.calls = dict()
+        self.Command = _FakeCommands(self)
+        self._clock = 0
+        self._gid = 10000
+
+    def call(self, method, **options):
+        """
+        Execute an API command.
+        :param str method: name of the command (e.g., group_add_member)
+        :param options: options of the command
+        :returns: command result in the format of `ipalib.api`
+        :rtype: dict
+        :raises KeyError: if the command does not exist
+        """
+        handler, entity_type = self._resolve(method)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if all([self.failure_rate, entity_type,
+                not method.endswith(('_find', '_show')),
+                self.random.random() < self.failure_rate]):
+            raise self.failure(
+                'Injected failure of %s: server is busy' % method)
+        if entity_type is None:
+            return handler(**options)
+        return handler(entity_type, **options)
+
+    def _resolve(self, method):
+        """
+        Find the handler of a command & the entity type it works with.
+        :returns: handler & entity type (None for `batch`)
+        :rtype: (function, str)
+        :raises KeyError: if the command does not exist
+        """
+        if method == 'batch':
+            return self._batch, None
+        for entity_type in sorted(self.entities, key=len, reverse=True):
+            if method.startswith('%s_' % entity_type):
+                operation = method[len(entity_type) + 1:]
+                break
+        else:
+            raise KeyError(method)
+        if operation in ('find', 'show', 'add', 'mod', 'del',
+                         'add_member', 'remove_member'):
+            return getattr(self, '_%s' % operation), entity_type
+        action, _, member = operation.partition('_')
+        if entity_type in ('hbacrule', 'sudorule') and action in (
+                'add', 'remove') and member in RULE_MEMBER_COMMANDS:
+            return (lambda entity_type, **options: self._rule_member(
+                entity_type, action, RULE_MEMBER_COMMANDS[member],
+                **options)), entity_type
+        if entity_type == 'sudorule' and operation in (
+                'add_option', 'remove_option'):
+            return (lambda entity_type, **options: self._sudo_option(
+                action, **options)), entity_type
+        if entity_type == 'user' and operation in ('enable', 'disable'):
+            return (lambda entity_type, **options: self._user_lock(
+                operation == 'disable', **options)), entity_type
+        raise KeyError(method)
+
+    def _get(self, entity_type, options):
+        name = options.pop(self.id_types[entity_type])
+        entity = self.entities[entity_type].get(name)
+        if entity is None:
+            raise NotFound('%s: %s not found' % (name, entity_type))
+        return name, entity
+
+    def _touch(self, entity):
+        self._clock += 1
+        entity['modifytimestamp'] = (unicode(time.strftime(
+            '%Y%m%d%H%M%SZ', time.gmtime(EPOCH + self._clock))),)
+
+    def _find(self, entity_type, all=False, sizelimit=0, pkey_only=False,
+              **criteria):
+        if criteria:  # not used by the tool, so not implemented
+            raise TypeError('Unsupported %s_find criteria: %s'
+                            % (entity_type, ', '.join(sorted(criteria))))
+        id_type = self.id_types[entity_type]
+        result = []
+        for name in sorted(self.entities[entity_type]):
+            entity = self.entities[entity_type][name]
+            if pkey_only:
+                result.append({id_type: entity[id_type]})
+            else:
+                result.append(dict(entity))
+        truncated = bool(sizelimit) and len(result) > sizelimit
+        if truncated:
+            result = result[:sizelimit]
+        return {'result': tuple(result), 'count': len(result),
+                'truncated': truncated,
+                'summary': u'%d %ss matched' % (len(result), entity_type)}
+
+    def _show(self, entity_type, all=False, **options):
+        name, entity = self._get(entity_type, options)
+        return {'result': dict(entity), 'value': name, 'summary': None}
+
+    def _add(self, entity_type, **options):
+        id_type = self.id_types[entity_type]
+        name = options.pop(id_type)
+        if name in self.entities[entity_type]:
+            raise DuplicateEntry('%s with name "%s" already exists'
+                                 % (entity_type, name))
+        entity = {id_type: (name,), 'objectclass': (u'top', u'ipaobject')}
+        if entity_type == 'group' and not options.pop('nonposix', False):
+            self._make_posix(entity)
+        self._modify(entity, options)
+        self._touch(entity)
+        self.entities[entity_type][name] = entity
+        return {'result': dict(entity), 'value': name,
+                'summary': u'Added %s "%s"' % (entity_type, name)}
+
+    def _mod(self, entity_type, **options):
+        name, entity = self._get(entity_type, options)
+        changed = False
+        if options.pop('posix', False):
+            changed = self._make_posix(entity)
+        if not self._modify(entity, options) and not changed:
+            raise EmptyModlist('no modifications to be performed')
+        self._touch(entity)
+        return {'result': dict(entity), 'value': name,
+                'summary': u'Modified %s "%s"' % (entity_type, name)}
+
+    def _make_posix(self, entity):
+        if u'posixgroup' in entity['objectclass']:
+            return False
+        entity['objectclass'] += (u'posixgroup',)
+        self._gid += 1
+        entity['gidnumber'] = (unicode(self._gid),)
+        return True
+
+    def _modify(self, entity, options):
+        """
+        Apply attribute changes to entity data. Empty values remove
+        the attribute; `setattr`/`addattr`/`delattr` take "attr=value"
+        items like in the API.
+        :returns: True if the data have changed
+        :rtype: bool
+        """
+        before = dict(entity)
+        for key, value in options.iteritems():
+            if key == 'all':
+                continue
+            elif key in ('setattr', 'addattr', 'delattr'):
+                for item in _values(value):
+                    attr, _, attr_value = item.partition('=')
+                    current = entity.get(attr, ())
+                    if key == 'setattr':
+                        new = (attr_value,) if attr_value else ()
+                    elif key == 'addattr':
+                        new = current + (attr_value,)
+                    else:
+                        new = tuple(i for i in current if i != attr_value)
+                    _set(entity, attr, new)
+            elif isinstance(value, bool):
+                entity[key] = value
+            else:
+                _set(entity, key, _values(value))
+        return entity != before
+
+    def _del(self, entity_type, **options):
+        name, entity = self._get(entity_type, options)
+        del self.entities[entity_type][name]
+        for other_type, other_entities in self.entities.iteritems():
+            for other in other_entities.itervalues():
+                for key in other.keys():
+                    if key.startswith('member') and key.endswith(
+                            '_%s' % entity_type) and name in other[key]:
+                        _set(other, key,
+                             tuple(i for i in other[key] if i != name))
+        return {'result': {'failed': ()}, 'value': (name,),
+                'summary': u'Deleted %s "%s"' % (entity_type, name)}
+
+    def _add_member(self, entity_type, **options):
+        return self._update_members(entity_type, True, **options)
+
+    def _remove_member(self, entity_type, **options):
+        return self._update_members(entity_type, False, **options)
+
+    def _update_members(self, entity_type, add, **options):
+        """
+        Add/remove members of a group-like entity, keeping the member's
+        `memberof_<type>` attribute in sync. Members that do not exist
+        or are (not) members already are reported as failed.
+        """
+        name, entity = self._get(entity_type, options)
+        options.pop('all', None)
+        failed = dict()
+        completed = 0
+        for member_type, members in options.iteritems():
+            failed[member_type] = []
+            key = 'member_%s' % member_type
+            for member in _values(members):
+                member_entity = self.entities.get(
+                    member_type, dict()).get(member)
+                is_member = member in entity.get(key, ())
+                if member_entity is None:
+                    failed[member_type].append((member, u'no such entry'))
+                elif add and is_member:
+                    failed[member_type].append(
+                        (member, u'This entry is already a member'))
+                elif not add and not is_member:
+                    failed[member_type].append(
+                        (member, u'This entry is not a member'))
+                else:
+                    _update(entity, key, member, add)
+                    _update(member_entity, 'memberof_%s' % entity_type,
+                            name, add)
+                    completed += 1
+        if completed:
+            self._touch(entity)
+        return {'result': dict(entity), 'completed': completed,
+                'failed': {'member': dict(
+                    (k, tuple(v)) for k, v in failed.iteritems())}}
+
+    def _rule_member(self, entity_type, action, attr, **options):
+        """
+        Add/remove rule members (users/groups, hosts/hostgroups
+        or HBAC services), stored as `<attr>_<member type>`.
+        """
+        name, entity = self._get(entity_type, options)
+        add = action == 'add'
+        failed = dict()
+        completed = 0
+        for member_type, members in options.iteritems():
+            failed[member_type] = []
+            key = '%s_%s' % (attr, member_type)
+            for member in _values(members):
+                if (member in entity.get(key, ())) == add:
+                    failed[member_type].append((member, (
+                        u'This entry is already a member' if add
+                        else u'This entry is not a member')))
+                elif member not in self.entities.get(member_type, dict()):
+                    failed[member_type].append((member, u'no such entry'))
+                else:
+                    _update(entity, key, member, add)
+                    completed += 1
+        if completed:
+            self._touch(entity)
+        return {'result': dict(entity), 'completed': completed,
+                'failed': {attr: dict(
+                    (k, tuple(v)) for k, v in failed.iteritems())}}
+
+    def _sudo_option(self, action, **options):
+        name, entity = self._get('sudorule', options)
+        for option in _values(options.get('ipasudoopt', ())):
+            present = option in entity.get('ipasudoopt', ())
+            if action == 'add' and present:
+                raise DuplicateEntry('sudo option %s already exists' % option)
+            if action == 'remove' and not present:
+                raise NotFound('sudo option %s not found' % option)
+            _update(entity, 'ipasudoopt', option, action == 'add')
+        self._touch(entity)
+        return {'result': dict(entity), 'value': name,
+                'summary': u'Modified sudo rule "%s"' % name}
+
+    def _user_lock(self, lock, **options):
+        name, entity = self._get('user', options)
+        if entity.get('nsaccountlock', False) == lock:
+            raise (AlreadyInactive if lock else AlreadyActive)(
+                'This entry is already %s' % (
+                    'disabled' if lock else 'enabled'))
+        entity['nsaccountlock'] = lock
+        self._touch(entity)
+        return {'result': True, 'value': name, 'summary': u'%s user account '
+                '"%s"' % ('Disabled' if lock else 'Enabled', name)}
+
+    def _batch(self, methods=(), **options):
+        """
+        Execute several commands in one call. Failures of individual
+        commands are reported in their results instead of being raised.
+        """
+        results = []
+        for item in methods:
+            args, command_options = item.get('params', [[], {}])
+            try:
+                result = self.call(item['method'], **command_options)
+                result['error'] = None
+            except Exception as e:
+                result = {'error': unicode(e),
+                          'error_name': type(e).__name__}
+            results.append(result)
+        return {'count': len(results), 'results': tuple(results)}
+
+
+class _FakeCommands(object):
+    """
+    Mapping of API command names to functions calling them.
+    """
+    def __init__(self, api):
+        self.api = api
+
+    def __getitem__(self, method):
+        self.api._resolve(method)  # KeyError for undefined commands
+
+        def call(**options):
+            return self.api.call(method, **options)
+        return call
+
+
+def _values(value):
+    """
+    Convert a command option value to a tuple of unicode values.
+    """
+    if isinstance(value, (tuple, list)):
+        return tuple(unicode(i) for i in value)
+    return (unicode(value),)
+
+
+def _set(entity, key, value):
+    if value:
+        entity[key] = value
+    else:
+        entity.pop(key, None)
+
+
+def _update(entity, key, value, add):
+    current = entity.get(key, ())
+    if add:
+        _set(entity, key, current + (value,))
+    else:
+        _set(entity, key, tuple(i for i in current if i != value))
+
+
+class FakeIpaTool(FreeIPAManagerToolCore):
+    """
+    Command-line wrapper benchmarking push & pull of a config
+    repository against an (initially empty) fake FreeIPA.
+    """
+    def __init__(self, args=None):
+        self.args = _parse_args(args)
+        super(FakeIpaTool, self).__init__(self.args.loglevel)
+
+    def run(self):
+        """
+        Push the config into the fake FreeIPA, push it again (nothing
+        should change) and pull it back (dry run), reporting the time
+        spent and number of API calls of each step.
+        """
+        settings = load_settings(self.args.settings) if (
+            self.args.settings) else dict()
+        parsed = ConfigLoader(self.args.config, settings).load()
+        IntegrityChecker(parsed, settings).check()
+        self.api = FakeIpa(self.args.latency, self.args.failure_rate)
+        errors = sys.modules[__name__]  # exceptions raised by the fake
+        for step in ('push', 'repeated push', 'pull'):
+            self.api.calls = dict()
+            start = time.time()
+            if step == 'pull':
+                IpaDownloader(
+                    settings, parsed, self.args.config, dry_run=True,
+                    pull_types=self.args.pull_types, ipa_api=self.api,
+                    api_errors=errors).pull()
+            else:
+                IpaUploader(
+                    settings, parsed, 100, force=True, enable_deletion=True,
+                    processes=self.args.processes, ipa_api=self.api,
+                    api_errors=errors).push()
+            self.lg.info('%s took %.2f s using %d API calls', step.capitalize(),
+                         time.time() - start, sum(self.api.calls.values()))
+
+
+def _parse_args(args=None):
+    parser = argparse.ArgumentParser(description='FreeIPA Manager fake IPA')
+    parser.add_argument('config', help='Config repository path')
+    parser.add_argument('-s', '--settings', help='Settings file')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        dest='loglevel', help='Verbose mode (-vv for debug)')
+    parser.add_argument('-l', '--latency', type=float, default=0,
+                        help='Latency of each API call (seconds)')
+    parser.add_argument('-f', '--failure-rate', type=float, default=0,
+                        help='Probability of a modifying call failing (0-1)')
+    parser.add_argument('-j', '--processes', type=int,
+                        help='Number of worker processes to plan the push in')
+    parser.add_argument('-p', '--pull-types', nargs='+', default=['user'],
+                        help='Types of entities to pull',
+                        choices=[cls.entity_name for cls in ENTITY_CLASSES])
+    args = parser.parse_args(args)
+    args.loglevel = _type_verbosity(args.loglevel)
+    return args
+
+
+def main():
+    FakeIpaTool().run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2021, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - Okta replay tool
+
+A requests transport adapter serving recorded or synthetic Okta API
+responses, so that `OktaLoader` can be tested and benchmarked locally
+without a live Okta tenant, plus a generator of directories of any size.
+
+A directory consists of three JSON files:
+- users.json: list of Okta user records,
+- groups.json: list of Okta group records,
+- memberships.json: mapping of group IDs to lists of member user IDs.
+"""
+
+import argparse
+import json
+import os
+import random
+import requests
+import time
+import urllib
+import urlparse
+
+from ipamanager.errors import ManagerError
+from ipamanager.okta_loader import OktaLoader
+from ipamanager.tools.core import FreeIPAManagerToolCore
+from ipamanager.utils import _type_verbosity
+
+
+class OktaDirectory(object):
+    """
+    In-memory Okta directory (users, groups & their memberships).
+    """
+    def __init__(self, users, groups, memberships):
+        """
+        :param [dict] users: Okta user records
+        :param [dict] groups: Okta group records
+        :param dict memberships: group ID -> list of member user IDs
+        """
+        self.users = users
+        self.groups = groups
+        self.users_by_id = dict((u['id'], u) for u in users)
+        self.groups_by_id = dict((g['id'], g) for g in groups)
+        self.group_members = memberships
+        self.user_groups = dict()
+        for group in groups:
+            for user_id in memberships.get(group['id'], []):
+                self.user_groups.setdefault(user_id, []).append(group)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a directory saved in the given folder.
+        :param str path: folder with users/groups/memberships JSON files
+        :rtype: OktaDirectory
+        """
+        data = []
+        for name in ('users', 'groups', 'memberships'):
+            try:
+                with open(os.path.join(path, '%s.json' % name)) as src:
+                    data.append(json.load(src))
+            except (IOError, ValueError) as e:
+                raise ManagerError('Cannot load Okta %s: %s' % (name, e))
+        return cls(*data)
+
+    def save(self, path):
+        """
+        Save the directory into the given folder.
+        :param str path: folder to write the JSON files into
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name, data in (('users', self.users), ('groups', self.groups),
+                           ('memberships', self.group_members)):
+            with open(os.path.join(path, '%s.json' % name), 'w') as target:
+                json.dump(data, target)
+
+
+def generate_directory(users, groups, memberships, seed=0):
+    """
+    Generate a synthetic Okta directory of the given size.
+    User statuses and managers are distributed like in a real tenant
+    (mostly active users, a few suspended & deprovisioned ones).
+    :param int users: number of users to generate
+    :param int groups: number of groups to generate
+    :param int memberships: number of groups per user
+    :param int seed: random seed for reproducible output
+    :rtype: OktaDirectory
+    """
+    rand = random.Random(seed)
+    statuses = ['ACTIVE'] * 18 + ['SUSPENDED', 'DEPROVISIONED']
+    user_list = []
+    for i in range(users):
+        profile = {
+            'login': 'user%d@example.com' % i,
+            'email': 'user%d@example.com' % i,
+            'firstName': 'First%d' % i,
+            'lastName': 'Last%d' % i,
+            'employeeNumber': str(i)
+        }
+        if i:
+            profile['managerId'] = str(rand.randrange(i))
+        user_list.append({'id': '00u%017d' % i,
+                          'status': rand.choice(statuses),
+                          'profile': profile})
+    group_list = [{'id': '00g%017d' % i,
+                   'profile': {'name': 'group%d' % i, 'description': None}}
+                  for i in range(groups)]
+    group_members = dict()
+    for user in user_list:
+        for group in rand.sample(group_list, min(memberships, groups)):
+            group_members.setdefault(group['id'], []).append(user['id'])
+    return OktaDirectory(user_list, group_list, group_members)
+
+
+class OktaReplayAdapter(requests.adapters.BaseAdapter):
+    """
+    Transport adapter answering Okta API requests from an `OktaDirectory`.
+    Supports the endpoints used by `OktaLoader` with `limit`/`after`
+    pagination, `Link` headers, rate-limit headers and injectable latency.
+    :attr [str] requests: paths of all requests served (for measurements)
+    """
+    def __init__(self, directory, page_size=200, latency=0,
+                 rate_limit=600, enforce_rate_limit=False):
+        """
+        :param OktaDirectory directory: directory to serve
+        :param int page_size: default number of records per page
+        :param float latency: seconds to wait before each response
+        :param int rate_limit: number of requests allowed per minute
+        :param bool enforce_rate_limit: return HTTP 429 when exceeded
+        """
+        super(OktaReplayAdapter, self).__init__()
+        self.directory = directory
+        self.page_size = page_size
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.enforce_rate_limit = enforce_rate_limit
+        self.requests = []
+        self._listings = dict()  # (path, search) -> records & ID positions
+        self._window_start = time.time()
+        self._window_count = 0
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse.urlparse(request.url)
+        self.requests.append(url.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        headers = self._rate_limit_headers()
+        if self.enforce_rate_limit and headers['X-Rate-Limit-Remaining'] < 0:
+            return self._response(request, 429, {
+                'errorCode': 'E0000047',
+                'errorSummary': 'API call exceeded rate limit'}, headers)
+        try:
+            items, positions = self._listing(url.path, query)
+        except KeyError as e:
+            return self._response(request, 404, {
+                'errorCode': 'E0000007',
+                'errorSummary': 'Not found: Resource not found: %s' % e},
+                headers)
+        page, next_after = self._paginate(items, positions, query)
+        if next_after:
+            query.update({'after': next_after})
+            next_url = urlparse.urlunparse(
+                url._replace(query=urllib.urlencode(sorted(query.items()))))
+            headers['Link'] = '<%s>; rel="next"' % next_url
+        return self._response(request, 200, page, headers)
+
+    def close(self):
+        pass
+
+    def _listing(self, path, query):
+        """
+        Get records served by the given API path & positions of their IDs
+        (computed once per listing, as the directory does not change).
+        :raises KeyError: if the path or the resource does not exist
+        """
+        key = (path, query.get('search'))
+        if key not in self._listings:
+            items = self._route(path, query)
+            self._listings[key] = (items, dict(
+                (item['id'], i) for i, item in enumerate(items)))
+        return self._listings[key]
+
+    def _route(self, path, query):
+        """
+        Find records served by the given API path.
+        :raises KeyError: if the path or the resource does not exist
+        """
+        parts = path.split('/api/v1/', 1)[-1].strip('/').split('/')
+        if parts == ['users']:
+            if 'search' in query:
+                return self._search_users(query['search'])
+            return self.directory.users
+        elif parts == ['groups']:
+            return self.directory.groups
+        elif len(parts) == 3 and parts[0] == 'users' and parts[2] == 'groups':
+            if parts[1] not in self.directory.users_by_id:
+                raise KeyError('user %s' % parts[1])
+            return self.directory.user_groups.get(parts[1], [])
+        elif len(parts) == 3 and parts[0] == 'groups' and parts[2] == 'users':
+            if parts[1] not in self.directory.groups_by_id:
+                raise KeyError('group %s' % parts[1])
+            return [self.directory.users_by_id[i] for i
+                    in self.directory.group_members.get(parts[1], [])]
+        raise KeyError(path)
+
+    def _search_users(self, expression):
+        """
+        Evaluate a simple `profile.<attr> eq "<value>"` search expression.
+        """
+        attr, operator, value = expression.split(' ', 2)
+        if not attr.startswith('profile.') or operator != 'eq':
+            raise KeyError('unsupported search %s' % expression)
+        attr = attr[len('profile.'):]
+        value = value[1:-1].replace('\\"', '"')
+        return [u for u in self.directory.users
+                if u['profile'].get(attr) == value]
+
+    def _paginate(self, items, positions, query):
+        limit = int(query.get('limit', self.page_size))
+        start = 0
+        if 'after' in query:
+            start = positions[query['after']] + 1
+        page = items[start:start + limit]
+        if start + limit < len(items):
+            return page, page[-1]['id']
+        return page, None
+
+    def _rate_limit_headers(self):
+        now = time.time()
+        if now - self._window_start >= 60:
+            self._window_start = now
+            self._window_count = 0
+        self._window_count += 1
+        return {
+            'X-Rate-Limit-Limit': self.rate_limit,
+            'X-Rate-Limit-Remaining': self.rate_limit - self._window_count,
+            'X-Rate-Limit-Reset': int(self._window_start + 60)
+        }
+
+    def _response(self, request, status, data, headers):
+        response = requests.Response()
+        response.status_code = status
+        response.request = request
+        response.url = request.url
+        response.encoding = 'utf-8'
+        response._content = json.dumps(data)
+        response.headers = requests.structures.CaseInsensitiveDict(
+            dict((k, str(v)) for k, v in headers.iteritems()))
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
+
+class OktaReplayTool(FreeIPAManagerToolCore):
+    """
+    Command-line wrapper for generating directories
+    and benchmarking `OktaLoader` against them.
+    """
+    def __init__(self, args=None):
+        self.args = _parse_args(args)
+        super(OktaReplayTool, self).__init__(self.args.loglevel)
+
+    def run(self):
+        if self.args.action == 'generate':
+            directory = generate_directory(
+                self.args.users, self.args.groups,
+                self.args.memberships, self.args.seed)
+            directory.save(self.args.path)
+            self.lg.info('Generated %d users & %d groups into %s',
+                         len(directory.users), len(directory.groups),
+                         self.args.path)
+        elif self.args.action == 'benchmark':
+            self.benchmark()
+
+    def benchmark(self):
+        """
+        Run `OktaLoader` against a saved directory and report
+        the number of requests and time spent.
+        """
+        directory = OktaDirectory.load(self.args.path)
+        adapter = OktaReplayAdapter(directory, self.args.page_size,
+                                    self.args.latency)
+        settings = {'okta': {
+            'auth': {'org': 'replay', 'token_path': os.devnull},
+            'attributes': ['firstName', 'lastName', 'email'],
+            'user_id_regex': '(.+)@example.com',
+            'user_group_filter': self.args.group_filter
+        }}
+        group_names = [g['profile']['name'] for g in directory.groups]
+        loader = OktaLoader(settings, group_names, transport=adapter)
+        start = time.time()
+        users = loader.load()
+        loader.load_groups()
+        self.lg.info('Loaded %d users in %.2f s using %d requests',
+                     len(users), time.time() - start, len(adapter.requests))
+
+
+def _parse_args(args=None):
+    parser = argparse.ArgumentParser(description='FreeIPA Manager Okta replay')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        dest='loglevel', help='Verbose mode (-vv for debug)')
+    actions = parser.add_subparsers(help='action to execute')
+
+    generate = actions.add_parser('generate')
+    generate.set_defaults(action='generate')
+    generate.add_argument('path', help='Directory to generate into')
+    generate.add_argument('-u', '--users', type=int, default=1000)
+    generate.add_argument('-g', '--groups', type=int, default=100)
+    generate.add_argument('-m', '--memberships', type=int, default=5,
+                          help='Number of groups per user')
+    generate.add_argument('--seed', type=int, default=0)
+
+    benchmark = actions.add_parser('benchmark')
+    benchmark.set_defaults(action='benchmark')
+    benchmark.add_argument('path', help='Directory to serve')
+    benchmark.add_argument('-f', '--group-filter', nargs='+', default=[],
+                           help='Okta user group filter')
+    benchmark.add_argument('-l', '--latency', type=float, default=0,
+                           help='Latency of each response (seconds)')
+    benchmark.add_argument('-p', '--page-size', type=int, default=200)
+
+    args = parser.parse_args(args)
+    args.loglevel = _type_verbosity(args.loglevel)
+    return args
+
+
+def main():
+    OktaReplayTool().run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - query delta
+
+Compute how transitive membership and effective HBAC/sudo rule access
+change between two revisions of the config repository (or a revision
+and the working tree), e.g. to review the impact of a pull request.
+
+Only entities touched by the change (those whose memberOf differs,
+plus their direct and nested members on either side) get their
+membership closure recomputed; the closure of all other entities
+is the same in both revisions.
+"""
+
+import json
+import logging
+import sys
+
+from ipamanager.tools.core import FreeIPAManagerToolCore
+from ipamanager.tools.query_tool import QueryTool, RULE_TYPES
+from ipamanager.utils import checkout_revision
+
+
+class QueryDelta(FreeIPAManagerToolCore):
+    """
+    Membership & access delta between two config repository revisions.
+    Entities are identified by (type, name) keys, as the entity instances
+    of the two revisions are distinct objects.
+    """
+    def __init__(self, config, old, new=None, settings=None,
+                 loglevel=logging.INFO):
+        """
+        :param str config: path to a freeipa-manager-config folder
+        :param str old: git revision to compare from
+        :param str new: git revision to compare to (working tree if None)
+        :param str settings: path to a settings file
+        :param int loglevel: logging level to use
+        """
+        super(QueryDelta, self).__init__(loglevel)
+        self.config = config
+        self.revisions = (old, new)
+        self.settings = settings
+        self.loglevel = loglevel
+
+    def load(self):
+        """
+        Load & check the config repository at both revisions.
+        The membership index is not built, as only its affected part
+        is computed by `compute`.
+        """
+        self.graphs = []
+        for revision in self.revisions:
+            self.lg.info('Loading revision %s', revision or 'working tree')
+            with checkout_revision(self.config, revision) as path:
+                querytool = QueryTool(path, self.settings, self.loglevel)
+                querytool.load(index=False)
+            self.graphs.append(_Graph(querytool.entities))
+
+    def compute(self):
+        """
+        Compute the membership & access delta between the revisions.
+        :returns: delta with `membership` (entity -> `added`/`removed`
+                  groups it is a direct or nested member of) and `access`
+                  (rule -> `users`/`hostgroups` -> `added`/`removed`) keys
+        :rtype: dict
+        """
+        old, new = self.graphs
+        changed = set(key for key in set(old.parents) | set(new.parents)
+                      if old.parents.get(key) != new.parents.get(key))
+        affected = old.descendants(changed) | new.descendants(changed)
+        self.lg.debug('Recomputing closure of %d of %d entities',
+                      len(affected), len(new.parents))
+        membership = dict()
+        rules = set(key for key in set(old.rules) | set(new.rules)
+                    if old.rules.get(key) != new.rules.get(key))
+        for key in affected:
+            old_ancestors = old.ancestors(key)
+            new_ancestors = new.ancestors(key)
+            diff = _diff(old_ancestors, new_ancestors)
+            if diff:
+                membership[_format(key)] = diff
+            for target in old_ancestors ^ new_ancestors:
+                rules.update(old.references.get(target, ()))
+                rules.update(new.references.get(target, ()))
+        access = dict()
+        for rule in rules:
+            diff = dict()
+            for attr, index in (('users', 0), ('hostgroups', 1)):
+                attr_diff = _diff(old.access(rule)[index],
+                                  new.access(rule)[index])
+                if attr_diff:
+                    diff[attr] = attr_diff
+            if diff:
+                access[_format(rule)] = diff
+        self.lg.info('Membership of %d entities and access of %d rules changed',
+                     len(membership), len(access))
+        return {'membership': membership, 'access': access}
+
+    def run(self, fmt='text', output=None):
+        """
+        Load both revisions and write the delta report.
+        :param str fmt: output format (text/json)
+        :param file output: file object to write the report to (stdout)
+        """
+        output = output or sys.stdout
+        self.load()
+        delta = self.compute()
+        if fmt == 'json':
+            output.write('%s\n' % json.dumps(delta, sort_keys=True))
+            return
+        for name, diff in sorted(delta['membership'].iteritems()):
+            _write_diff(output, name, diff)
+        for name, diff in sorted(delta['access'].iteritems()):
+            for attr in ('users', 'hostgroups'):
+                _write_diff(output, name, diff.get(attr, {}))
+
+
+class _Graph(object):
+    """
+    Membership graph of a single revision keyed by (type, name).
+    """
+    def __init__(self, entities):
+        self.parents = dict()
+        self.children = dict()
+        self.rules = dict()
+        self.references = dict()
+        self._ancestors = dict()
+        self._access = dict()
+        for entity_type, entity_dict in entities.iteritems():
+            for entity in entity_dict.itervalues():
+                key = (entity_type, entity.name)
+                memberof = entity.data_repo.get('memberOf', {})
+                parents = frozenset(
+                    (target_type, target_name)
+                    for target_type, target_list in memberof.iteritems()
+                    for target_name in target_list)
+                self.parents[key] = parents
+                for parent in parents:
+                    self.children.setdefault(parent, set()).add(key)
+        for rule_type in RULE_TYPES:
+            for rule in entities.get(rule_type, {}).itervalues():
+                key = (rule_type, rule.name)
+                self.rules[key] = (
+                    frozenset(('group', name) for name
+                              in rule.data_repo.get('memberUser', [])),
+                    frozenset(('hostgroup', name) for name
+                              in rule.data_repo.get('memberHost', [])))
+                for target in self.rules[key][0] | self.rules[key][1]:
+                    self.references.setdefault(target, set()).add(key)
+
+    def ancestors(self, key):
+        """
+        Get (and memoize) the keys of entities that `key` is a member of.
+        """
+        result = self._ancestors.get(key)
+        if result is None:
+            result = set()
+            for parent in self.parents.get(key, ()):
+                result.add(parent)
+                result.update(self.ancestors(parent))
+            self._ancestors[key] = result
+        return result
+
+    def descendants(self, keys):
+        """
+        Get the keys of `keys` and all their direct and nested members.
+        """
+        result = set(keys)
+        stack = list(keys)
+        while stack:
+            for child in self.children.get(stack.pop(), ()):
+                if child not in result:
+                    result.add(child)
+                    stack.append(child)
+        return result
+
+    def access(self, rule):
+        """
+        Get (and memoize) the users & hostgroups covered by a rule.
+        """
+        result = self._access.get(rule)
+        if result is None:
+            groups, hostgroups = self.rules.get(rule, ((), ()))
+            result = (
+                set(key for key in self.descendants(groups)
+                    if key[0] == 'user'),
+                set(key for key in self.descendants(hostgroups)
+                    if key[0] == 'hostgroup'))
+            self._access[rule] = result
+        return result
+
+
+def _format(key):
+    return '%s:%s' % key
+
+
+def _diff(old, new):
+    """
+    Compute the added & removed items between two sets of keys.
+    :returns: dictionary with non-empty `added`/`removed` lists
+    :rtype: dict
+    """
+    result = dict()
+    for attr, items in (('added', new - old), ('removed', old - new)):
+        if items:
+            result[attr] = sorted(_format(key) for key in items)
+    return result
+
+
+def _write_diff(output, name, diff):
+    for sign, attr in (('+', 'added'), ('-', 'removed')):
+        for item in diff.get(attr, []):
+            output.write('%s %s%s\n' % (name, sign, item))
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - query daemon
+
+A long-running server that loads the config repository once, keeps
+the query tool's membership index warm and answers queries over a local
+Unix socket. The protocol is line-delimited JSON: each request line
+is a query as accepted by `QueryTool.answer`, e.g.:
+    {"query": "member", "member": "user:user1", "entity": "group:group1"}
+and each response line is a JSON object with a `result` or `error` key.
+The repository is reloaded automatically when its git HEAD changes.
+"""
+
+import json
+import logging
+import os
+import sh
+import socket
+import SocketServer
+import threading
+import time
+
+from ipamanager.errors import ManagerError
+from ipamanager.tools.core import FreeIPAManagerToolCore
+from ipamanager.tools.query_tool import QueryTool
+
+
+class QueryServer(FreeIPAManagerToolCore):
+    """
+    Query daemon answering queries from a warm `QueryTool` instance.
+    """
+    def __init__(self, config, socket_path, settings=None,
+                 loglevel=logging.INFO, reload_interval=5):
+        """
+        :param str config: path to a freeipa-manager-config folder
+        :param str socket_path: path of the Unix socket to listen on
+        :param str settings: path to a settings file
+        :param int loglevel: logging level to use
+        :param float reload_interval: minimal number of seconds
+            between two checks of the repository's HEAD
+        """
+        super(QueryServer, self).__init__(loglevel)
+        self.config = config
+        self.settings = settings
+        self.loglevel = loglevel
+        self.socket_path = socket_path
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()  # guards the reload check state
+        self.reloading = False
+        self.querytool = None
+        self.revision = None
+        self.last_check = 0
+
+    def load(self):
+        """
+        (Re)load the repository into a new query tool instance, which then
+        replaces the previous one at once (queries answered meanwhile use
+        the previous one). The previous instance is kept if loading fails.
+        """
+        revision = self._current_revision()
+        self.lg.info('Loading config repository (revision %s)', revision)
+        querytool = QueryTool(self.config, self.settings, self.loglevel)
+        querytool.load()
+        # lazy indexes are built before the request threads share the tool
+        # (the paths & labels caches only memoize complete results, so
+        # concurrent queries filling them at worst repeat some work)
+        querytool.build_access()
+        self.querytool = querytool
+        self.revision = revision
+        self.last_check = time.time()
+
+    def _current_revision(self):
+        """
+        Get the current HEAD commit of the config repository.
+        :returns: commit hash (None if the config is not a git repository)
+        :rtype: str
+        """
+        try:
+            return str(sh.git('rev-parse', 'HEAD', _cwd=self.config)).strip()
+        except (sh.ErrorReturnCode, sh.CommandNotFound, OSError) as e:
+            self.lg.debug('Cannot read repository HEAD: %s', e)
+            return None
+
+    def _check_reload(self):
+        """
+        Reload the repository if its HEAD has changed since last load.
+        HEAD is checked at most once per `reload_interval` seconds
+        and by one thread at a time; the reload itself runs outside
+        of the lock, so other threads keep answering queries meanwhile.
+        """
+        with self.lock:
+            if self.reloading or (
+                    time.time() - self.last_check < self.reload_interval):
+                return
+            self.last_check = time.time()
+            self.reloading = True
+        try:
+            revision = self._current_revision()
+            if revision == self.revision:
+                return
+            self.lg.info('Repository HEAD changed (%s -> %s), reloading',
+                         self.revision, revision)
+            self.load()
+        except ManagerError as e:
+            self.lg.error('Reload failed, keeping previous config: %s', e)
+        finally:
+            self.reloading = False
+
+    def answer(self, line):
+        """
+        Answer a single request line of the protocol.
+        :param str line: JSON-encoded query
+        :returns: JSON-encoded response
+        :rtype: str
+        """
+        try:
+            query = json.loads(line)
+            if not isinstance(query, dict):
+                raise ValueError('query must be a JSON object')
+        except ValueError as e:
+            return json.dumps({'error': 'Invalid query: %s' % e})
+        self._check_reload()
+        try:
+            response = self.querytool.answer(query)
+        except Exception as e:  # e.g., a query field of a wrong type
+            self.lg.error('Error answering query %s: %s', query, e)
+            response = {'error': 'Error answering query: %s' % e}
+            if 'id' in query:
+                response['id'] = query['id']
+        return json.dumps(response)
+
+    def serve_forever(self):
+        """
+        Load the repository and serve queries until interrupted.
+        """
+        self.load()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = _UnixServer(self.socket_path, _QueryHandler)
+        self.server.query_server = self
+        self.lg.info('Serving queries on %s', self.socket_path)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.unlink(self.socket_path)
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+class _UnixServer(SocketServer.ThreadingMixIn,
+                  SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _QueryHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            response = self.server.query_server.answer(line)
+            self.wfile.write('%s\n' % response)
+            self.wfile.flush()
+
+
+class QueryClient(object):
+    """
+    Thin client of the query daemon.
+    """
+    def __init__(self, socket_path):
+        """
+        :param str socket_path: path of the daemon's Unix socket
+        """
+        self.socket_path = socket_path
+
+    def query_all(self, queries):
+        """
+        Send queries to the daemon over a single connection.
+        :param [dict] queries: queries to send
+        :returns: generator of responses (in the order of queries)
+        :rtype: generator
+        :raises ManagerError: if the daemon cannot be reached
+                              or closes the connection
+        """
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.socket_path)
+        except socket.error as e:
+            raise ManagerError('Cannot connect to query daemon at %s: %s'
+                               % (self.socket_path, e))
+        stream = conn.makefile('rw')
+        try:
+            for query in queries:
+                try:
+                    stream.write('%s\n' % json.dumps(query))
+                    stream.flush()
+                    response = stream.readline()
+                except socket.error as e:
+                    raise ManagerError('Query daemon connection failed: %s' % e)
+                if not response:
+                    raise ManagerError('Query daemon closed the connection')
+                yield json.loads(response)
+        finally:
+            stream.close()
+            conn.close()
+
+    def query(self, query):
+        """
+        Send a single query to the daemon.
+        :param dict query: query to send
+        :returns: response of the daemon
+        :rtype: dict
+        """
+        return next(self.query_all([query]))
@@ -13,8 +13,16 @@ A tool for querying entities for various purposes, like:
 
 import argparse
 import collections
+import csv
+import heapq
+import itertools
+import json
 import logging
+import mmap
+import multiprocessing
 import os
+import sys
+import tempfile
 
 from ipamanager.config_loader import ConfigLoader
 from ipamanager.errors import ManagerError
@@ -23,6 +31,13 @@ from ipamanager.utils import _args_common, find_entity
 from ipamanager.utils import load_settings, _type_verbosity
 from ipamanager.tools.core import FreeIPAManagerToolCore
 
+# modes of path construction for membership queries
+PATH_MODES = ('all', 'count', 'first', 'shortest')
+# rule types evaluated in the effective access matrix
+RULE_TYPES = ('hbacrule', 'sudorule')
+# query tool instance shared with label audit worker processes (via fork)
+_audit_tool = None
+
 
 class QueryTool(FreeIPAManagerToolCore):
     """
@@ -44,16 +59,23 @@ class QueryTool(FreeIPAManagerToolCore):
         self.graph = {}
         self.ancestors = {}
         self.paths = {}
+        self.closure = None
+        self.descendants = None
+        self.access = None
+        self.labels = None
 
-    def load(self):
+    def load(self, index=True):
         """
         Load and verify entity config to perform queries on.
         Uses the ConfigLoader and IntegrityChecker components.
+        :param bool index: whether to precompute the membership index
         """
         self.lg.info('Running pre-query config load & checks')
         self.entities = ConfigLoader(self.config, self.settings).load()
         self.checker = IntegrityChecker(self.entities, self.settings)
         self.checker.check()
+        if index:
+            self.build_index()
         self.lg.info('Pre-query config load & checks finished')
 
     def run(self, args):
@@ -62,9 +84,138 @@ class QueryTool(FreeIPAManagerToolCore):
         :param argparse.Namespace args: parsed args
         """
         if args.action == 'member':
-            self._query_membership(args.members, args.entities)
+            self._query_membership(
+                args.members, args.entities, getattr(args, 'paths', 'all'),
+                getattr(args, 'limit', None))
         elif args.action == 'labels':
             self._query_labels(args)
+        elif args.action == 'members':
+            self._query_members(args.entities, args.type)
+        elif args.action == 'access':
+            self._query_access(args)
+        elif args.action == 'export':
+            self.export_membership(args.output)
+        elif args.action == 'batch':
+            if args.input == '-':
+                self.batch(sys.stdin, args.format)
+            else:
+                with open(args.input) as source:
+                    self.batch(source, args.format)
+
+    def answer(self, query):
+        """
+        Answer a single query given as a dictionary. This is the format
+        used by the query daemon (line-delimited JSON protocol).
+        The query type is selected by the `query` key:
+        - member: `member` & `entity` (type:name), optional `paths` mode,
+        - groups: `user`,
+        - members: `entity` (type:name), optional member `type`,
+        - access: `user` or `hostgroup`,
+        - labels: `subaction` (as on CLI) & `label`/`group`/`user`.
+        :param dict query: query to answer
+        :returns: response with a `result` or an `error` key
+                  (and the query's `id`, if it was given)
+        :rtype: dict
+        """
+        response = dict()
+        if 'id' in query:
+            response['id'] = query['id']
+        handlers = {
+            'member': self._answer_member,
+            'groups': lambda q: sorted(self.list_groups(q['user'])),
+            'members': self._answer_members,
+            'access': self._answer_access,
+            'labels': self._answer_labels
+        }
+        try:
+            handler = handlers[query.get('query')]
+        except KeyError:
+            response['error'] = 'Unknown query %s' % query.get('query')
+            return response
+        try:
+            response['result'] = handler(query)
+        except KeyError as e:
+            response['error'] = 'Missing query field %s' % e
+        except (ManagerError, ValueError) as e:
+            response['error'] = str(e)
+        return response
+
+    def batch(self, source, fmt='json', output=None):
+        """
+        Answer many queries at once, streaming a JSON line per response.
+        The queries are either JSON lines (format of `answer`) or CSV rows
+        (see `_parse_csv_query`); CSV responses carry the row number as `id`.
+        :param file source: file object to read queries from
+        :param str fmt: format of the queries (json/csv)
+        :param file output: file object to write responses to (stdout)
+        :returns: number of answered queries
+        :rtype: int
+        """
+        output = output or sys.stdout
+        if fmt == 'csv':
+            rows = enumerate(csv.reader(source), 1)
+        else:
+            rows = enumerate(source, 1)
+        count = 0
+        for number, row in rows:
+            if not row or (fmt != 'csv' and not row.strip()):
+                continue
+            try:
+                if fmt == 'csv':
+                    query = _parse_csv_query(row)
+                    query['id'] = number
+                else:
+                    query = json.loads(row)
+                    if not isinstance(query, dict):
+                        raise ValueError('query must be a JSON object')
+            except ValueError as e:
+                response = {'error': 'Invalid query on line %d: %s'
+                            % (number, e)}
+            else:
+                response = self.answer(query)
+            output.write('%s\n' % json.dumps(response))
+            count += 1
+        self.lg.info('Answered %d queries', count)
+        return count
+
+    def _answer_member(self, query):
+        member, entity = self._resolve_entities(
+            [_entity_type(query['member']), _entity_type(query['entity'])])
+        mode = query.get('paths')
+        if not mode:
+            return self.is_member(member, entity)
+        if not self.is_member(member, entity):
+            return 0 if mode == 'count' else []
+        paths = self._construct_path(entity, member, mode, query.get('limit'))
+        if mode == 'count':
+            return paths
+        return [['%s:%s' % (e.entity_name, e.name) for e in path]
+                for path in paths]
+
+    def _answer_members(self, query):
+        entity = self._resolve_entities([_entity_type(query['entity'])])[0]
+        return ['%s:%s' % (e.entity_name, e.name)
+                for e in self.members(entity, query.get('type'))]
+
+    def _answer_access(self, query):
+        if 'user' in query:
+            return self.user_access(query['user'])
+        return self.hostgroup_access(query['hostgroup'])
+
+    def _answer_labels(self, query):
+        subaction = query['subaction']
+        if subaction == 'audit':
+            return self.audit_labels()
+        if subaction == 'check':
+            return self.check_label_necessary(query['label'], query['group'])
+        elif subaction == 'missing':
+            return sorted(self.list_user_missing_labels(query['user']))
+        elif subaction == 'necessary':
+            return self.list_necessary_labels(query['group'])
+        elif subaction == 'user':
+            return self.check_user_necessary_labels(
+                query['user'], query['group'])
+        raise ValueError('Unknown labels subaction %s' % subaction)
 
     def _resolve_entities(self, entity_list):
         """
@@ -83,6 +234,315 @@ class QueryTool(FreeIPAManagerToolCore):
             result.append(resolved)
         return result
 
+    def build_index(self):
+        """
+        Precompute the transitive closure of the memberOf relation.
+        Each entity that can be a membership target gets an integer ID
+        and every entity gets an ancestor bitset (a Python int with a bit
+        set for each entity it is a direct or nested member of), so that
+        membership checks are O(1) bit tests. Only membership targets
+        get IDs, keeping the bitsets as long as the number of groups
+        rather than the number of all entities.
+        """
+        self.parents = dict()
+        self.ids = dict()
+        self.index = []
+        for entity_type in sorted(self.entities):
+            for entity in self.entities[entity_type].itervalues():
+                parents = []
+                memberof = entity.data_repo.get('memberOf', {})
+                for target_type, target_list in sorted(memberof.iteritems()):
+                    for target_name in target_list:
+                        target = find_entity(
+                            self.entities, target_type, target_name)
+                        if not target:
+                            continue
+                        if target not in self.ids:
+                            self.ids[target] = len(self.index)
+                            self.index.append(target)
+                        parents.append(target)
+                self.parents[entity] = parents
+        self.closure = dict()
+        self.descendants = None
+        self.access = None
+        self.labels = dict()
+        for entity in self.parents:
+            self._closure(entity)
+        self.lg.debug('Membership index built for %d entities (%d targets)',
+                      len(self.closure), len(self.index))
+
+    def _closure(self, entity):
+        """
+        Get (and memoize) the ancestor bitset of an entity.
+        :param FreeIPAEntity entity: entity whose ancestors to compute
+        :returns: bitset of IDs of entities that `entity` is a member of
+        :rtype: int
+        """
+        bits = self.closure.get(entity)
+        if bits is None:
+            bits = 0
+            for parent in self.parents.get(entity, ()):
+                bits |= (1 << self.ids[parent]) | self._closure(parent)
+            self.closure[entity] = bits
+        return bits
+
+    def _entities_from_bits(self, bits):
+        """
+        Iterate over entities whose IDs are set in the given bitset.
+        :param int bits: bitset of entity IDs
+        :returns: generator of entities
+        :rtype: generator
+        """
+        while bits:
+            lowest = bits & -bits
+            yield self.index[lowest.bit_length() - 1]
+            bits ^= lowest
+
+    def is_member(self, member, entity):
+        """
+        Check if `member` is a (direct or nested) member of `entity`
+        using the precomputed membership index.
+        :param FreeIPAEntity member: member to evaluate
+        :param FreeIPAEntity entity: entity to evaluate
+        :rtype: bool
+        """
+        if self.closure is None:
+            self.build_index()
+        entity_id = self.ids.get(entity)
+        if entity_id is None:
+            return False
+        return bool(self._closure(member) >> entity_id & 1)
+
+    def build_descendants(self):
+        """
+        Precompute the descendants index, the inverse of the membership
+        closure: for each membership target, its direct and nested members
+        grouped by entity type (and sorted by name). The index is built
+        in a single pass over the closure bitsets on first use.
+        """
+        if self.closure is None:
+            self.build_index()
+        descendants = dict()
+        for entity, bits in self.closure.iteritems():
+            for target in self._entities_from_bits(bits):
+                descendants.setdefault(target, dict()).setdefault(
+                    entity.entity_name, []).append(entity)
+        for by_type in descendants.itervalues():
+            for entity_list in by_type.itervalues():
+                entity_list.sort(key=lambda e: e.name)
+        self.descendants = descendants
+        self.lg.debug('Descendants index built for %d targets',
+                      len(descendants))
+
+    def members(self, entity, entity_type=None):
+        """
+        List all direct and nested members of `entity`
+        using the precomputed descendants index.
+        :param FreeIPAEntity entity: entity whose members to list
+        :param str entity_type: type of members to list (all if None)
+        :returns: members sorted by type and name
+        :rtype: [FreeIPAEntity]
+        """
+        if self.descendants is None:
+            self.build_descendants()
+        by_type = self.descendants.get(entity, {})
+        if entity_type:
+            return list(by_type.get(entity_type, []))
+        return [member for member_type in sorted(by_type)
+                for member in by_type[member_type]]
+
+    def list_members(self, group, member_type='user'):
+        """
+        Find all direct and nested members of `group`.
+        This function serves as a wrapper for easy import into other scripts.
+        :param str group: name of the group whose members to list
+        :param str member_type: type of members to list (all if None)
+        :returns: generator of member names
+        :rtype: generator
+        """
+        group_entity = find_entity(self.entities, 'group', group)
+        if not group_entity:
+            raise ManagerError('Group %s does not exist in config' % group)
+        return (i.name for i in self.members(group_entity, member_type))
+
+    def _query_members(self, entity_names, member_type=None):
+        """
+        List members of each entity from `entity_names`.
+        :param [str] entity_names: entities to evaluate (type:name format)
+        :param str member_type: type of members to list (all if None)
+        """
+        for entity in self._resolve_entities(entity_names):
+            members = self.members(entity, member_type)
+            self.lg.info('%s has %d members: [%s]', entity, len(members),
+                         ', '.join(repr(e) for e in members))
+
+    def build_access(self):
+        """
+        Compute the effective access matrix of HBAC and sudo rules.
+        Each rule's memberUser groups are expanded to all their nested
+        member users and its memberHost hostgroups to themselves plus
+        their nested member hostgroups, using the descendants index.
+        The matrix is stored in `access` as rule -> (users, hostgroups),
+        along with inverted user -> rules and hostgroup -> rules indexes.
+        """
+        if self.descendants is None:
+            self.build_descendants()
+        # built aside & published at once, so that a concurrent query
+        # never sees a partially filled matrix
+        access, by_user, by_hostgroup = dict(), dict(), dict()
+        for rule_type in RULE_TYPES:
+            for rule in self.entities.get(rule_type, {}).itervalues():
+                users = set()
+                for name in rule.data_repo.get('memberUser', []):
+                    group = find_entity(self.entities, 'group', name)
+                    if group:
+                        users.update(self.members(group, 'user'))
+                hostgroups = set()
+                for name in rule.data_repo.get('memberHost', []):
+                    hostgroup = find_entity(self.entities, 'hostgroup', name)
+                    if hostgroup:
+                        hostgroups.add(hostgroup)
+                        hostgroups.update(self.members(hostgroup, 'hostgroup'))
+                access[rule] = (users, hostgroups)
+                for user in users:
+                    by_user.setdefault(user, []).append(rule)
+                for hostgroup in hostgroups:
+                    by_hostgroup.setdefault(hostgroup, []).append(rule)
+        # `access` is assigned last, as it marks the matrix as built
+        self.access_by_user = by_user
+        self.access_by_hostgroup = by_hostgroup
+        self.access = access
+        self.lg.debug('Access matrix built for %d rules', len(access))
+
+    def _access_result(self, rules, index):
+        """
+        Format access of the given rules as a rule type -> rule name ->
+        sorted names of entities (users or hostgroups) mapping.
+        """
+        result = dict()
+        for rule in rules:
+            entities = self.access[rule][index]
+            result.setdefault(rule.entity_name, dict())[rule.name] = sorted(
+                i.name for i in entities)
+        return result
+
+    def user_access(self, user):
+        """
+        Find the effective access of a user granted by HBAC & sudo rules.
+        :param str user: name of the user to check
+        :returns: rule type -> rule name -> hostgroups accessible by `user`
+        :rtype: dict
+        :raises ManagerError: if `user` is not defined in config
+        """
+        user_entity = find_entity(self.entities, 'user', user)
+        if not user_entity:
+            raise ManagerError('User %s does not exist in config' % user)
+        if self.access is None:
+            self.build_access()
+        return self._access_result(self.access_by_user.get(user_entity, []), 1)
+
+    def hostgroup_access(self, hostgroup):
+        """
+        Find users having access to a hostgroup via HBAC & sudo rules.
+        :param str hostgroup: name of the hostgroup to check
+        :returns: rule type -> rule name -> users with access to `hostgroup`
+        :rtype: dict
+        :raises ManagerError: if `hostgroup` is not defined in config
+        """
+        hostgroup_entity = find_entity(self.entities, 'hostgroup', hostgroup)
+        if not hostgroup_entity:
+            raise ManagerError(
+                'Hostgroup %s does not exist in config' % hostgroup)
+        if self.access is None:
+            self.build_access()
+        return self._access_result(
+            self.access_by_hostgroup.get(hostgroup_entity, []), 0)
+
+    def export_access(self, path):
+        """
+        Export the effective access matrix into a JSON file as
+        rule type -> rule name -> {users: [...], hostgroups: [...]}.
+        :param str path: path of the file to write
+        """
+        if self.access is None:
+            self.build_access()
+        result = dict((rule_type, dict()) for rule_type in RULE_TYPES)
+        for rule, (users, hostgroups) in self.access.iteritems():
+            result[rule.entity_name][rule.name] = {
+                'users': sorted(i.name for i in users),
+                'hostgroups': sorted(i.name for i in hostgroups)}
+        try:
+            with open(path, 'w') as target:
+                json.dump(result, target, indent=2, sort_keys=True)
+        except IOError as e:
+            raise ManagerError('Cannot export access matrix: %s' % e)
+        self.lg.info('Access matrix of %d rules exported to %s',
+                     len(self.access), path)
+
+    def _query_access(self, args):
+        """
+        Run an access query based on arguments (user, hostgroup or export).
+        """
+        if args.export:
+            self.export_access(args.export)
+            return
+        if args.user:
+            access = self.user_access(args.user)
+            template = 'User %s has %s %s access to hostgroups: [%s]'
+            name = args.user
+        else:
+            access = self.hostgroup_access(args.hostgroup)
+            template = 'Hostgroup %s has %s %s access for users: [%s]'
+            name = args.hostgroup
+        if not access:
+            self.lg.info('%s is covered by NO rules', name)
+        for rule_type, rules in sorted(access.iteritems()):
+            for rule, entities in sorted(rules.iteritems()):
+                self.lg.info(template, name, rule_type, rule,
+                             ', '.join(entities))
+
+    def export_membership(self, path):
+        """
+        Export the flattened effective membership into a file
+        of lines `<type>:<name><TAB><JSON list>`, where the list holds
+        the names of all groups a user is a (nested) member of for
+        `user:` lines and all (nested) members in type:name format
+        for lines of other (membership target) entities.
+        Lines are sorted bytewise, so the file can be searched without
+        Python or parsing the repository, e.g. via `LC_ALL=C look`,
+        or via the `lookup_membership` function.
+        The file is written atomically (via a temporary file & rename).
+        :param str path: path of the file to write
+        """
+        if self.descendants is None:
+            self.build_descendants()
+        lines = []
+        for user in self.entities.get('user', {}).itervalues():
+            groups = sorted(
+                i.name for i in self._entities_from_bits(self._closure(user))
+                if i.entity_name == 'group')
+            lines.append(_export_line(user, groups))
+        for entity in self.index:
+            members = ['%s:%s' % (i.entity_name, i.name)
+                       for i in self.members(entity)]
+            lines.append(_export_line(entity, members))
+        lines.sort()
+        directory = os.path.dirname(os.path.abspath(path))
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.export-')
+            with os.fdopen(fd, 'w') as target:
+                # mkstemp creates the file readable by the owner only
+                os.fchmod(target.fileno(), 0o666 & ~_umask())
+                target.writelines(lines)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise ManagerError('Cannot export membership: %s' % e)
+        self.lg.info('Membership of %d entities exported to %s',
+                     len(lines), path)
+
     def build_graph(self, member):
         """
         Find all entities of which `member` is a member.
@@ -92,10 +552,10 @@ class QueryTool(FreeIPAManagerToolCore):
         :returns: list of entities that `member` is a member of
         :rtype: [FreeIPAEntity]
         """
-        result = self.graph.get(member, set())
-        if result:
+        if member in self.graph:
             self.lg.debug('Membership for %s already calculated', member)
-            return result
+            return self.graph[member]
+        result = set()
         self.lg.debug('Calculating membership graph for %s', member)
         memberof = member.data_repo.get('memberOf', {})
         for entity_type, entity_list in memberof.iteritems():
@@ -111,64 +571,152 @@ class QueryTool(FreeIPAManagerToolCore):
         self.graph[member] = result
         return result
 
-    def check_membership(self, member, entity):
+    def check_membership(self, member, entity, mode='all', limit=None):
         """
         Check if `member` is a member of `entity`.
         :param FreeIPAEntity member: member to evaluate
         :param FreeIPAEntity entity: entity to evaluate
-        :returns: possible paths from member to entity (empty if not a member)
-        :rtype: [[FreeIPAEntity]]
+        :param str mode: which paths to find (see `PATH_MODES`)
+        :param int limit: number of paths to find in the `shortest` mode
+        :returns: possible paths from member to entity (empty if not
+                  a member), or the number of paths in the `count` mode
+        :rtype: [[FreeIPAEntity]] or int
         """
-        self.build_graph(member)
-        paths = self._construct_path(entity, member)
-        if paths:
+        if not self.is_member(member, entity):
+            self.lg.info('%s IS NOT a member of %s', member, entity)
+            return 0 if mode == 'count' else []
+        paths = self._construct_path(entity, member, mode, limit)
+        if mode == 'count':
+            self.lg.info('%s IS a member of %s; %d possible paths',
+                         member, entity, paths)
+        else:
             self.lg.info(
                 '%s IS a member of %s; possible paths: [%s]',
                 member, entity, '; '.join(' -> '.join(
                     repr(e) for e in path) for path in paths))
-        else:
-            self.lg.info('%s IS NOT a member of %s', member, entity)
         return paths
 
-    def _query_membership(self, members, entity_names):
+    def _query_membership(self, members, entity_names, mode='all',
+                          limit=None):
         """
         Check membership of each entity from `members`
         in each entity from `entity_names`.
         :param [str] members: members to evaluate (type:name format)
         :param [str] entity_names: entities to evaluate (type:name format)
+        :param str mode: which paths to find (see `PATH_MODES`)
+        :param int limit: number of paths to find in the `shortest` mode
         """
         member_entities = self._resolve_entities(members)
         entity_list = self._resolve_entities(entity_names)
         for member in member_entities:
             for entity in entity_list:
-                self.check_membership(member, entity)
+                self.check_membership(member, entity, mode, limit)
 
-    def _construct_path(self, entity, member):
+    def _construct_path(self, entity, member, mode='all', limit=None):
         """
-        Find all paths leading from `member` to `entity`.
-        The paths are constructed backwards, based on the `ancestor`
-        mapping constructed in the `build_graph` method.
-        :param FreeIPAEntity entity: entity to search from
-        :param FreeIPAEntity member: member to search towards
-        :returns: list of paths from `member` to `entity` ([] if no path found)
-        :rtype: [[FreeIPAEntity]]
+        Find paths leading from `member` to `entity`.
+        The search walks the memberOf relation upwards from `member`
+        and only enters entities that `entity` can be reached from
+        (checked via the membership index), so no dead ends are explored
+        and only the requested result is materialised:
+        - all: all paths (may be exponential for diamond-shaped hierarchies),
+        - count: number of paths, counted via DP over the membership DAG,
+        - shortest: `limit` shortest paths (best-first search),
+        - first: a single shortest path.
+        :param FreeIPAEntity entity: entity to search towards
+        :param FreeIPAEntity member: member to search from
+        :param str mode: which paths to find (see `PATH_MODES`)
+        :param int limit: number of paths to find in the `shortest` mode
+        :returns: list of paths from `member` to `entity` ([] if no path
+                  found), or the number of paths in the `count` mode
+        :rtype: [[FreeIPAEntity]] or int
         """
-        if (member, entity) in self.paths:
+        if mode not in PATH_MODES:
+            raise ManagerError('Unknown path mode %s' % mode)
+        # the limit only matters in the shortest mode (first == shortest 1)
+        if mode == 'first':
+            mode, limit = 'shortest', 1
+        elif mode == 'shortest':
+            limit = limit or 1
+        else:
+            limit = None
+        key = (member, entity, mode, limit)
+        if key in self.paths:
             self.lg.debug('Using cached paths for %s -> %s', member, entity)
-            return self.paths[(member, entity)]
+            return self.paths[key]
+        if mode == 'all':
+            result = self._all_paths(entity, member)
+        elif mode == 'count':
+            result = self._count_paths(entity, member, dict())
+        else:
+            result = self._shortest_paths(entity, member, limit)
+        self.paths[key] = result
+        self.lg.debug('Found %d paths %s -> %s',
+                      result if mode == 'count' else len(result),
+                      member, entity)
+        return result
+
+    def _next_hops(self, current, entity):
+        """
+        List parents of `current` through which `entity` can be reached.
+        """
+        return [parent for parent in self.parents.get(current, ())
+                if parent == entity or self.is_member(parent, entity)]
+
+    def _all_paths(self, entity, member):
         paths = []
-        queue = collections.deque([[entity]])
+        queue = collections.deque([[member]])
         while queue:
             current = queue.popleft()
-            preds = self.ancestors.get(current[0], [])
-            for pred in preds:
-                new_path = [pred] + current
-                if pred == member:
-                    paths.append(new_path)
+            for parent in self._next_hops(current[-1], entity):
+                if parent == entity:
+                    paths.append(current + [parent])
                 else:
-                    queue.append(new_path)
-        self.paths[(member, entity)] = paths
-        self.lg.debug('Found %d paths %s -> %s', len(paths), member, entity)
+                    queue.append(current + [parent])
+        return paths
+
+    def _count_paths(self, entity, current, memo):
+        if current == entity:
+            return 1
+        if current not in memo:
+            memo[current] = sum(self._count_paths(entity, parent, memo)
+                                for parent in self._next_hops(current, entity))
+        return memo[current]
+
+    def _distance(self, entity, current, memo):
+        """
+        Length of the shortest path from `current` to `entity`.
+        """
+        if current == entity:
+            return 0
+        if current not in memo:
+            memo[current] = 1 + min(
+                self._distance(entity, parent, memo)
+                for parent in self._next_hops(current, entity))
+        return memo[current]
+
+    def _shortest_paths(self, entity, member, limit):
+        """
+        Find the `limit` shortest paths via best-first search guided
+        by exact distances to `entity`, so that paths are completed
+        in order of their length and nothing else is enumerated
+        (ties are broken in favour of longer partial paths, so that
+        equally long alternatives are not expanded breadth-first).
+        """
+        memo = dict()
+        paths = []
+        counter = itertools.count()
+        heap = [(self._distance(entity, member, memo), -1, next(counter),
+                 [member])]
+        while heap and len(paths) < limit:
+            current = heapq.heappop(heap)[-1]
+            if current[-1] == entity:
+                paths.append(current)
+                continue
+            for parent in self._next_hops(current[-1], entity):
+                estimate = len(current) + self._distance(entity, parent, memo)
+                heapq.heappush(heap, (estimate, -len(current) - 1,
+                                      next(counter), current + [parent]))
         return paths
 
     def check_user_membership(self, user, group):
@@ -186,7 +734,7 @@ class QueryTool(FreeIPAManagerToolCore):
         group_entity = find_entity(self.entities, 'group', group)
         if not group_entity:
             raise ManagerError('Group %s does not exist in config' % group)
-        return bool(self.check_membership(user_entity, group_entity))
+        return self.is_member(user_entity, group_entity)
 
     def list_groups(self, user):
         """
@@ -199,7 +747,9 @@ class QueryTool(FreeIPAManagerToolCore):
         user_entity = find_entity(self.entities, 'user', user)
         if not user_entity:
             raise ManagerError('User %s does not exist in config' % user)
-        groups = self.build_graph(user_entity)
+        if self.closure is None:
+            self.build_index()
+        groups = self._entities_from_bits(self._closure(user_entity))
         return (i.name for i in groups)
 
     def _query_labels(self, args):
@@ -210,7 +760,8 @@ class QueryTool(FreeIPAManagerToolCore):
             'check': lambda a: self.check_label_necessary(a.label, a.group),
             'missing': lambda a: self.list_user_missing_labels(a.user),
             'necessary': lambda a: self.list_necessary_labels(a.group),
-            'user': lambda a: self.check_user_necessary_labels(a.user, a.group)
+            'user': lambda a: self.check_user_necessary_labels(a.user, a.group),
+            'audit': lambda a: self.audit_labels(a.processes)
         }
         subactions[args.subaction](args)
 
@@ -233,13 +784,99 @@ class QueryTool(FreeIPAManagerToolCore):
         :returns: list of labels defined for nested groups (and entity itself)
         :rtype: [str]
         """
+        if self.closure is None:
+            self.build_index()
         labels = []
-        for group in self.build_graph(entity):
+        for group in self._entities_from_bits(self._closure(entity)):
             labels.extend(self._get_labels(group))
         if include_self:
             labels.extend(self._get_labels(entity))
         return labels
 
+    def _required_labels(self, entity):
+        """
+        Get (and memoize in the `labels` index) the labels required
+        for membership in `entity`: its own labels plus the labels
+        required by all entities it is a (nested) member of.
+        The index is filled bottom-up over the membership DAG, so the
+        labels of each group are computed only once.
+        :param FreeIPAEntity entity: entity whose required labels to get
+        :rtype: frozenset
+        """
+        labels = self.labels.get(entity)
+        if labels is None:
+            labels = frozenset(self._get_labels(entity)).union(
+                self._inherited_labels(entity))
+            self.labels[entity] = labels
+        return labels
+
+    def _inherited_labels(self, entity):
+        """
+        Get labels required by the entities that `entity` is a member of.
+        :param FreeIPAEntity entity: entity whose inherited labels to get
+        :rtype: set
+        """
+        labels = set()
+        for parent in self.parents.get(entity, ()):
+            labels.update(self._required_labels(parent))
+        return labels
+
+    def _missing_labels(self, user):
+        """
+        Get labels that a user entity lacks for its group membership.
+        :param FreeIPAEntity user: user entity to check
+        :rtype: set
+        """
+        return self._inherited_labels(user).difference(self._get_labels(user))
+
+    def audit_labels(self, processes=None):
+        """
+        Find the missing labels of all users in a single pass
+        over the label index. For very large user sets, the users
+        can be sharded among a pool of worker processes.
+        :param int processes: number of worker processes (no pool if None)
+        :returns: user name -> sorted missing labels (users missing some)
+        :rtype: dict
+        """
+        global _audit_tool
+        if self.closure is None:
+            self.build_index()
+        # precompute the label index once, before forking the workers
+        for entity in self.index:
+            self._required_labels(entity)
+        users = sorted(self.entities.get('user', {}))
+        if processes and processes > 1:
+            shards = [users[i::processes] for i in range(processes)]
+            _audit_tool = self
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_audit_users, shards)
+            finally:
+                pool.terminate()
+                _audit_tool = None
+            missing = dict(itertools.chain.from_iterable(results))
+        else:
+            missing = dict(self._audit_users(users))
+        for user, labels in sorted(missing.iteritems()):
+            self.lg.info('User %s misses labels: {%s}',
+                         user, ', '.join(labels))
+        self.lg.info('%d of %d users miss labels', len(missing), len(users))
+        return missing
+
+    def _audit_users(self, users):
+        """
+        Find the missing labels of the given users.
+        :param [str] users: names of users to check
+        :returns: (user name, sorted missing labels) of users missing some
+        :rtype: [(str, [str])]
+        """
+        result = []
+        for name in users:
+            missing = self._missing_labels(self.entities['user'][name])
+            if missing:
+                result.append((name, sorted(missing)))
+        return result
+
     def check_label_necessary(self, label, group):
         """
         Check if `label` is necessary for membership in `group`.
@@ -272,7 +909,7 @@ class QueryTool(FreeIPAManagerToolCore):
         user_entity = find_entity(self.entities, 'user', user)
         if not user_entity:
             raise ManagerError('User %s does not exist in config' % user)
-        necessary = set(self.list_necessary_labels(user_entity))
+        necessary = set(self._list_necessary_labels(user_entity))
         current = set(self._get_labels(user_entity))
         missing = necessary.difference(current)
         if missing:
@@ -356,8 +993,38 @@ def _parse_args(args=None):
     member.add_argument(
         '-e', '--entities', nargs='+', type=_entity_type, default=[],
         required=True, help='entities whose members to check (type:name)')
+    member.add_argument(
+        '-P', '--paths', choices=PATH_MODES, default='all',
+        help='membership paths to find (default: all)')
+    member.add_argument(
+        '-k', '--limit', type=int, default=3,
+        help='number of paths to find with --paths shortest (default: 3)')
     member.set_defaults(action='member')
 
+    members = actions.add_parser('members', parents=[common])
+    members.add_argument(
+        '-e', '--entities', nargs='+', type=_entity_type, default=[],
+        required=True, help='entities whose members to list (type:name)')
+    members.add_argument(
+        '-t', '--type', help='type of members to list (default: all)')
+    members.set_defaults(action='members')
+
+    access = actions.add_parser('access', parents=[common])
+    access.set_defaults(action='access')
+    access_target = access.add_mutually_exclusive_group(required=True)
+    access_target.add_argument(
+        '-u', '--user', help='list rules & hostgroups accessible by user')
+    access_target.add_argument(
+        '-H', '--hostgroup', help='list rules & users with hostgroup access')
+    access_target.add_argument(
+        '-x', '--export', metavar='PATH',
+        help='export the whole access matrix as JSON')
+
+    export = actions.add_parser('export', parents=[common])
+    export.set_defaults(action='export')
+    export.add_argument('-o', '--output', required=True,
+                        help='path of the file to export membership into')
+
     labels = actions.add_parser('labels')
     labels.set_defaults(action='labels')
     labels_actions = labels.add_subparsers(help='labels query action')
@@ -380,11 +1047,150 @@ def _parse_args(args=None):
     labels_user.add_argument('user', help='user name')
     labels_user.add_argument('group', help='group name')
 
+    labels_audit = labels_actions.add_parser('audit', parents=[common])
+    labels_audit.set_defaults(subaction='audit')
+    labels_audit.add_argument(
+        '-j', '--processes', type=int,
+        help='number of worker processes to shard users among')
+
+    batch = actions.add_parser('batch', parents=[common])
+    batch.set_defaults(action='batch')
+    batch.add_argument('-i', '--input', default='-',
+                       help='file with queries (default: stdin)')
+    batch.add_argument('-f', '--format', choices=('json', 'csv'),
+                       default='json', help='format of queries')
+
+    delta = actions.add_parser('delta', parents=[common])
+    delta.set_defaults(action='delta')
+    delta.add_argument('-o', '--old', required=True,
+                       help='git revision to compare from')
+    delta.add_argument('-n', '--new',
+                       help='git revision to compare to (default: work tree)')
+    delta.add_argument('-f', '--format', choices=('text', 'json'),
+                       default='text', help='format of the report')
+
+    serve = actions.add_parser('serve', parents=[common])
+    serve.set_defaults(action='serve')
+    serve.add_argument('-S', '--socket', required=True,
+                       help='Unix socket path to listen on')
+    serve.add_argument('-r', '--reload-interval', type=float, default=5,
+                       help='seconds between repository HEAD checks')
+
+    client = actions.add_parser('client')
+    client.set_defaults(action='client')
+    client.add_argument('-S', '--socket', required=True,
+                        help='Unix socket path of the query daemon')
+    client.add_argument('queries', nargs='*',
+                        help='JSON queries (read from stdin if not given)')
+    client.add_argument('-v', '--verbose', action='count', default=0,
+                        dest='loglevel', help='Verbose mode (-vv for debug)')
+
     args = parser.parse_args(args)
     args.loglevel = _type_verbosity(args.loglevel)
     return args
 
 
+def lookup_membership(path, key):
+    """
+    Look up an entity in a file written by `QueryTool.export_membership`.
+    The file is memory-mapped and binary-searched, so a lookup costs
+    O(log n) line reads regardless of the file size.
+    :param str path: path of the exported file
+    :param str key: entity to look up in type:name format
+    :returns: the entity's effective membership (None if not exported)
+    :rtype: [str]
+    """
+    prefix = '%s\t' % key.encode('utf-8')
+    with open(path, 'rb') as src:
+        if not os.fstat(src.fileno()).st_size:
+            return None
+        data = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            low, high = 0, len(data)
+            while low < high:  # find the first line not less than prefix
+                middle = (low + high) // 2
+                start = data.rfind('\n', 0, middle) + 1
+                end = data.find('\n', start)
+                if data[start:end + 1] < prefix:
+                    low = end + 1
+                else:
+                    high = start
+            end = data.find('\n', low)
+            line = data[low:end]
+        finally:
+            data.close()
+    if not line.startswith(prefix):
+        return None
+    return json.loads(line[len(prefix):])
+
+
+def _export_line(entity, values):
+    return '%s:%s\t%s\n' % (
+        entity.entity_name, entity.name.encode('utf-8'),
+        json.dumps(values, separators=(',', ':')))
+
+
+def _umask():
+    """
+    Get the process umask (which can only be read by setting it).
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def _audit_users(users):
+    """
+    Worker function of the label audit process pool.
+    Uses the query tool instance inherited from the parent process.
+    """
+    return _audit_tool._audit_users(users)
+
+
+def _parse_csv_query(row):
+    """
+    Convert a CSV row into a query dictionary (see `QueryTool.answer`).
+    Supported rows:
+    - member,<type:name>,<type:name>[,<paths mode>]
+    - groups,<user>
+    - members,<type:name>[,<member type>]
+    - access,user,<user> / access,hostgroup,<hostgroup>
+    - labels,check,<label>,<group> / labels,missing,<user>
+    - labels,necessary,<group> / labels,user,<user>,<group>
+    - labels,audit
+    :param [str] row: parsed CSV row
+    :returns: query dictionary
+    :rtype: dict
+    :raises ValueError: if the row does not match any query
+    """
+    fields = {
+        ('member',): ('member', 'entity', 'paths'),
+        ('groups',): ('user',),
+        ('members',): ('entity', 'type'),
+        ('access', 'user'): ('user',),
+        ('access', 'hostgroup'): ('hostgroup',),
+        ('labels', 'check'): ('label', 'group'),
+        ('labels', 'missing'): ('user',),
+        ('labels', 'necessary'): ('group',),
+        ('labels', 'user'): ('user', 'group'),
+        ('labels', 'audit'): ()
+    }
+    row = [i.strip() for i in row]
+    for prefix, names in fields.iteritems():
+        if tuple(row[:len(prefix)]) == prefix:
+            values = row[len(prefix):]
+            optional = prefix in (('member',), ('members',))
+            if not len(names) - optional <= len(values) <= len(names):
+                raise ValueError('wrong number of fields for %s query'
+                                 % ' '.join(prefix))
+            query = dict(zip(names, values))
+            query['query'] = prefix[0]
+            if len(prefix) > 1:
+                query['subaction'] = prefix[1]
+            return query
+    raise ValueError('unknown query %s' % ','.join(row))
+
+
 def _entity_type(value):
     """
     Type function used for parsing --members/--entities arguments
@@ -394,11 +1200,43 @@ def _entity_type(value):
     return entity_type, entity_name
 
 
+def _run_client(args):
+    """
+    Send queries from arguments (or stdin) to the query daemon
+    and print its responses as JSON lines.
+    :param argparse.Namespace args: parsed args
+    """
+    from ipamanager.tools.query_server import QueryClient
+    queries = []
+    for line in args.queries or sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            queries.append(json.loads(line))
+        except ValueError as e:
+            raise ManagerError('Invalid query %s: %s' % (line.strip(), e))
+    for response in QueryClient(args.socket).query_all(queries):
+        sys.stdout.write('%s\n' % json.dumps(response))
+
+
 def main():
     """
     Main executable function used when run as a command-line script.
     """
     args = _parse_args()
+    if args.action == 'serve':
+        from ipamanager.tools.query_server import QueryServer
+        QueryServer(args.config, args.socket, args.settings, args.loglevel,
+                    args.reload_interval).serve_forever()
+        return
+    elif args.action == 'client':
+        _run_client(args)
+        return
+    elif args.action == 'delta':
+        from ipamanager.tools.query_delta import QueryDelta
+        QueryDelta(args.config, args.old, args.new, args.settings,
+                   args.loglevel).run(args.format)
+        return
     querytool = QueryTool(args.config, args.settings, args.loglevel)
     querytool.load()
     querytool.run(args)
@@ -10,16 +10,23 @@ Various utility functions for better code readability & organization.
 
 import argcomplete
 import argparse
+import contextlib
 import logging
 import logging.handlers
 import os
 import re
+import sh
+import shutil
 import socket
+import StringIO
 import sys
+import tarfile
+import tempfile
 import voluptuous
 import yaml
 
 import entities
+from errors import ManagerError
 from schemas import schema_settings
 
 
@@ -152,6 +159,28 @@ def parse_args():
                       help='Actually make changes (no dry run)')
     push.add_argument('-t', '--threshold', type=_type_threshold,
                       metavar='(%)', help='Change threshold', default=10)
+    targeted = push.add_mutually_exclusive_group()
+    targeted.add_argument(
+        '-c', '--changed', nargs='+', metavar='PATH',
+        help='Only push entities from changed config files '
+             '(paths relative to config repository)')
+    targeted.add_argument(
+        '-g', '--git-range', metavar='A..B',
+        help='Only push entities from config files changed in git range '
+             '(A..B, or A...B for changes since the merge base of A & B)')
+    push.add_argument('-j', '--processes', type=int,
+                      help='Number of worker processes to plan the push in')
+
+    plan = actions.add_parser('plan', parents=[common])
+    plan.set_defaults(action='plan')
+    plan.add_argument('-o', '--old', required=True, metavar='REVISION',
+                      help='Git revision FreeIPA is at')
+    plan.add_argument('-n', '--new', metavar='REVISION',
+                      help='Git revision to push (default: working tree)')
+    plan.add_argument('-d', '--deletion', action='store_true',
+                      help='Enable deletion of entities')
+    plan.add_argument('-j', '--processes', type=int,
+                      help='Number of worker processes to plan the push in')
 
     pull = actions.add_parser('pull', parents=[common])
     pull.set_defaults(action='pull')
@@ -246,3 +275,154 @@ def find_entity(entity_dict, entity_type, name):
     :param str name: entity name to search for
     """
     return entity_dict.get(entity_type, {}).get(name)
+
+
+@contextlib.contextmanager
+def checkout_revision(path, revision=None):
+    """
+    Provide the contents of a folder in a git repository at a given revision.
+    The folder's tree is extracted (via `git archive`) into a temporary
+    directory that is removed when the context is left. The folder itself
+    (i.e., the working tree) is provided if no revision is given.
+    :param str path: path to a folder inside a git repository
+    :param str revision: git revision (commit, branch, tag...) to check out
+    :returns: context manager providing the path to the checked-out folder
+    :raises ManagerError: if the revision cannot be checked out
+    """
+    if not revision:
+        yield path
+        return
+    tmpdir = tempfile.mkdtemp(prefix='ipamanager-')
+    try:
+        try:
+            toplevel, prefix = str(sh.git(
+                'rev-parse', '--show-toplevel', '--show-prefix',
+                _cwd=path)).split('\n')[:2]
+            archive = sh.git('archive', '--format=tar',
+                             '%s:%s' % (revision, prefix),
+                             _cwd=toplevel, _tty_out=False).stdout
+            with tarfile.open(fileobj=StringIO.StringIO(archive)) as tar:
+                tar.extractall(tmpdir)
+        except (sh.ErrorReturnCode, sh.CommandNotFound,
+                tarfile.TarError, OSError) as e:
+            reason = str(getattr(e, 'stderr', '') or e).strip()
+            raise ManagerError('Cannot check out revision %s of %s: %s'
+                               % (revision, path, reason))
+        yield tmpdir
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _split_git_range(revision_range):
+    """
+    Split a git revision range into its start & end and the separator.
+    Empty start or end stands for HEAD, like in git.
+    :param str revision_range: git revision range in the A..B or A...B format
+    :returns: start revision, separator ('..' or '...') & end revision
+    :rtype: (str, str, str)
+    :raises ManagerError: if the range is not in one of the formats
+    """
+    separator = '...' if '...' in revision_range else '..'
+    parts = revision_range.split(separator)
+    if len(parts) != 2 or any(i.startswith('.') or i.endswith('.')
+                              for i in parts):
+        raise ManagerError('Invalid git range %s, expected A..B or A...B'
+                           % revision_range)
+    return parts[0] or 'HEAD', separator, parts[1] or 'HEAD'
+
+
+def git_range_base(path, revision_range):
+    """
+    Resolve the revision that changes in a git range are relative to:
+    the start of an A..B range, the merge base of A & B for A...B.
+    :param str path: path to a folder inside a git repository
+    :param str revision_range: git revision range in the A..B or A...B format
+    :returns: base revision
+    :rtype: str
+    :raises ManagerError: if the range is invalid or cannot be resolved
+    """
+    start, separator, end = _split_git_range(revision_range)
+    if separator == '..':
+        return start
+    try:
+        return str(sh.git('merge-base', start, end,
+                          _cwd=path, _tty_out=False)).strip()
+    except (sh.ErrorReturnCode, sh.CommandNotFound, OSError) as e:
+        reason = str(getattr(e, 'stderr', '') or e).strip()
+        raise ManagerError('Cannot find merge base of %s: %s'
+                           % (revision_range, reason))
+
+
+def git_revision(path, revision):
+    """
+    Resolve a git revision (branch, tag, HEAD...) to its commit.
+    :param str path: path to a folder inside a git repository
+    :param str revision: git revision to resolve
+    :returns: commit hash
+    :rtype: str
+    :raises ManagerError: if the revision cannot be resolved
+    """
+    try:
+        return str(sh.git('rev-parse', '--verify', '%s^{commit}' % revision,
+                          _cwd=path, _tty_out=False)).strip()
+    except (sh.ErrorReturnCode, sh.CommandNotFound, OSError) as e:
+        reason = str(getattr(e, 'stderr', '') or e).strip()
+        raise ManagerError('Cannot resolve revision %s: %s'
+                           % (revision, reason))
+
+
+def git_range_end(path, revision_range):
+    """
+    Resolve the end of a git range (B of A..B or A...B) to its commit.
+    :param str path: path to a folder inside a git repository
+    :param str revision_range: git revision range in the A..B or A...B format
+    :returns: commit hash
+    :rtype: str
+    :raises ManagerError: if the range is invalid or cannot be resolved
+    """
+    return git_revision(path, _split_git_range(revision_range)[2])
+
+
+def git_changed_files(path, revision_range):
+    """
+    List files of a folder in a git repository changed in a revision range.
+    Renames are reported as a removal of the old & addition of the new file.
+    :param str path: path to a folder inside a git repository
+    :param str revision_range: git revision range in the A..B or A...B format
+    :returns: paths (relative to `path`) of changed/added & of removed files
+    :rtype: ([str], [str])
+    :raises ManagerError: if the changed files cannot be listed
+    """
+    _split_git_range(revision_range)
+    try:
+        output = str(sh.git('diff', '--name-status', '--no-renames',
+                            '--relative', revision_range, '--', '.',
+                            _cwd=path, _tty_out=False))
+    except (sh.ErrorReturnCode, sh.CommandNotFound, OSError) as e:
+        reason = str(getattr(e, 'stderr', '') or e).strip()
+        raise ManagerError('Cannot list files changed in %s: %s'
+                           % (revision_range, reason))
+    changed, removed = [], []
+    for line in output.splitlines():
+        status, filepath = line.split('\t', 1)
+        (removed if status == 'D' else changed).append(filepath)
+    return changed, removed
+
+
+def git_file_contents(path, revision, filepath):
+    """
+    Read a file of a folder in a git repository at a given revision.
+    :param str path: path to a folder inside a git repository
+    :param str revision: git revision to read the file at
+    :param str filepath: path of the file relative to `path`
+    :returns: file contents
+    :rtype: str
+    :raises ManagerError: if the file cannot be read
+    """
+    try:
+        return str(sh.git('show', '%s:./%s' % (revision, filepath),
+                          _cwd=path, _tty_out=False))
+    except (sh.ErrorReturnCode, sh.CommandNotFound, OSError) as e:
+        reason = str(getattr(e, 'stderr', '') or e).strip()
+        raise ManagerError('Cannot read %s at %s: %s'
+                           % (filepath, revision, reason))
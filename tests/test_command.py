@@ -26,6 +26,55 @@ class TestCommand(object):
         assert isinstance(cmd.payload['attr2'][0], unicode)
         assert cmd.description == desc
 
+    def test_slots(self):
+        cmd = tool.Command('group_add', {}, 'group1', 'cn')
+        assert not hasattr(cmd, '__dict__')
+        assert cmd.lg.name == 'Command'
+
+    def test_description_lazy(self):
+        cmd = tool.Command('group_mod', {'description': 'x'}, 'group1', 'cn')
+        assert cmd._description is None
+        assert cmd.description == 'group_mod group1 (description=x)'
+        cmd.update({'posix': True})
+        assert cmd.description == (
+            'group_mod group1 (description=x; posix=True)')
+        cmd.description = 'group_mod group1 (make POSIX)'
+        assert repr(cmd) == 'group_mod group1 (make POSIX)'
+
+    def test_rank(self):
+        ranks = [tool.Command(name, {}, 'x', 'cn').rank for name in (
+            'group_add', 'group_add_member', 'group_mod',
+            'group_remove_member', 'group_del', 'user_disable')]
+        assert ranks == [0, 1, 2, 3, 4, 5]
+        with mock.patch('%s.RANK_PATTERNS' % tool.__name__) as mock_patterns:
+            assert tool.Command('group_del', {}, 'y', 'cn').rank == 4
+        mock_patterns.__getitem__.assert_not_called()
+
+    def test_sort(self):
+        commands = [
+            tool.Command('group_del', {}, 'group0', 'cn'),
+            tool.Command('group_add_member', {'user': 'b'}, 'group1', 'cn'),
+            tool.Command('group_add_member', {'user': 'a'}, 'group1', 'cn'),
+            tool.Command('group_add', {}, 'group2', 'cn'),
+            tool.Command('group_add_member', {'group': 'c'}, 'group0', 'cn')]
+        expected = [
+            'group_add group2 ()', 'group_add_member group0 (group=c)',
+            'group_add_member group1 (user=a)',
+            'group_add_member group1 (user=b)', 'group_del group0 ()']
+        result = sorted(commands, key=lambda i: i.sort_key)
+        assert all(i._description is None for i in commands)
+        assert [repr(i) for i in result] == expected
+        assert [repr(i) for i in sorted(commands)] == expected
+
+    def test_sort_key_cached(self):
+        cmd = tool.Command('group_add_member', {'user': 'b'}, 'group1', 'cn')
+        key = cmd.sort_key
+        assert cmd.sort_key is key
+        # refreshed after a payload update
+        cmd.update({'user': u'a'})
+        assert cmd.sort_key == (1, 'group_add_member', 'group1',
+                                [('user', u'a')])
+
     @log_capture('Command', level=logging.INFO)
     def test_execute(self, captured_log):
         mock_api = mock.MagicMock()
@@ -84,6 +133,38 @@ class TestCommand(object):
             cmd.execute(mock_api)
         assert exc.value[0] == 'Non-existent command non_existent'
 
+    def test_execute_transient(self):
+        class NetworkError(Exception):
+            pass
+
+        class DatabaseError(Exception):
+            pass
+        mock_api = mock.MagicMock()
+        cmd = tool.Command('user_del', {}, 'user1', 'uid')
+        mock_api.Command.__getitem__.return_value.side_effect = (
+            DatabaseError('Server is busy'))
+        with pytest.raises(tool.RetryableCommandError) as exc:
+            cmd.execute(mock_api)
+        assert exc.value[0] == 'Error executing user_del: Server is busy'
+        # the user may have been deleted before the connection failed
+        mock_api.Command.__getitem__.return_value.side_effect = (
+            NetworkError('connection reset'))
+        with pytest.raises(tool.CommandError) as exc:
+            cmd.execute(mock_api)
+        assert not isinstance(exc.value, tool.RetryableCommandError)
+        mock_api.Command.__getitem__.return_value.side_effect = (
+            DatabaseError('Invalid syntax'))
+        with pytest.raises(tool.CommandError) as exc:
+            cmd.execute(mock_api)
+        assert not isinstance(exc.value, tool.RetryableCommandError)
+
+    def test_is_transient(self):
+        assert tool.is_transient('DatabaseError', 'Server is busy')
+        assert not tool.is_transient('DatabaseTimeout', 'timed out')
+        assert not tool.is_transient('NetworkError', 'connection reset')
+        assert not tool.is_transient('DatabaseError', 'Operations error')
+        assert not tool.is_transient('NotFound', 'user1: user not found')
+
     @log_capture('Command', level=logging.INFO)
     def test_handle_command_output_summary(self, captured_log):
         cmd = tool.Command('test', {'user': 'user1'}, 'group1', 'cn')
@@ -6,7 +6,7 @@
 import logging
 import os.path
 import pytest
-from testfixtures import log_capture
+from testfixtures import log_capture, LogCapture
 
 from _utils import _import
 tool = _import('ipamanager', 'config_loader')
@@ -167,6 +167,19 @@ class TestConfigLoader(object):
              'Not creating ignored user test.user '
              'from users/test_user.yaml'))
 
+    def test_load_clears_interned(self):
+        self.loader.basepath = CONFIG_CORRECT
+        stale = (u'removed-group',)
+        entities._names[stale[0]] = stale[0]
+        entities._memberships[stale] = stale
+        with LogCapture():
+            self.loader.load()
+        # only names & memberships of the loaded entities are kept
+        assert stale[0] not in entities._names
+        assert stale not in entities._memberships
+        self.loader.entities['hbacrule']['rule_one'].data_ipa
+        assert entities._memberships
+
     @log_capture('ConfigLoader', level=logging.INFO)
     def test_load(self, captured_log):
         self.loader.basepath = CONFIG_CORRECT
@@ -222,6 +235,22 @@ class TestConfigLoader(object):
             ('ConfigLoader', 'INFO', 'Parsed 2 users'),
             ('ConfigLoader', 'INFO', 'Parsed 3 groups'))
 
+    def test_load_groups_callback(self):
+        self.loader.basepath = CONFIG_CORRECT
+        parsed_types = []
+
+        def callback(groups):
+            parsed_types.extend(
+                t for t, e in self.loader.entities.iteritems() if e)
+            self.callback_groups = sorted(groups)
+
+        with LogCapture():
+            self.loader.load(groups_callback=callback)
+        assert self.callback_groups == [
+            'group-four-users', 'group-three-users', 'group-two']
+        assert parsed_types == ['group']
+        assert len(self.loader.entities['hostgroup']) == 3
+
     @log_capture('ConfigLoader', level=logging.INFO)
     def test_load_no_apply_ignored(self, captured_log):
         self.loader.basepath = CONFIG_CORRECT
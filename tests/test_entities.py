@@ -45,6 +45,133 @@ class TestFreeIPAEntity(object):
         rule2.name = 'rule-one'
         assert rule1 == rule2
 
+    def test_slots(self):
+        for entity in (tool.FreeIPAUserGroup('group', {}, 'path'),
+                       tool.FreeIPASudoRule('rule-one', {}, 'path'),
+                       tool.FreeIPAUser('user1', {}),
+                       tool.FreeIPAOktaUser('user2', {})):
+            assert not hasattr(entity, '__dict__')
+            with pytest.raises(AttributeError):
+                entity.errs = []
+
+    def test_class_logger(self):
+        group1 = tool.FreeIPAUserGroup('group1', {}, 'path')
+        group2 = tool.FreeIPAUserGroup('group2', {}, 'path')
+        assert group1.lg is group2.lg
+        assert group1.lg.name == 'FreeIPAUserGroup'
+        assert tool.FreeIPAHostGroup('group', {}, 'path').lg.name == (
+            'FreeIPAHostGroup')
+
+    def test_interned_names(self):
+        group = tool.FreeIPAUserGroup(''.join(['group', '-one']), {}, 'path')
+        user1 = tool.FreeIPAUser('user1', {
+            'firstName': 'Some', 'lastName': 'Name',
+            'memberOf': {'group': [''.join(['group', '-one'])]}}, 'path')
+        user2 = tool.FreeIPAUser('user2', {
+            'firstName': 'Some', 'lastName': 'Name',
+            'memberOf': {'group': [''.join(['group', '-one'])]}}, 'path')
+        assert user1.data_repo['memberOf']['group'][0] is group.name
+        assert user2.data_ipa['memberof']['group'][0] is group.name
+
+    def test_interned_names_unicode(self):
+        name = u''.join([u'gr\xfcp', u'-one'])
+        group = tool.FreeIPAUserGroup(name, {'cn': (name,)})
+        user = tool.FreeIPAUser(
+            'user1', {'memberof_group': (u''.join([u'gr\xfcp', u'-one']),)})
+        assert isinstance(group.name, unicode)
+        assert user.data_ipa['memberof_group'][0] is group.name
+
+    def test_lazy_data_ipa(self):
+        group = tool.FreeIPAUserGroup(
+            'group', {'description': 'Group', 'posix': False}, 'path')
+        assert group._data_ipa is None
+        assert not group.posix
+        with mock.patch('%s.FreeIPAUserGroup._convert_to_ipa' % modulename,
+                        return_value={'description': (u'Group',)}) as conv:
+            assert group.data_ipa == {'description': (u'Group',)}
+            assert group.data_ipa == {'description': (u'Group',)}
+        conv.assert_called_once_with({'description': 'Group', 'posix': False})
+
+    def test_lazy_data_repo(self):
+        user = tool.FreeIPAUser('user1', {'givenname': (u'Some',)})
+        assert user._data_repo is None
+        assert user.data_repo == {'firstName': u'Some'}
+        assert user.data_repo is user.data_repo
+
+    def test_memberof_checked_eagerly(self):
+        with pytest.raises(tool.ConfigError) as exc:
+            tool.FreeIPAUserGroup(
+                'group', {'memberOf': {'invalid': ['group-one']}}, 'path')
+        assert exc.value[0] == (
+            'Cannot be a member of non-existent entity type invalid')
+
+    def test_get_entity_class(self):
+        assert tool.FreeIPAEntity.get_entity_class('hostgroup') is (
+            tool.FreeIPAHostGroup)
+        assert tool.FreeIPAEntity.get_entity_class('user') is tool.FreeIPAUser
+        with pytest.raises(KeyError):
+            tool.FreeIPAEntity.get_entity_class('invalid')
+
+    def test_conversion_tables(self):
+        ipa_keys, pull, push = tool.FreeIPASudoRule._conversion_tables()
+        assert tool.FreeIPASudoRule._conversion_tables()[0] is ipa_keys
+        assert ipa_keys['options'] == 'ipasudoopt'
+        assert ipa_keys['memberHost'] == 'memberhost'
+        assert dict(pull)['ipasudoopt'] == 'options'
+        assert dict(pull)['description'] == 'description'
+        assert push == ('cmdcategory', 'description',
+                        'ipasudorunasgroupcategory', 'ipasudorunasusercategory')
+        # not inherited from the parent class
+        okta_keys, okta_pull, _ = tool.FreeIPAOktaUser._conversion_tables()
+        assert tool.FreeIPAUser._conversion_tables()[0] is not okta_keys
+        assert okta_pull == ()
+        assert tool.FreeIPAHostGroup._conversion_tables()[1] == (
+            ('description', 'description'),)
+
+    def test_fingerprint(self):
+        keys = tool.FreeIPAUser._conversion_tables()[2]
+        user1 = tool.FreeIPAUser('user1', {
+            'givenname': (u'Some',), 'title': (u'B', u'A')})
+        user2 = tool.FreeIPAUser('user1', {
+            'givenname': (u'Some',), 'title': (u'A', u'B')})
+        assert user1.fingerprint(keys) == user2.fingerprint(keys)
+        assert user1.fingerprint(keys)[1][-1] == (u'A', u'B')
+        assert user1.fingerprint(keys) is user1.fingerprint(keys)
+        user1.data_ipa = {'givenname': (u'Other',)}
+        assert user1.fingerprint(keys) != user2.fingerprint(keys)
+
+    def test_create_commands_fingerprint_match(self):
+        local = tool.FreeIPAUser('user1', {
+            'firstName': 'Some', 'lastName': 'Name', 'title': 'A',
+            'emailAddress': ['a@example.com', 'b@example.com']}, 'path')
+        remote = tool.FreeIPAUser('user1', {
+            'givenname': (u'Some',), 'sn': (u'Name',), 'title': (u'A',),
+            'mail': (u'b@example.com', u'a@example.com')})
+        assert local.fingerprint(('title', 'mail')) == remote.fingerprint(
+            ('title', 'mail'))
+        assert local.create_commands(remote) == []
+
+    def test_create_commands_fingerprint_mismatch(self):
+        local = tool.FreeIPAUser('user1', {
+            'firstName': 'Some', 'lastName': 'Name', 'title': 'A'}, 'path')
+        remote = tool.FreeIPAUser('user1', {
+            'givenname': (u'Some',), 'sn': (u'Other',), 'title': (u'A',),
+            'mail': (u'a@example.com',)})
+        commands = local.create_commands(remote)
+        assert [repr(i) for i in commands] == [
+            'user_mod user1 (mail=(); sn=Name)']
+
+    def test_shared_membership_tuples(self):
+        user1 = tool.FreeIPAUser(
+            'user1', {'memberof_group': (u'group-one', u'group-two')})
+        user2 = tool.FreeIPAUser(
+            'user2', {'memberof_group': (u'group-one', u'group-two')})
+        rule1 = tool.FreeIPASudoRule(
+            'rule-one', {'memberUser': ['group-one', 'group-two']}, 'path')
+        assert user1.data_ipa['memberof_group'] is (
+            user2.data_ipa['memberof_group'])
+        assert rule1.data_ipa['memberuser'] is user1.data_ipa['memberof_group']
+
 
 class TestFreeIPAGroup(object):
     def test_create_group(self):
@@ -889,13 +1016,14 @@ class TestFreeIPAHBACRule(object):
     def test_write_to_file_no_default_attributes(self):
         rule = tool.FreeIPAHBACRule(
             'rule-one', {'description': 'Sample HBAC rule'}, 'path')
-        rule.default_attributes = []
         assert rule.data_repo == {
             'description': 'Sample HBAC rule', 'serviceCategory': 'all'}
         output = dict()
         with mock.patch('yaml.dump', _mock_dump(output, yaml.dump)):
             with mock.patch('__builtin__.open'):
-                rule.write_to_file()
+                with mock.patch.object(
+                        tool.FreeIPAHBACRule, 'default_attributes', []):
+                    rule.write_to_file()
         assert output == {'rule-one': '---\nrule-one:\n'
                                       '  description: Sample HBAC rule\n'
                                       '  serviceCategory: all\n'}
@@ -1015,6 +1143,28 @@ class TestFreeIPASudoRule(object):
              'ipasudorunasgroupcategory': u'all',
              'ipasudorunasusercategory': u'all'}]
 
+    def test_create_commands_skip(self):
+        rule = tool.FreeIPASudoRule('rule-one', {}, 'path')
+        remote_rule = tool.FreeIPASudoRule(
+            'rule-one', {'cn': (u'rule-one',), 'memberhost_hostgroup': (
+                u'hosts',), 'ipasudoopt': (u'!test', u'!test2')})
+        skipped = []
+
+        def skip(command):
+            if '_remove_' in command:
+                skipped.append(command)
+                return True
+            return False
+        with mock.patch('%s.Command' % modulename,
+                        wraps=tool.Command) as mock_command:
+            commands = rule.create_commands(remote_rule, skip)
+        assert sorted(i.command for i in commands) == [
+            'sudorule_add_option', 'sudorule_add_option', 'sudorule_mod']
+        # skipped commands are not created at all
+        assert mock_command.call_count == 3
+        assert sorted(skipped) == ['sudorule_remove_host'] + [
+            'sudorule_remove_option'] * 2
+
     def test_convert_to_repo(self):
         rule = tool.FreeIPASudoRule('rule-one', {})
         result = rule._convert_to_repo(self.ipa_data)
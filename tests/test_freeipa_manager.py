@@ -7,8 +7,12 @@ import logging
 import mock
 import os
 import pytest
+import sh
+import shutil
 import socket
 import sys
+import tempfile
+import threading
 from testfixtures import log_capture, LogCapture, StringComparison
 
 from _utils import _import
@@ -29,6 +33,8 @@ SETTINGS_MERGE_INCLUDE = os.path.join(
     os.path.dirname(__file__), 'freeipa-manager-config/settings_merge.yaml')
 SETTINGS_INVALID = os.path.join(
     os.path.dirname(__file__), 'freeipa-manager-config/settings_invalid.yaml')
+CONFIG_CORRECT = os.path.join(
+    os.path.dirname(__file__), 'freeipa-manager-config/correct')
 
 
 class TestFreeIPAManagerBase(object):
@@ -170,7 +176,8 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
                 manager.entities = dict()
                 manager.run()
         mock_conn.assert_called_with(
-            manager.settings, {}, 10, True, False, False, [])
+            manager.settings, {}, 10, True, False, False, [],
+            processes=None)
 
     def test_run_push_enable_deletion(self):
         with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
@@ -179,7 +186,8 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
                 manager.entities = dict()
                 manager.run()
         mock_conn.assert_called_with(
-            manager.settings, {}, 10, True, True, False, [])
+            manager.settings, {}, 10, True, True, False, [],
+            processes=None)
 
     def test_run_push_dry_run(self):
         with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
@@ -188,7 +196,8 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
                 manager.entities = dict()
                 manager.run()
         mock_conn.assert_called_with(
-            manager.settings, {}, 10, False, False, False, [])
+            manager.settings, {}, 10, False, False, False, [],
+            processes=None)
 
     def test_run_push_dry_run_enable_deletion(self):
         with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
@@ -197,7 +206,209 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
                 manager.entities = dict()
                 manager.run()
         mock_conn.assert_called_with(
-            manager.settings, {}, 10, False, True, False, [])
+            manager.settings, {}, 10, False, True, False, [],
+            processes=None)
+
+    def test_run_push_processes(self):
+        with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
+            with mock.patch('%s.FreeIPAManager.check' % modulename):
+                manager = self._init_tool(['push', 'config_repo', '-j', '4'])
+                manager.entities = dict()
+                manager.run()
+        mock_conn.assert_called_with(
+            manager.settings, {}, 10, False, False, False, [], processes=4)
+
+    def test_run_push_changed(self):
+        with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
+            with mock.patch('%s.FreeIPAManager.check' % modulename):
+                with mock.patch('%s.FreeIPAManager._resolve_changes'
+                                % modulename) as mock_resolve:
+                    manager = self._init_tool(
+                        ['push', 'config_repo', '-c', 'groups/group_one.yaml'])
+                    manager.entities = dict()
+                    manager.run()
+        mock_conn.return_value.push.assert_called_with(
+            mock_resolve.return_value)
+
+    def _init_git_repo(self):
+        self.repo = tempfile.mkdtemp()
+        self.config = os.path.join(self.repo, 'config')
+        shutil.copytree(CONFIG_CORRECT, self.config)
+        self.git = sh.git.bake(
+            '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+            _cwd=self.repo)
+        self.git.init('-q')
+        self.git.add('.')
+        self.git.commit('-q', '-m', 'initial')
+
+    def _write_config(self, path, content):
+        with open(os.path.join(self.config, path), 'w') as target:
+            target.write('---\n%s' % content)
+
+    def _resolve_changes(self, args):
+        # test.user removed, firstname.lastname changed & moved
+        # to a new file, group-four-users renamed
+        os.unlink(os.path.join(self.config, 'users/test_user.yaml'))
+        os.unlink(os.path.join(self.config, 'users/firstname_lastname.yaml'))
+        self._write_config('users/new.yaml', 'firstname.lastname:\n'
+                           '  firstName: First\n  lastName: Last\n')
+        self._write_config('groups/group_four.yaml',
+                           'group-five-users:\n  description: Five\n')
+        if args[0] == '-g':
+            self.git.add('-A', '.')
+            self.git.commit('-q', '-m', 'change')
+        manager = self._init_tool(['push', self.config] + args)
+        with LogCapture():
+            manager.load()
+            changed, removed = manager._resolve_changes()
+        return sorted(repr(i) for i in changed), removed
+
+    def test_resolve_changes_paths(self):
+        self._init_git_repo()
+        try:
+            changed, removed = self._resolve_changes([
+                '-c', 'users/test_user.yaml', 'users/new.yaml',
+                'users/firstname_lastname.yaml', 'groups/group_four.yaml',
+                'ignored.yaml'])
+        finally:
+            shutil.rmtree(self.repo)
+        assert changed == ['group group-five-users', 'user firstname.lastname']
+        assert removed == [('group', 'group-four-users'),
+                           ('user', 'test.user')]
+
+    def test_resolve_changes_git_range(self):
+        self._init_git_repo()
+        try:
+            changed, removed = self._resolve_changes(['-g', 'HEAD~1..HEAD'])
+        finally:
+            shutil.rmtree(self.repo)
+        assert changed == ['group group-five-users', 'user firstname.lastname']
+        assert removed == [('group', 'group-four-users'),
+                           ('user', 'test.user')]
+
+    def test_resolve_changes_git_range_not_head(self):
+        self._init_git_repo()
+        try:
+            main = str(self.git('rev-parse', '--abbrev-ref', 'HEAD')).strip()
+            self.git.branch('release')
+            self._write_config('groups/group_four.yaml',
+                               'group-five-users:\n  description: Five\n')
+            self.git.commit('-q', '-a', '-m', 'change')
+            self.git.checkout('-q', 'release')
+            # the working tree does not contain the changes of the range
+            manager = self._init_tool(
+                ['push', self.config, '-g', 'release..%s' % main])
+            with LogCapture():
+                manager.load()
+                with pytest.raises(errors.ManagerError) as exc:
+                    manager._resolve_changes()
+            head = str(self.git('rev-parse', 'HEAD')).strip()
+            assert utils.git_range_end(self.config, 'A...HEAD') == head
+        finally:
+            shutil.rmtree(self.repo)
+        assert exc.value[0] == (
+            'End of git range release..%s is not the checked-out HEAD' % main)
+
+    def test_resolve_changes_git_range_invalid(self):
+        manager = self._init_tool(['push', CONFIG_CORRECT, '-g', 'HEAD'])
+        manager.entities = dict()
+        with pytest.raises(errors.ManagerError) as exc:
+            manager._resolve_changes()
+        assert exc.value[0] == 'Invalid git range HEAD, expected A..B or A...B'
+
+    def test_resolve_changes_git_range_symmetric(self):
+        self._init_git_repo()
+        try:
+            # branch from the initial commit, main line changes group-two
+            main = str(self.git('rev-parse', '--abbrev-ref', 'HEAD')).strip()
+            self.git.branch('base')
+            # (group-six-users exists on the main line only)
+            self._write_config('groups/group_four.yaml',
+                               'group-four-users:\n  description: Four\n'
+                               'group-six-users:\n  description: Six\n')
+            self.git.commit('-q', '-a', '-m', 'main change')
+            self.git.checkout('-q', '-b', 'feature', 'base')
+            changed, removed = self._resolve_changes(
+                ['-g', '%s...HEAD' % main])
+            base = str(self.git('rev-parse', 'base')).strip()
+            assert utils.git_range_base(
+                self.config, '%s...HEAD' % main) == base
+        finally:
+            shutil.rmtree(self.repo)
+        # only changes of the branch, relative to the merge base
+        assert changed == ['group group-five-users', 'user firstname.lastname']
+        assert removed == [('group', 'group-four-users'),
+                           ('user', 'test.user')]
+
+    def test_git_range_base(self):
+        assert utils.git_range_base('.', 'v1.2..HEAD') == 'v1.2'
+        assert utils.git_range_base('.', '..HEAD') == 'HEAD'
+        for revision_range in ('HEAD', 'A..B..C', 'A....B', 'A..B.'):
+            with pytest.raises(errors.ManagerError) as exc:
+                utils.git_range_base('.', revision_range)
+            assert exc.value[0] == (
+                'Invalid git range %s, expected A..B or A...B' % revision_range)
+
+    def test_resolve_changes_removed_unknown(self):
+        self._init_git_repo()
+        try:
+            with pytest.raises(errors.ManagerError) as exc:
+                self._resolve_changes(['-c', 'users/nonexistent.yaml'])
+        finally:
+            shutil.rmtree(self.repo)
+        assert exc.value[0].startswith(
+            'Cannot read users/nonexistent.yaml at HEAD: fatal:')
+
+    def _plan(self, args, capsys):
+        self._init_git_repo()
+        # group-four-users moves from group-three-users to group-two,
+        # group-three-hosts leaves group-two & test.user is removed
+        self._write_config('groups/group_four.yaml',
+                           'group-four-users:\n  memberOf:\n'
+                           '    group: [group-two]\n')
+        self._write_config('hostgroups/group_three.yaml',
+                           'group-three-hosts:\n  description: Sample.\n')
+        os.unlink(os.path.join(self.config, 'users/test_user.yaml'))
+        try:
+            manager = self._init_tool(['plan', self.config] + args)
+            with LogCapture() as self.log:
+                manager.plan()
+        finally:
+            shutil.rmtree(self.repo)
+        return capsys.readouterr()[0].splitlines()
+
+    def test_plan(self, capsys):
+        assert self._plan(['-o', 'HEAD'], capsys) == [
+            'group_add_member group-two (group=group-four-users)',
+            'hostgroup_mod group-three-hosts (description=Sample.)']
+        self.log.check_present(
+            ('IpaUploader', 'INFO', 'Loaded 34 entities from repository state'),
+            ('FreeIPAManager', 'INFO', '2 commands planned'))
+
+    def test_plan_deletion(self, capsys):
+        assert self._plan(['-o', 'HEAD', '-d'], capsys) == [
+            'group_add_member group-two (group=group-four-users)',
+            'hostgroup_mod group-three-hosts (description=Sample.)',
+            'group_remove_member group-three-users (group=group-four-users)',
+            'hostgroup_remove_member group-two (hostgroup=group-three-hosts)',
+            'user_del test.user ()']
+
+    def test_plan_processes(self, capsys):
+        assert self._plan(['-o', 'HEAD', '-d', '-j', '3'], capsys) == [
+            'group_add_member group-two (group=group-four-users)',
+            'hostgroup_mod group-three-hosts (description=Sample.)',
+            'group_remove_member group-three-users (group=group-four-users)',
+            'hostgroup_remove_member group-two (hostgroup=group-three-hosts)',
+            'user_del test.user ()']
+
+    def test_plan_same_revision(self, capsys):
+        assert self._plan(['-o', 'HEAD', '-n', 'HEAD', '-d'], capsys) == []
+
+    def test_plan_invalid_revision(self, capsys):
+        with pytest.raises(errors.ManagerError) as exc:
+            self._plan(['-o', 'nonexistent'], capsys)
+        assert exc.value[0].startswith(
+            'Cannot check out revision nonexistent of %s' % self.config)
 
     def test_run_pull(self):
         with mock.patch('ipamanager.ipa_connector.IpaDownloader') as mock_conn:
@@ -260,6 +471,113 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
                                       'separate_foreman_view': False},
                       'repo', False)])
 
+    def _mock_config_load(self, order):
+        def f(groups_callback=None):
+            order.append('groups parsed')
+            groups_callback(['group1', 'group2'])
+            order.append('rest parsed')
+            return {'group': {'group1': 'g1', 'group2': 'g2'},
+                    'user': {'git.user': 'u1'}}
+        return f
+
+    @mock.patch('%s.OktaLoader' % modulename)
+    @mock.patch('%s.ConfigLoader' % modulename)
+    def test_load_okta_concurrent(self, mock_config, mock_okta):
+        order = []
+        mock_config.return_value.load.side_effect = self._mock_config_load(
+            order)
+        mock_config.return_value.errs = []
+        threads = set()
+
+        def okta_step(step, result):
+            def f():
+                threads.add(threading.current_thread())
+                order.append(step)
+                return result
+            return f
+        mock_okta.return_value.load.side_effect = okta_step(
+            'okta users', {'okta.user': 'u2'})
+        mock_okta.return_value.load_groups.side_effect = okta_step(
+            'okta groups', ['group1'])
+        manager = self._init_tool(['push', 'config_path'])
+        manager.okta_users = True
+        with LogCapture() as log:
+            manager.load()
+        mock_okta.assert_called_with(manager.settings, ['group1', 'group2'])
+        assert order[0] == 'groups parsed'
+        # Okta groups & users loaded one after another in one thread
+        assert order.index('okta groups') < order.index('okta users')
+        assert len(threads) == 1
+        assert threading.current_thread() not in threads
+        assert manager.entities['user'] == {'okta.user': 'u2'}
+        assert manager.entities['group'] == {'group1': 'g1', 'group2': 'g2'}
+        assert manager.okta_groups == ['group1']
+        log.check_present(
+            ('FreeIPAManager', 'WARNING',
+             '1 users parsed from Git but will be overwritten by Okta'))
+
+    @mock.patch('%s.OktaLoader' % modulename)
+    @mock.patch('%s.ConfigLoader' % modulename)
+    def test_load_okta_error(self, mock_config, mock_okta):
+        mock_config.return_value.load.side_effect = self._mock_config_load([])
+        mock_config.return_value.errs = []
+        mock_okta.return_value.load.side_effect = errors.OktaError('failed')
+        manager = self._init_tool(['push', 'config_path'])
+        manager.okta_users = True
+        with pytest.raises(errors.OktaError) as exc:
+            manager.load()
+        assert exc.value[0] == 'failed'
+
+    @mock.patch('%s.OktaLoader' % modulename)
+    @mock.patch('%s.ConfigLoader' % modulename)
+    def test_load_okta_config_error(self, mock_config, mock_okta):
+        def load(groups_callback=None):
+            groups_callback(['group1'])
+            raise errors.ConfigError('invalid config')
+        mock_config.return_value.load.side_effect = load
+        mock_config.return_value.errs = []
+        okta_done = threading.Event()
+        mock_okta.return_value.load.side_effect = lambda: okta_done.wait(5)
+        manager = self._init_tool(['push', 'config_path'])
+        manager.okta_users = True
+        with LogCapture() as log:
+            with pytest.raises(errors.ConfigError) as exc:
+                manager.load()
+        # the error is raised without waiting for the Okta loading
+        assert not okta_done.is_set()
+        okta_done.set()
+        assert exc.value[0] == 'invalid config'
+        log.check_present(('FreeIPAManager', 'DEBUG',
+                           'Abandoning background Okta loading'))
+
+    @mock.patch('%s.OktaLoader' % modulename)
+    @mock.patch('%s.ConfigLoader' % modulename)
+    def test_load_okta_group_errors(self, mock_config, mock_okta):
+        def load(groups_callback=None):
+            groups_callback(['group1'])
+            raise errors.ConfigError('invalid groups')
+        mock_config.return_value.load.side_effect = load
+        mock_config.return_value.errs = ['groups/group1.yaml']
+        manager = self._init_tool(['push', 'config_path'])
+        manager.okta_users = True
+        with LogCapture():
+            with pytest.raises(errors.ConfigError):
+                manager.load()
+        mock_okta.assert_not_called()
+
+    @mock.patch('%s.OktaLoader' % modulename)
+    @mock.patch('%s.ConfigLoader' % modulename)
+    def test_load_okta_check(self, mock_config, mock_okta):
+        mock_config.return_value.load.return_value = {'user': {'u': 'u1'}}
+        manager = self._init_tool(['check', 'config_path'])
+        manager.okta_users = True
+        with LogCapture():
+            manager.load()
+        mock_config.return_value.load.assert_called_with()
+        mock_okta.assert_not_called()
+        assert manager.entities['user'] == {}
+        assert manager.okta_groups == []
+
     def _mock_load(self):
         def f(manager, *args, **kwargs):
             self.mock_load_args = (args, kwargs)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import logging
+import mock
+import pytest
+from testfixtures import LogCapture
+
+from _utils import _import
+tool = _import('ipamanager', 'governor')
+modulename = 'ipamanager.governor'
+
+
+class TestExecutionGovernor(object):
+    def setup_method(self, method):
+        self.governor = tool.ExecutionGovernor(
+            {'execution': {'target_latency': 0.5, 'retries': 2,
+                           'backoff': 1, 'max_backoff': 1.5,
+                           'max_batch_size': 3}}, max_concurrency=4)
+        self.command = mock.Mock(description='user_add user1 ()')
+
+    def test_defaults(self):
+        governor = tool.ExecutionGovernor({})
+        assert (governor.target_latency, governor.retries, governor.backoff,
+                governor.max_backoff, governor.max_batch_size) == (
+                    1.0, 3, 0.5, 30, 16)
+        assert governor.concurrency == governor.batch_size == 1
+
+    def test_execute(self):
+        self.governor.execute(self.command, 'api')
+        self.command.execute.assert_called_once_with('api')
+        assert self.governor.stats['commands'] == 1
+        assert self.governor.stats['attempts'] == 1
+
+    @mock.patch('%s.time.sleep' % modulename)
+    @mock.patch('%s.random.uniform' % modulename)
+    def test_execute_retry(self, mock_uniform, mock_sleep):
+        mock_uniform.return_value = 0.7
+        self.command.execute.side_effect = [
+            tool.RetryableCommandError('Error executing user_add: timeout'),
+            None]
+        with LogCapture('ExecutionGovernor', level=logging.WARNING) as log:
+            self.governor.execute(self.command, 'api')
+        mock_uniform.assert_called_once_with(0, 1)
+        mock_sleep.assert_called_once_with(0.7)
+        log.check(('ExecutionGovernor', 'WARNING',
+                   'user_add user1 () failed transiently, retry 1/2 in '
+                   '0.70 s: Error executing user_add: timeout'))
+        assert self.governor.stats == {
+            'commands': 1, 'attempts': 2, 'retries': 1, 'errors': 0,
+            'time': self.governor.stats['time']}
+
+    @mock.patch('%s.time.sleep' % modulename)
+    @mock.patch('%s.random.uniform' % modulename)
+    def test_execute_retries_exhausted(self, mock_uniform, mock_sleep):
+        self.command.execute.side_effect = tool.RetryableCommandError('busy')
+        with LogCapture():
+            with pytest.raises(tool.RetryableCommandError) as exc:
+                self.governor.execute(self.command, 'api')
+        assert exc.value[0] == 'busy'
+        assert self.command.execute.call_count == 3
+        # exponential backoff capped at max_backoff
+        assert mock_uniform.call_args_list == [
+            mock.call(0, 1), mock.call(0, 1.5)]
+        assert self.governor.stats['errors'] == 1
+        assert self.governor.stats['retries'] == 2
+
+    @mock.patch('%s.time.sleep' % modulename)
+    def test_execute_not_retryable(self, mock_sleep):
+        self.command.execute.side_effect = tool.CommandError('no such entry')
+        with pytest.raises(tool.CommandError) as exc:
+            self.governor.execute(self.command, 'api')
+        assert exc.value[0] == 'no such entry'
+        assert self.command.execute.call_count == 1
+        mock_sleep.assert_not_called()
+        assert self.governor.stats['errors'] == 1
+
+    def test_adjust_increase(self):
+        for _ in range(5):
+            self.governor._record(0.1)
+            self.governor.adjust()
+        assert self.governor.concurrency == 4
+        assert self.governor.batch_size == 3
+
+    def test_adjust_decrease_latency(self):
+        self.governor.concurrency = 4
+        self.governor.batch_size = 3
+        self.governor._record(0.1)
+        self.governor._record(1.1)
+        with LogCapture('ExecutionGovernor', level=logging.DEBUG) as log:
+            self.governor.adjust()
+        assert (self.governor.concurrency, self.governor.batch_size) == (2, 1)
+        log.check(('ExecutionGovernor', 'DEBUG',
+                   'Mean latency 0.600 s, 0 transient errors; '
+                   'concurrency 2, batch size 1'))
+
+    def test_adjust_decrease_transient(self):
+        self.governor.concurrency = 3
+        self.governor._record(0.1, transient=True)
+        self.governor.adjust()
+        assert self.governor.concurrency == 1
+        self.governor.adjust()  # nothing executed in the wave
+        assert self.governor.concurrency == 1
+
+    def test_log_stats(self):
+        self.governor._record(0.2)
+        self.governor._record(0.4)
+        self.governor.stats.update(commands=1, retries=1)
+        with LogCapture('ExecutionGovernor', level=logging.INFO) as log:
+            self.governor.log_stats()
+        log.check(('ExecutionGovernor', 'INFO',
+                   'Executed 1 commands (1 retries, 0 errors), '
+                   'mean latency 0.300 s'))
@@ -3,11 +3,15 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright © 2017-2019, GoodData Corporation. All rights reserved.
 
+import datetime
+import json
 import logging
 import mock
 import os
 import pytest
+import shutil
 import sys
+import tempfile
 import yaml
 from testfixtures import log_capture, LogCapture
 
@@ -22,6 +26,13 @@ SETTINGS = os.path.join(
     os.path.dirname(__file__), 'freeipa-manager-config/settings.yaml')
 
 
+class NotFound(Exception):
+    pass
+
+
+tool.ipa_errors.NotFound = NotFound
+
+
 class TestIpaConnectorBase(object):
     def setup_method(self, method):
         self._create_uploader()
@@ -360,6 +371,11 @@ class TestIpaUploader(TestIpaConnectorBase):
             'hbacsvc': dict(),
             'hbacsvcgroup': dict()}
         self.uploader.commands = []
+        self.uploader._parse_entity_diff(
+            self.uploader.repo_entities['user']['test.user'])
+        assert self.uploader.commands == []
+        assert self.uploader.skipped_deletions == 1
+        self.uploader.enable_deletion = True
         self.uploader._parse_entity_diff(
             self.uploader.repo_entities['user']['test.user'])
         assert len(self.uploader.commands) == 1
@@ -430,7 +446,11 @@ class TestIpaUploader(TestIpaConnectorBase):
         assert [i.command for i in sorted(self.uploader.commands)] == [
             'sudorule_add', 'user_add', 'group_add_member',
             'sudorule_add_option', 'sudorule_add_option', 'sudorule_add_user']
-        captured_log.check(('IpaUploader', 'INFO', '6 commands to execute'))
+        captured_log.check(
+            ('IpaUploader', 'INFO',
+             '1 deletion commands skipped (deletion disabled)'),
+            ('IpaUploader', 'INFO', '6 commands to execute'))
+        assert self.uploader.skipped_deletions == 1
 
     def test_prepare_push_changes_deletion_enabled(self):
         self._create_uploader(enable_deletion=True)
@@ -474,6 +494,63 @@ class TestIpaUploader(TestIpaConnectorBase):
             'sudorule_add_option', 'sudorule_add_option',
             'sudorule_add_user', 'group_del']
 
+    def _planner_entities(self):
+        repo_users = dict(
+            ('user%d' % i, entities.FreeIPAUser('user%d' % i, {
+                'firstName': 'First', 'lastName': 'User%d' % i,
+                'memberOf': {'group': ['group-%d' % (i % 3)]}}, 'path'))
+            for i in range(30))
+        ipa_users = dict(
+            ('user%d' % i, entities.FreeIPAUser('user%d' % i, {
+                'uid': ('user%d' % i,), 'givenname': (u'First',),
+                'sn': (u'Last%d' % (i % 2),)}))
+            for i in range(0, 30, 2))
+        ipa_groups = dict(
+            ('group-%d' % i, entities.FreeIPAUserGroup('group-%d' % i, {
+                'cn': ('group-%d' % i,), u'objectclass': (u'posixgroup',),
+                'member_user': tuple(
+                    u'user%d' % j for j in range(0, 30, 2)
+                    if (j + 1) % 3 == i)}))
+            for i in range(4))
+        self.uploader.repo_entities = {
+            'user': repo_users,
+            'group': dict(
+                ('group-%d' % i, entities.FreeIPAUserGroup(
+                    'group-%d' % i, {}, 'path')) for i in range(3))}
+        self.uploader.ipa_entities = {'user': ipa_users, 'group': ipa_groups}
+
+    def test_prepare_push_processes(self):
+        self._create_uploader()
+        self._planner_entities()
+        with LogCapture():
+            self.uploader._prepare_push()
+        serial = [i.description for i in self.uploader.commands]
+        skipped = self.uploader.skipped_deletions
+        assert len(serial) == 60
+        assert skipped == 16
+        for processes in (2, 7, 100):
+            self.uploader.processes = processes
+            with LogCapture() as log:
+                self.uploader._prepare_push()
+            assert [i.description for i in self.uploader.commands] == serial
+            assert self.uploader.skipped_deletions == skipped
+            log.check_present(
+                ('IpaUploader', 'INFO',
+                 '16 deletion commands skipped (deletion disabled)'),
+                ('IpaUploader', 'INFO', '60 commands to execute'))
+        assert tool._planning_uploader is None
+
+    def test_prepare_push_processes_deletion_enabled(self):
+        self._create_uploader(enable_deletion=True)
+        self._planner_entities()
+        self.uploader._prepare_push()
+        serial = [i.description for i in self.uploader.commands]
+        self.uploader.processes = 3
+        self.uploader._prepare_push()
+        assert [i.description for i in self.uploader.commands] == serial
+        assert self.uploader.skipped_deletions == 0
+        assert serial[-1] == 'group_del group-3 ()'
+
     def test_prepare_push_memberof_add_new_group(self):
         self._create_uploader(debug=True)
         self.uploader.repo_entities = {
@@ -511,20 +588,30 @@ class TestIpaUploader(TestIpaConnectorBase):
         }
         self.uploader.commands = []
         self.uploader._prepare_del_commands()
+        assert self.uploader.commands == []
+        assert self.uploader.skipped_deletions == 1
+        self.uploader.enable_deletion = True
+        self.uploader._prepare_del_commands()
         assert len(self.uploader.commands) == 1
         cmd = self.uploader.commands[0]
         assert cmd.command == 'user_del'
         assert cmd.description == 'user_del test.user ()'
         assert cmd.payload == {'uid': u'test.user'}
 
-    def test_filter_deletion_commands(self):
+    def test_skip_deletion(self):
         self.uploader.deletion_patterns = ['.+_add$']
-        old_cmds = [
-            tool.Command('user_add', {}, 'user1', 'user'),
-            tool.Command('group_add_member', {}, 'group-one', 'group')]
-        self.uploader.commands = old_cmds
-        self.uploader._filter_deletion_commands()
-        assert self.uploader.commands == old_cmds[1:]
+        self.uploader._init_deletion_filter()
+        with mock.patch('%s.re.compile' % modulename) as mock_compile:
+            assert self.uploader._skip_deletion('user_add')
+            assert not self.uploader._skip_deletion('group_add_member')
+            assert self.uploader._skip_deletion('user_add')
+        mock_compile.assert_not_called()
+        assert self.uploader._deletions == {
+            'user_add': True, 'group_add_member': False}
+        assert self.uploader.skipped_deletions == 2
+        self.uploader.enable_deletion = True
+        assert not self.uploader._skip_deletion('user_add')
+        assert self.uploader.skipped_deletions == 2
 
     def test_add_command(self):
         cmd = tool.Command(
@@ -772,6 +859,392 @@ class TestIpaUploader(TestIpaConnectorBase):
         assert self.uploader.errs == [
             'Error executing invalid x (): Non-existent command invalid']
 
+    @mock.patch('ipamanager.governor.time.sleep')
+    def test_push_retry(self, mock_sleep):
+        class DatabaseError(Exception):
+            pass
+        self._create_uploader(force=True, threshold=15)
+        results = [DatabaseError('Server is busy'), {'summary': u'Deleted "x"'}]
+
+        def user_del(**kwargs):
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        tool.api.Command.__getitem__.side_effect = {'user_del': user_del}.get
+        self.uploader.commands = [tool.Command('user_del', {}, 'x', 'uid')]
+        with mock.patch('%s.load_ipa_entities' % up_class):
+            with mock.patch('%s._prepare_push' % up_class):
+                with mock.patch('%s._check_threshold' % up_class):
+                    with LogCapture('ExecutionGovernor') as log:
+                        self.uploader.push()
+        assert self.uploader.errs == []
+        assert mock_sleep.call_count == 1
+        log.check_present(('ExecutionGovernor', 'INFO', mock.ANY))
+
+    def test_push_rpc(self):
+        self._create_uploader(force=True, threshold=15)
+        assert self.uploader.rpc_client is None
+        self.uploader.rpc_client = mock.Mock()
+        self.uploader.rpc_client.execute.return_value = ['Error executing x']
+        self.uploader.commands = self._large_commands()
+        tool.api.Command.__getitem__.reset_mock()
+        with mock.patch('%s.load_ipa_entities' % up_class):
+            with mock.patch('%s._prepare_push' % up_class):
+                with mock.patch('%s._check_threshold' % up_class):
+                    with pytest.raises(tool.ManagerError) as exc:
+                        self.uploader.push()
+        assert exc.value[0] == 'There were 1 errors executing update'
+        self.uploader.rpc_client.execute.assert_called_with(
+            self.uploader.commands)
+        assert self.uploader.errs == ['Error executing x']
+        tool.api.Command.__getitem__.assert_not_called()
+
+    def test_rpc_client_settings(self):
+        with open(SETTINGS) as settings_file:
+            settings = yaml.safe_load(settings_file)
+        settings['rpc'] = {'url': 'https://ipa.example.com', 'workers': 8}
+        uploader = tool.IpaUploader(settings, {}, 10)
+        assert isinstance(uploader.rpc_client, tool.IpaRpcClient)
+        assert uploader.rpc_client.workers == 8
+
+    def _create_state_uploader(self, **args):
+        self._create_uploader(**args)
+        self.uploader.state_file = os.path.join(self.state_dir, 'state.json')
+        self.uploader.repo_entities = {'group': {
+            'group-one': entities.FreeIPAUserGroup('group-one', {}, 'path')}}
+        tool.api.Command.__getitem__.side_effect = self._api_call
+
+    def _push_state(self):
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            with mock.patch('%s.load_ipa_entities' % up_class) as mock_load:
+                with mock.patch('%s._prepare_push' % up_class):
+                    self.uploader.push()
+        return log, mock_load
+
+    def test_push_state(self):
+        self.state_dir = tempfile.mkdtemp()
+        try:
+            self._create_state_uploader(force=True)
+            self.uploader.commands = []
+            log, mock_load = self._push_state()
+            mock_load.assert_called_with()
+            with open(self.uploader.state_file) as src:
+                saved = json.load(src)
+            assert sorted(saved) == ['remote', 'repository', 'time']
+            assert saved['remote']['user'][0] == 1
+            # second push skips loading of FreeIPA entities
+            self._create_state_uploader(force=True)
+            log, mock_load = self._push_state()
+            mock_load.assert_not_called()
+            log.check(('IpaUploader', 'INFO', 'Neither config nor FreeIPA '
+                       'changed since last push, nothing to do'))
+        finally:
+            shutil.rmtree(self.state_dir)
+
+    def test_push_state_changes(self):
+        self.state_dir = tempfile.mkdtemp()
+        try:
+            self._create_state_uploader(force=True)
+            self.uploader.commands = []
+            self._push_state()
+            # config change
+            self._create_state_uploader(force=True)
+            self.uploader.repo_entities['group']['group-one'] = \
+                entities.FreeIPAUserGroup(
+                    'group-one', {'description': 'changed'}, 'path')
+            self.uploader.commands = []
+            log, mock_load = self._push_state()
+            mock_load.assert_called_with()
+            # FreeIPA drift
+            self._create_state_uploader(force=True)
+            self.uploader.repo_entities['group']['group-one'] = \
+                entities.FreeIPAUserGroup(
+                    'group-one', {'description': 'changed'}, 'path')
+            self._api_user_find = lambda **kwargs: {'result': [
+                {'uid': ('user.one',)}, {'uid': ('user.two',)}]}
+            log, mock_load = self._push_state()
+            mock_load.assert_called_with()
+            log.check_present(('IpaUploader', 'INFO',
+                               'FreeIPA changed since last push, '
+                               'running full push'))
+        finally:
+            shutil.rmtree(self.state_dir)
+
+    def test_push_state_max_age(self):
+        self.state_dir = tempfile.mkdtemp()
+        try:
+            self._create_state_uploader()
+            self.uploader.commands = []
+            self._push_state()
+            self._create_state_uploader()
+            self.uploader.state_max_age = -1
+            log, mock_load = self._push_state()
+            mock_load.assert_called_with()
+            log.check_present(('IpaUploader', 'INFO',
+                               'Push state older than -1 seconds, '
+                               'running full push'))
+        finally:
+            shutil.rmtree(self.state_dir)
+
+    def test_push_state_not_saved_dry_run(self):
+        self.state_dir = tempfile.mkdtemp()
+        try:
+            self._create_state_uploader()
+            self.uploader.commands = self._large_commands()
+            with mock.patch('%s._check_threshold' % up_class):
+                self._push_state()
+            assert not os.path.exists(self.uploader.state_file)
+        finally:
+            shutil.rmtree(self.state_dir)
+
+    def test_push_state_saved_after_changes(self):
+        self.state_dir = tempfile.mkdtemp()
+        try:
+            self._create_state_uploader(force=True)
+            self.uploader.commands = self._large_commands()
+            with LogCapture():
+                with mock.patch('%s._check_threshold' % up_class):
+                    with mock.patch('%s._remote_indicators' % up_class,
+                                    return_value={}) as mock_indicators:
+                        self._push_state()
+            # indicators are collected before & after executing commands
+            # (after only for the types the commands changed)
+            assert mock_indicators.call_count == 2
+            assert mock_indicators.call_args == mock.call(types={
+                'user', 'group', 'hostgroup', 'hbacrule', 'sudorule'})
+            assert os.path.exists(self.uploader.state_file)
+        finally:
+            shutil.rmtree(self.state_dir)
+
+    def test_remote_indicators_error(self):
+        tool.api.Command.__getitem__.side_effect = self._api_call_find_fail
+        with pytest.raises(tool.ManagerError) as exc:
+            self.uploader._remote_indicators()
+        assert exc.value[0].startswith('Error loading')
+
+    def test_remote_indicators(self):
+        tool.api.Command.__getitem__.side_effect = self._api_call
+        users = [
+            {'uid': (u'user.one',), 'title': (u'Boss',),
+             'memberof_group': (u'group-one', u'group-two'),
+             'modifytimestamp': (u'20200101000000Z',)},
+            {'uid': (u'user.two',), 'modifytimestamp': (u'20200102000000Z',)}]
+        self._api_user_find = lambda **kwargs: {'result': users}
+        indicators = self.uploader._remote_indicators()
+        assert indicators['user'][0] == 2
+        assert indicators['user'][2] == u'20200102000000Z'
+        # order of values does not matter
+        users[0]['memberof_group'] = (u'group-two', u'group-one')
+        assert self.uploader._remote_indicators() == indicators
+        # attribute & membership changes do (even without timestamps)
+        for key, value in (('title', (u'Intern',)),
+                           ('memberof_group', (u'group-one',))):
+            changed = dict(users[0], **{key: value})
+            self._api_user_find = lambda **kwargs: {
+                'result': [changed, users[1]]}
+            assert self.uploader._remote_indicators()['user'][1] != (
+                indicators['user'][1])
+
+    def test_remote_indicators_keep(self):
+        tool.api.Command.__getitem__.side_effect = self._api_call
+        calls = []
+        self._api_user_find = lambda **kwargs: calls.append(kwargs) or {
+            'result': [{'uid': (u'user.one',)}]}
+        with LogCapture():
+            self.uploader._current_state()
+            # data loaded for the state check are reused once
+            self.uploader.load_ipa_entities()
+            assert self.uploader.ipa_entities['user'].keys() == ['user.one']
+            assert calls == [{'all': True, 'sizelimit': 0}]
+            self.uploader.load_ipa_entities()
+            assert len(calls) == 2
+            # indicators collected after the push are not kept
+            self.uploader._remote_indicators()
+            self.uploader.load_ipa_entities()
+        assert len(calls) == 4
+
+    def test_affected_types(self):
+        self.uploader.commands = [
+            tool.Command('user_mod', {'title': u'Boss'}, 'user1', 'uid'),
+            tool.Command('hbacrule_add_user', {'group': u'group1'},
+                         'rule1', 'cn'),
+            tool.Command('role_add_privilege', {'privilege': u'priv1'},
+                         'role1', 'cn')]
+        assert self.uploader._affected_types() == {
+            'user', 'hbacrule', 'group', 'role', 'privilege'}
+
+    def test_remote_indicators_types(self):
+        tool.api.Command.__getitem__.side_effect = self._api_call
+        indicators = self.uploader._remote_indicators(types={'user'})
+        assert indicators.keys() == ['user']
+
+    def test_current_state_yaml_date(self):
+        group = entities.FreeIPAUserGroup('group1', {}, 'path')
+        # e.g., an unquoted date in YAML parsed by an unvalidated loader
+        group.data_repo['description'] = datetime.date(2020, 1, 1)
+        self.uploader.repo_entities = {'group': {'group1': group}}
+        with mock.patch('%s._remote_indicators' % up_class, return_value={}):
+            state = self.uploader._current_state()
+        assert len(state['repository']) == 64
+
+    def test_push_state_max_age_default(self):
+        with open(SETTINGS) as settings_file:
+            settings = yaml.safe_load(settings_file)
+        settings['push-state-file'] = '/tmp/state.json'
+        assert tool.IpaUploader(settings, {}, 10).state_max_age == 86400
+        settings['push-state-max-age'] = 60
+        assert tool.IpaUploader(settings, {}, 10).state_max_age == 60
+
+    def _api_show(self, command):
+        remote = {
+            'group-one': {'cn': (u'group-one',),
+                          'objectclass': (u'posixgroup',),
+                          'memberof_group': (u'group-three',)},
+            'group-three': {'cn': (u'group-three',),
+                            'member_group': (u'group-one',)},
+            'group-old': {'cn': (u'group-old',)}}
+
+        def _func(cn, all):
+            if command != 'group_show':
+                raise KeyError(command)
+            self.shown.append(cn)
+            if cn not in remote:
+                raise NotFound('%s: group not found' % cn)
+            return {'result': remote[cn]}
+        return _func
+
+    def _create_targeted_uploader(self, **args):
+        group_one = entities.FreeIPAUserGroup(
+            'group-one', {'memberOf': {'group': ['group-two']}}, 'path')
+        self._create_uploader(parsed={'group': {
+            'group-one': group_one,
+            'group-two': entities.FreeIPAUserGroup('group-two', {}, 'path')
+        }}, **args)
+        self.shown = []
+        tool.api.Command.__getitem__.side_effect = self._api_show
+        return group_one
+
+    def test_load_ipa_entities_targeted(self):
+        group_one = self._create_targeted_uploader()
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            self.uploader.load_ipa_entities_targeted(
+                [group_one], [('group', 'group-old')])
+        assert self.shown == [
+            'group-old', 'group-one', 'group-three', 'group-two']
+        assert sorted(self.uploader.ipa_entities['group']) == [
+            'group-old', 'group-one', 'group-three']
+        assert self.uploader.ipa_entities['hostgroup'] == {}
+        assert self.uploader.ipa_entity_count == 2
+        log.check(('IpaUploader', 'INFO',
+                   'Loading 1 changed & 1 removed entities from FreeIPA'),
+                  ('IpaUploader', 'INFO',
+                   'Loaded 3 entities from FreeIPA API'))
+
+    def test_load_ipa_entities_targeted_ignored(self):
+        group_one = self._create_targeted_uploader()
+        self.uploader.ignored['group'] = ['group-t.+']
+        with LogCapture():
+            self.uploader.load_ipa_entities_targeted([group_one], [])
+        assert self.shown == ['group-one']
+
+    def test_load_ipa_entities_targeted_error(self):
+        group_one = self._create_targeted_uploader()
+        tool.api.Command.__getitem__.side_effect = self._api_call_find_fail
+        with pytest.raises(tool.ManagerError) as exc:
+            with LogCapture():
+                self.uploader.load_ipa_entities_targeted([group_one], [])
+        assert exc.value[0] == 'Undefined API command group_show'
+
+    def test_push_targeted(self):
+        group_one = self._create_targeted_uploader(
+            threshold=100, enable_deletion=True)
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            self.uploader.push(([group_one], [('group', 'group-old'),
+                                              ('group', 'group-gone')]))
+        assert sorted(repr(i) for i in self.uploader.commands) == [
+            'group_add_member group-two (group=group-one)',
+            'group_del group-old ()',
+            'group_remove_member group-three (group=group-one)']
+        log.check_present(('IpaUploader', 'INFO', '3 commands to execute'))
+
+    def test_push_targeted_no_deletion(self):
+        group_one = self._create_targeted_uploader(threshold=100)
+        self.uploader.state_file = '/nonexistent/state.json'
+        with LogCapture():
+            with mock.patch('%s._current_state' % up_class) as mock_state:
+                self.uploader.push(([group_one], [('group', 'group-old')]))
+        mock_state.assert_not_called()
+        assert sorted(repr(i) for i in self.uploader.commands) == [
+            'group_add_member group-two (group=group-one)']
+
+    def _repo_state(self):
+        return {
+            'group': {
+                'group-one': entities.FreeIPAUserGroup(
+                    'group-one', {'memberOf': {'group': ['group-two']}},
+                    'path'),
+                'group-two': entities.FreeIPAUserGroup(
+                    'group-two', {'description': 'Two', 'posix': False},
+                    'path')},
+            'hbacrule': {
+                'rule-one': entities.FreeIPAHBACRule(
+                    'rule-one', {'memberUser': ['group-two'],
+                                 'memberHost': ['hosts']}, 'path')}}
+
+    def test_load_ipa_entities_from_repo(self):
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            self.uploader.load_ipa_entities_from_repo(self._repo_state())
+        group_one = self.uploader.ipa_entities['group']['group-one']
+        group_two = self.uploader.ipa_entities['group']['group-two']
+        rule = self.uploader.ipa_entities['hbacrule']['rule-one']
+        assert group_one.path is None
+        assert group_one.posix and not group_two.posix
+        assert group_two.data_ipa['member_group'] == (u'group-one',)
+        assert rule.data_ipa['memberuser_group'] == (u'group-two',)
+        assert rule.data_ipa['memberhost_hostgroup'] == (u'hosts',)
+        assert self.uploader.ipa_entities['user'] == {}
+        assert self.uploader.ipa_entity_count == 3
+        log.check(('IpaUploader', 'INFO',
+                   'Loading FreeIPA entities from repository state'),
+                  ('IpaUploader', 'INFO',
+                   'Loaded 3 entities from repository state'))
+
+    def test_plan(self):
+        self.uploader.repo_entities = self._repo_state()
+        self.uploader.repo_entities['group']['group-one'] = \
+            entities.FreeIPAUserGroup('group-one', {}, 'path')
+        with LogCapture():
+            commands = self.uploader.plan(self._repo_state())
+        assert [repr(i) for i in commands] == []
+        self.uploader.enable_deletion = True
+        with LogCapture():
+            commands = self.uploader.plan(self._repo_state())
+        assert [repr(i) for i in commands] == [
+            'group_remove_member group-two (group=group-one)']
+
+    def test_ipa_memberships(self):
+        self.uploader.load_ipa_entities_from_repo(self._repo_state())
+        assert self.uploader._ipa_memberships() == {
+            ('group', 'group-one'): {('group', 'group-two')}}
+        index = self.uploader._ipa_memberships()
+        assert self.uploader._ipa_memberships() is index
+        # loading entities resets the index, also when loaded in place
+        ipa_entities = self.uploader.ipa_entities
+        tool.api.Command.__getitem__.side_effect = self._api_call
+        with LogCapture():
+            self.uploader.load_ipa_entities()
+        assert self.uploader.ipa_entities is ipa_entities
+        assert self.uploader._ipa_memberships() == {}
+        self.uploader.load_ipa_entities_from_repo(self._repo_state())
+        assert self.uploader._ipa_memberships() == index
+
+    def test_plan_same_state(self):
+        self.uploader.repo_entities = self._repo_state()
+        self.uploader.enable_deletion = True
+        with LogCapture():
+            assert self.uploader.plan(self._repo_state()) == []
+
     def _api_call_unreliable(self, command):
         try:
             return {
@@ -98,12 +98,24 @@ class TestOktaLoader(object):
                 "Users loaded from Okta: .+")),
             ('OktaLoader', 'INFO', '2 users loaded from Okta'))
 
-    def test_load_group_filter(self):
-        self.loader.settings['okta']['user_group_filter'] = ['commongroup2']
-        self.loader._get_okta_api_pages = mock.Mock()
+    def _mock_filter_pages(self, url, params=None):
         with open(os.path.join(testpath, 'okta/users.json')) as resp_users_fh:
             resp_users = json.load(resp_users_fh)
-            self.loader._get_okta_api_pages.return_value = resp_users
+        base = 'https://testoktaorg.okta.com/api/v1'
+        if url == '%s/groups' % base:
+            return [{'id': '00g1', 'profile': {'name': 'commongroup1'}},
+                    {'id': '00g2', 'profile': {'name': 'commongroup2'}}]
+        elif url == '%s/groups/00g2/users' % base:
+            return [resp_users[1]]
+        elif url == '%s/users' % base and params == {
+                'search': 'profile.employeeNumber eq "123"'}:
+            return [resp_users[0]]
+        raise AssertionError('Unexpected Okta request %s %s' % (url, params))
+
+    def test_load_group_filter(self):
+        self.loader.settings['okta']['user_group_filter'] = ['commongroup2']
+        self.loader._get_okta_api_pages = mock.Mock(
+            side_effect=self._mock_filter_pages)
         self.loader._user_groups = self._mock_groups
 
         with LogCapture() as log:
@@ -111,25 +123,70 @@ class TestOktaLoader(object):
 
         assert len(users) == 1
         assert users.keys() == [u'other.user']
+        assert users[u'other.user'].data_repo == {
+            'firstName': u'Other', 'lastName': u'User',
+            'memberOf': {'group': ['commongroup2']},
+            'disabled': True, 'manager': u'some.user'}
+        # only the filter group members were downloaded
+        assert [i[0][0] for i in
+                self.loader._get_okta_api_pages.call_args_list] == [
+            'https://testoktaorg.okta.com/api/v1/groups',
+            'https://testoktaorg.okta.com/api/v1/groups/00g2/users',
+            'https://testoktaorg.okta.com/api/v1/users']
 
         log.check(
             ('OktaLoader', 'INFO', 'Loading users from Okta'),
-            ('OktaLoader',
-             'DEBUG',
-             u'User some.user is ACTIVE in Okta, setting as active user'),
-            ('OktaLoader', 'INFO', u'User some.user has no group from filter, skipping'),
+            ('OktaLoader', 'DEBUG', 'Reading members of Okta group commongroup2'),
+            ('OktaLoader', 'DEBUG', '1 users found in filter groups'),
             ('OktaLoader',
              'DEBUG',
              u'User other.user is SUSPENDED in Okta, setting as disabled'),
-            ('OktaLoader',
-             'WARNING',
-             u'User different.user@otherdomain.com does not match UID regex "(.+)@devgdc.com", skipping'),
-            ('OktaLoader',
-             'DEBUG',
-             u'User terminated.user is DEPROVISIONED in Okta, not creating'),
             ('OktaLoader', 'DEBUG', "Users loaded from Okta: [u'other.user']"),
             ('OktaLoader', 'INFO', '1 users loaded from Okta'))
 
+    def test_load_group_filter_no_group_match(self):
+        self.loader.settings['okta']['user_group_filter'] = ['commongroup2']
+        self.loader._get_okta_api_pages = mock.Mock(
+            side_effect=self._mock_filter_pages)
+        self.loader._user_groups = lambda user: ['oktagroup3']
+
+        with LogCapture():
+            users = self.loader.load()
+
+        assert users == {}
+
+    def test_parse_manager_cached(self):
+        self.loader.filtered = True
+        self.loader._get_okta_api_pages = mock.Mock(side_effect=[
+            [{'profile': {'login': 'boss@devgdc.com'}}], []])
+        users = [{'profile': {'managerId': i}} for i in ('12', '12', 'x"y')]
+        with LogCapture() as log:
+            managers = [self.loader._parse_manager(
+                'user%d' % i, user, '(.+)@devgdc.com')
+                for i, user in enumerate(users + users)]
+        assert managers == ['boss', 'boss', None] * 2
+        # one search per manager, misses included
+        assert self.loader._get_okta_api_pages.call_args_list == [
+            mock.call('https://testoktaorg.okta.com/api/v1/users',
+                      params={'search': 'profile.employeeNumber eq "12"'}),
+            mock.call('https://testoktaorg.okta.com/api/v1/users',
+                      params={'search': 'profile.employeeNumber eq "x\\"y"'})]
+        log.check_present(
+            ('OktaLoader', 'WARNING', 'User user5 manager (ID x"y) not found'))
+
+    def test_load_groups_cached(self):
+        self.loader._get_okta_api_pages = mock.Mock(
+            side_effect=self._mock_filter_pages)
+        self.loader.settings['okta']['user_group_filter'] = ['commongroup2']
+        self.loader._user_groups = self._mock_groups
+        with LogCapture():
+            self.loader.load()
+            groups = self.loader.load_groups()
+        assert set(groups) == {'commongroup1', 'commongroup2'}
+        assert [i[0][0] for i in
+                self.loader._get_okta_api_pages.call_args_list].count(
+            'https://testoktaorg.okta.com/api/v1/groups') == 1
+
     def test_load_groups(self):
         self.loader._get_okta_api_pages = mock.Mock()
         with open(os.path.join(testpath, 'okta/groups.json')) as resp_groups_fh:
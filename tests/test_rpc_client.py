@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import BaseHTTPServer
+import json
+import mock
+import pytest
+import SocketServer
+import sys
+import tempfile
+import threading
+import urlparse
+from requests.packages.urllib3.exceptions import (
+    MaxRetryError, NewConnectionError, ProtocolError)
+from testfixtures import LogCapture
+
+from _utils import _import
+sys.modules['ipalib'] = mock.Mock()
+tool = _import('ipamanager', 'rpc_client')
+command = _import('ipamanager', 'command')
+modulename = 'ipamanager.rpc_client'
+
+
+class _IpaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in of the FreeIPA session login & JSON-RPC endpoints.
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with server.lock:
+            server.connections.add(self.client_address)
+        if self.path == '/ipa/session/login_password':
+            form = dict(urlparse.parse_qsl(body))
+            if form != {'user': 'admin', 'password': 'secret'}:
+                return self._respond(401, '')
+            with server.lock:
+                server.sessions += 1
+                session = 'session%d' % server.sessions
+            return self._respond(200, '', {
+                'Set-Cookie': 'ipa_session=%s; Path=/ipa' % session})
+        cookie = self.headers.get('Cookie', '')
+        if not all([self.path == '/ipa/session/json',
+                    cookie == 'ipa_session=session%d' % server.sessions,
+                    self.headers.get('Referer', '').endswith('/ipa')]):
+            return self._respond(401, '')
+        request = json.loads(body)
+        method, options = request['method'], request['params'][1]
+        with server.lock:
+            server.calls.append((method, options))
+        if method == 'invalid_cmd':
+            response = {'result': None, 'error': {
+                'code': 905, 'name': 'CommandError',
+                'message': 'unknown command \'invalid_cmd\''}}
+        elif method == 'busy_cmd':
+            response = {'result': None, 'error': {
+                'code': 4203, 'name': 'DatabaseError',
+                'message': 'Server is busy'}}
+        elif method == 'flaky_cmd' and server.calls.count(
+                (method, options)) == 1:
+            return self._respond(503, '')
+        elif method.endswith('_add_member'):
+            response = {'result': {'completed': 0, 'failed': {'member': {
+                'user': [['user1', 'no such entry']]}}}, 'error': None}
+        else:
+            response = {'result': {
+                'summary': 'Done %s' % method, 'result': {}}, 'error': None}
+        response['id'] = request['id']
+        self._respond(200, json.dumps(response))
+
+    def _respond(self, status, body, headers={}):
+        self.send_response(status)
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _IpaServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestIpaRpcClient(object):
+    def setup_method(self, method):
+        self.server = _IpaServer(('127.0.0.1', 0), _IpaHandler)
+        self.server.lock = threading.Lock()
+        self.server.connections = set()
+        self.server.sessions = 0
+        self.server.calls = []
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.password = tempfile.NamedTemporaryFile()
+        self.password.write('secret\n')
+        self.password.flush()
+
+    def teardown_method(self, method):
+        self.server.shutdown()
+        self.server.server_close()
+        self.password.close()
+
+    def _client(self, **rpc_settings):
+        settings = {
+            'url': 'http://127.0.0.1:%d/' % self.server.server_address[1],
+            'user': 'admin', 'password_path': self.password.name}
+        settings.update(rpc_settings)
+        return tool.IpaRpcClient({'rpc': settings})
+
+    def test_call(self):
+        client = self._client()
+        assert client.Command['user_show'](uid=u'user1', all=True) == {
+            'summary': 'Done user_show', 'result': {}}
+        assert self.server.calls == [
+            ('user_show', {'uid': 'user1', 'all': True})]
+        assert self.server.sessions == 1
+
+    def test_call_error(self):
+        client = self._client()
+        with pytest.raises(tool.CommandError) as exc:
+            client.call('invalid_cmd')
+        assert exc.value[0] == (
+            "CommandError: unknown command 'invalid_cmd'")
+
+    def test_call_transient(self):
+        client = self._client()
+        with pytest.raises(tool.RetryableCommandError) as exc:
+            client.call('busy_cmd')
+        assert exc.value[0] == 'DatabaseError: Server is busy'
+        with pytest.raises(tool.RetryableCommandError) as exc:
+            client.call('flaky_cmd')
+        assert exc.value[0] == 'HTTP 503'
+        assert client.call('flaky_cmd') == {
+            'summary': 'Done flaky_cmd', 'result': {}}
+
+    def test_call_timeout(self):
+        client = self._client()
+        client.login()
+        with mock.patch.object(client.session, 'post') as mock_post:
+            mock_post.side_effect = tool.requests.ReadTimeout(
+                'read timed out')
+            with pytest.raises(tool.CommandError) as exc:
+                client.call('user_show')
+        # the server may have applied the command, so it is not retried
+        assert not isinstance(exc.value, tool.RetryableCommandError)
+        assert exc.value[0] == 'Error communicating with API: read timed out'
+        assert mock_post.call_args[1]['timeout'] == 60
+
+    def test_call_connection_error(self):
+        client = self._client()
+        client.login()
+        refused = tool.requests.ConnectionError(MaxRetryError(
+            None, '/ipa/session/json', NewConnectionError(None, 'refused')))
+        reset = tool.requests.ConnectionError(
+            ProtocolError('Connection aborted.'))
+        with mock.patch.object(client.session, 'post') as mock_post:
+            mock_post.side_effect = tool.requests.ConnectTimeout(
+                'connect timed out')
+            with pytest.raises(tool.RetryableCommandError):
+                client.call('user_add')
+            mock_post.side_effect = refused
+            with pytest.raises(tool.RetryableCommandError):
+                client.call('user_add')
+            mock_post.side_effect = reset
+            with pytest.raises(tool.CommandError) as exc:
+                client.call('user_add')
+        assert not isinstance(exc.value, tool.RetryableCommandError)
+
+    def test_call_session_expired(self):
+        client = self._client()
+        client.call('user_show', uid='user1')
+        self.server.sessions += 1  # invalidate the session cookie
+        client.call('user_show', uid='user1')
+        assert self.server.sessions == 3
+        assert len(self.server.calls) == 2
+
+    def test_login_invalid(self):
+        with pytest.raises(tool.ManagerError) as exc:
+            self._client(user='nobody').login()
+        assert exc.value[0] == 'Error logging in to %s: HTTP 401' % (
+            'http://127.0.0.1:%d' % self.server.server_address[1])
+
+    def test_login_password_missing(self):
+        with pytest.raises(tool.ManagerError) as exc:
+            self._client(password_path='/nonexistent').login()
+        assert exc.value[0] == (
+            "Cannot read API password: [Errno 2] No such file or directory: "
+            "'/nonexistent'")
+
+    @mock.patch('%s.HTTPKerberosAuth' % modulename, None)
+    def test_login_kerberos_unavailable(self):
+        with pytest.raises(tool.ManagerError) as exc:
+            self._client(user=None).login()
+        assert exc.value[0] == (
+            'Kerberos login requires the requests-kerberos package')
+
+    def test_execute(self):
+        commands = [
+            command.Command('group_del', {}, 'group0', 'cn'),
+            command.Command('group_add_member', {'user': ('user1',)},
+                            'group1', 'cn')]
+        for i in range(20):
+            commands.append(command.Command(
+                'user_add', {'givenname': 'User', 'sn': str(i)},
+                'user%d' % i, 'uid'))
+            commands.append(command.Command(
+                'user_mod', {'title': 'Title'}, 'user%d' % i, 'uid'))
+        client = self._client(workers=3)
+        with LogCapture() as log:
+            errs = client.execute(commands)
+        assert errs == [
+            'Error executing group_add_member group1 (user=user1): '
+            'Error executing group_add_member: '
+            "[u'- user1: no such entry']"]
+        log.check_present(('IpaRpcClient', 'ERROR', errs[0]))
+        methods = [method for method, _ in self.server.calls]
+        # all commands of a rank are executed before the next rank
+        assert sorted(methods[:20]) == ['user_add'] * 20
+        assert methods[20] == 'group_add_member'
+        assert sorted(methods[21:41]) == ['user_mod'] * 20
+        assert methods[41] == 'group_del'
+        # session & keep-alive connections reused by workers
+        assert self.server.sessions == 1
+        assert len(self.server.connections) <= 3
+        # concurrency increased up to the number of workers
+        assert client.governor.concurrency == 3
+        log.check_present(('ExecutionGovernor', 'INFO', mock.ANY))
+
+    def test_execute_retry(self):
+        commands = [command.Command('flaky_cmd', {}, 'x', 'cn'),
+                    command.Command('busy_cmd', {}, 'y', 'cn')]
+        client = self._client()
+        client.governor.backoff = 0
+        client.governor.concurrency = 2
+        with LogCapture() as log:
+            errs = client.execute(commands)
+        assert errs == [
+            'Error executing busy_cmd y (): Error executing busy_cmd: '
+            'DatabaseError: Server is busy']
+        assert [method for method, _ in self.server.calls].count(
+            'flaky_cmd') == 2
+        assert client.governor.stats['retries'] == 4
+        # transient errors in the wave made the governor back off
+        assert client.governor.concurrency == 1
+        log.check_present(('IpaRpcClient', 'ERROR', errs[0]))
+
+    def test_execute_login_error(self):
+        client = self._client(user='nobody')
+        with pytest.raises(tool.ManagerError):
+            client.execute([command.Command('user_del', {}, 'user1', 'uid')])
+        assert self.server.calls == []
+
+    def test_execute_same_entity_order(self):
+        commands = [
+            command.Command('sudorule_add_option', {'ipasudoopt': 'opt%d' % i},
+                            'rule1', 'cn') for i in range(10)]
+        client = self._client(workers=4)
+        with LogCapture():
+            assert client.execute(commands) == []
+        assert [options['ipasudoopt'] for _, options in self.server.calls] == [
+            'opt%d' % i for i in range(10)]
+
+    def test_settings_default(self):
+        client = tool.IpaRpcClient({'rpc': {'url': 'https://ipa.example.com'}})
+        assert client.workers == 4
+        assert client.session.verify is True
+        assert client.session.headers['Referer'] == (
+            'https://ipa.example.com/ipa')
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import logging
+import mock
+import os
+import pytest
+import yaml
+from testfixtures import LogCapture
+
+import ipamanager.tools.fake_ipa as tool
+from ipamanager.config_loader import ConfigLoader
+from ipamanager.errors import ManagerError
+from ipamanager.integrity_checker import IntegrityChecker
+from ipamanager.ipa_connector import IpaDownloader, IpaUploader
+
+modulename = 'ipamanager.tools.fake_ipa'
+testdir = os.path.dirname(os.path.dirname(__file__))
+CONFIG_CORRECT = os.path.join(testdir, 'freeipa-manager-config/correct')
+SETTINGS = os.path.join(testdir, 'freeipa-manager-config/settings.yaml')
+
+
+class TestFakeIpa(object):
+    def setup_method(self, method):
+        self.api = tool.FakeIpa()
+        self.api.Command['user_add'](
+            uid=u'user1', givenname=(u'First',), sn=(u'Last',))
+        self.api.Command['group_add'](cn=u'group1', description=(u'Group',))
+
+    def test_find(self):
+        self.api.Command['user_add'](uid=u'user2', givenname=u'Second')
+        result = self.api.Command['user_find'](all=True, sizelimit=0)
+        assert result['count'] == 2
+        assert not result['truncated']
+        assert result['result'][0]['givenname'] == (u'First',)
+        assert self.api.Command['user_find'](pkey_only=True, sizelimit=1) == {
+            'result': ({'uid': (u'user1',)},), 'count': 1, 'truncated': True,
+            'summary': u'1 users matched'}
+
+    def test_find_criteria(self):
+        with pytest.raises(TypeError) as exc:
+            self.api.Command['user_find'](uid=u'user2', all=True)
+        assert exc.value[0] == 'Unsupported user_find criteria: uid'
+
+    def test_show(self):
+        result = self.api.Command['group_show'](cn=u'group1', all=True)
+        assert result['result']['description'] == (u'Group',)
+        assert u'posixgroup' in result['result']['objectclass']
+        assert result['result']['modifytimestamp'] == (u'20200101000002Z',)
+        with pytest.raises(tool.NotFound) as exc:
+            self.api.Command['group_show'](cn=u'group2')
+        assert exc.value[0] == 'group2: group not found'
+
+    def test_unknown_command(self):
+        with pytest.raises(KeyError):
+            self.api.Command['user_frobnicate']
+        with pytest.raises(KeyError):
+            self.api.Command['gadget_add']
+
+    def test_add_duplicate(self):
+        with pytest.raises(tool.DuplicateEntry) as exc:
+            self.api.Command['user_add'](uid=u'user1')
+        assert exc.value[0] == 'user with name "user1" already exists'
+
+    def test_add_nonposix(self):
+        self.api.Command['group_add'](cn=u'group2', nonposix=True)
+        group = self.api.entities['group']['group2']
+        assert u'posixgroup' not in group['objectclass']
+        assert 'gidnumber' not in group
+
+    def test_mod(self):
+        assert self.api.Command['user_mod'](
+            uid=u'user1', title=(u'Boss',), sn=())['summary'] == (
+                u'Modified user "user1"')
+        user = self.api.entities['user']['user1']
+        assert user['title'] == (u'Boss',)
+        assert 'sn' not in user
+        self.api.Command['user_mod'](
+            uid=u'user1', addattr=(u'mail=a@x.com', u'mail=b@x.com'))
+        self.api.Command['user_mod'](uid=u'user1', delattr=u'mail=a@x.com')
+        assert user['mail'] == (u'b@x.com',)
+        self.api.Command['user_mod'](uid=u'user1', setattr=u'mail=')
+        assert 'mail' not in user
+
+    def test_mod_empty(self):
+        with pytest.raises(tool.EmptyModlist):
+            self.api.Command['user_mod'](uid=u'user1', givenname=(u'First',))
+
+    def test_mod_posix(self):
+        self.api.Command['group_add'](cn=u'group2', nonposix=True)
+        self.api.Command['group_mod'](cn=u'group2', posix=True)
+        assert self.api.entities['group']['group2']['gidnumber'] == (
+            u'10002',)
+
+    def test_members(self):
+        result = self.api.Command['group_add_member'](
+            cn=u'group1', user=(u'user1', u'user2'))
+        assert result['completed'] == 1
+        assert result['failed'] == {
+            'member': {'user': ((u'user2', u'no such entry'),)}}
+        assert 'summary' not in result
+        assert self.api.entities['group']['group1']['member_user'] == (
+            u'user1',)
+        assert self.api.entities['user']['user1']['memberof_group'] == (
+            u'group1',)
+        result = self.api.Command['group_remove_member'](
+            cn=u'group1', user=u'user1')
+        assert result['completed'] == 1
+        assert 'member_user' not in self.api.entities['group']['group1']
+        assert 'memberof_group' not in self.api.entities['user']['user1']
+
+    def test_members_already(self):
+        self.api.Command['group_add_member'](cn=u'group1', user=u'user1')
+        result = self.api.Command['group_add_member'](
+            cn=u'group1', user=u'user1')
+        assert result['failed']['member']['user'] == (
+            (u'user1', u'This entry is already a member'),)
+
+    def test_del(self):
+        self.api.Command['group_add_member'](cn=u'group1', user=u'user1')
+        self.api.Command['hbacrule_add'](cn=u'rule1')
+        self.api.Command['hbacrule_add_user'](cn=u'rule1', group=u'group1')
+        self.api.Command['group_del'](cn=u'group1')
+        assert 'memberof_group' not in self.api.entities['user']['user1']
+        assert 'memberuser_group' not in self.api.entities[
+            'hbacrule']['rule1']
+
+    def test_rule_members(self):
+        self.api.Command['hostgroup_add'](cn=u'hosts1')
+        self.api.Command['sudorule_add'](cn=u'rule1')
+        result = self.api.Command['sudorule_add_host'](
+            cn=u'rule1', hostgroup=u'hosts1')
+        assert result['failed'] == {'memberhost': {'hostgroup': ()}}
+        result = self.api.Command['sudorule_add_user'](
+            cn=u'rule1', group=u'group2')
+        assert result['failed'] == {
+            'memberuser': {'group': ((u'group2', u'no such entry'),)}}
+        assert self.api.entities['sudorule']['rule1'][
+            'memberhost_hostgroup'] == (u'hosts1',)
+        self.api.Command['sudorule_remove_host'](
+            cn=u'rule1', hostgroup=u'hosts1')
+        assert 'memberhost_hostgroup' not in self.api.entities[
+            'sudorule']['rule1']
+
+    def test_sudo_options(self):
+        self.api.Command['sudorule_add'](cn=u'rule1')
+        self.api.Command['sudorule_add_option'](
+            cn=u'rule1', ipasudoopt=[u'!authenticate'])
+        assert self.api.entities['sudorule']['rule1']['ipasudoopt'] == (
+            u'!authenticate',)
+        with pytest.raises(tool.DuplicateEntry):
+            self.api.Command['sudorule_add_option'](
+                cn=u'rule1', ipasudoopt=[u'!authenticate'])
+        self.api.Command['sudorule_remove_option'](
+            cn=u'rule1', ipasudoopt=[u'!authenticate'])
+        assert 'ipasudoopt' not in self.api.entities['sudorule']['rule1']
+        with pytest.raises(KeyError):
+            self.api.Command['hbacrule_add_option']
+
+    def test_user_disable_enable(self):
+        self.api.Command['user_disable'](uid=u'user1')
+        assert self.api.entities['user']['user1']['nsaccountlock'] is True
+        with pytest.raises(tool.AlreadyInactive):
+            self.api.Command['user_disable'](uid=u'user1')
+        self.api.Command['user_enable'](uid=u'user1')
+        assert self.api.entities['user']['user1']['nsaccountlock'] is False
+
+    def test_batch(self):
+        result = self.api.Command['batch'](methods=[
+            {'method': 'user_show', 'params': [[], {'uid': u'user1'}]},
+            {'method': 'user_show', 'params': [[], {'uid': u'user2'}]}])
+        assert result['count'] == 2
+        assert result['results'][0]['error'] is None
+        assert result['results'][0]['value'] == u'user1'
+        assert result['results'][1] == {
+            'error': u'user2: user not found', 'error_name': 'NotFound'}
+        assert self.api.calls == {
+            'user_add': 1, 'group_add': 1, 'batch': 1, 'user_show': 2}
+
+    @mock.patch('%s.time.sleep' % modulename)
+    def test_latency(self, mock_sleep):
+        api = tool.FakeIpa(latency=0.05)
+        api.Command['user_find']()
+        mock_sleep.assert_called_once_with(0.05)
+
+    def test_failure_injection(self):
+        api = tool.FakeIpa(failure_rate=0.5, seed=1)
+        failures = 0
+        for i in range(100):
+            try:
+                api.Command['user_add'](uid=u'user%d' % i)
+            except tool.DatabaseError as e:
+                assert e[0] == 'Injected failure of user_add: server is busy'
+                failures += 1
+        assert 30 < failures < 70
+        assert api.calls['user_add'] == 100
+        # loading entities never fails
+        assert api.Command['user_find']()['count'] == 100 - failures
+
+    def test_failure_injection_reproducible(self):
+        def failing(seed):
+            api = tool.FakeIpa(failure_rate=0.3, seed=seed)
+            result = []
+            for i in range(20):
+                try:
+                    api.Command['group_add'](cn=u'group%d' % i)
+                except tool.DatabaseError:
+                    result.append(i)
+            return result
+        assert failing(3) == failing(3)
+        assert failing(3) != failing(4)
+
+
+class TestFakeIpaConnectors(object):
+    def setup_method(self, method):
+        with open(SETTINGS) as settings_file:
+            self.settings = yaml.safe_load(settings_file)
+        self.parsed = ConfigLoader(CONFIG_CORRECT, self.settings).load()
+        IntegrityChecker(self.parsed, self.settings).check()
+        self.api = tool.FakeIpa()
+
+    def _push(self, changes=None, **kwargs):
+        uploader = IpaUploader(self.settings, self.parsed, 100, force=True,
+                               ipa_api=self.api, api_errors=tool,
+                               **kwargs)
+        uploader.push(changes)
+        return uploader
+
+    def test_push(self):
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            self._push()
+        log.check_present(('IpaUploader', 'INFO', '59 commands to execute'))
+        assert len(self.api.entities['user']) == 3
+        assert self.api.entities['group']['group-one-users'][
+            'memberof_group'] == (u'group-two',)
+        assert self.api.entities['sudorule']['rule-one']['ipasudoopt'] == (
+            u'!authenticate', u'!requiretty')
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            self._push()
+        log.check_present(('IpaUploader', 'INFO',
+                           'FreeIPA consistent with local config, '
+                           'nothing to do'))
+
+    def test_push_changes(self):
+        self._push()
+        self.api.Command['user_mod'](uid=u'test.user', title=(u'Boss',))
+        self.api.Command['group_remove_member'](
+            cn=u'group-two', group=u'group-one-users')
+        self.api.Command['user_add'](uid=u'intruder')
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            self._push(enable_deletion=True)
+        log.check_present(('IpaUploader', 'INFO', '3 commands to execute'))
+        assert 'intruder' not in self.api.entities['user']
+        assert self.api.entities['user']['test.user']['title'] == (
+            u'Sr. SW Enginner',)
+        assert self.api.entities['group']['group-two']['member_group'] == (
+            u'group-one-users',)
+
+    def test_push_targeted(self):
+        with LogCapture():
+            self._push()
+        self.api.Command['user_mod'](uid=u'test.user', title=(u'Boss',))
+        self.api.Command['user_del'](uid=u'firstname.lastname')
+        self.api.calls = dict()
+        with LogCapture():
+            self._push(changes=([self.parsed['user']['test.user']], []))
+        assert self.api.entities['user']['test.user']['title'] == (
+            u'Sr. SW Enginner',)
+        # only the changed entity (& its groups) loaded, entity pushed
+        assert 'firstname.lastname' not in self.api.entities['user']
+        assert self.api.calls == {
+            'user_show': 1, 'group_show': 1, 'user_mod': 1}
+
+    def test_push_targeted_missing(self):
+        with LogCapture():
+            self._push()
+        self.api.Command['user_del'](uid=u'test.user')
+        with LogCapture('IpaUploader') as log:
+            self._push(changes=([self.parsed['user']['test.user']], []))
+        # the fake's NotFound is recognized as a missing entity
+        log.check_present(('IpaUploader', 'DEBUG',
+                           'user test.user does not exist in FreeIPA'))
+        assert self.api.entities['user']['test.user']['title'] == (
+            u'Sr. SW Enginner',)
+
+    def test_push_retry(self):
+        self.api.failure_rate = 0.2
+        with mock.patch('ipamanager.governor.time.sleep') as mock_sleep:
+            with LogCapture():
+                uploader = self._push()
+        assert uploader.governor.stats['retries'] == mock_sleep.call_count > 0
+        assert uploader.governor.stats['errors'] == 0
+        self.api.failure_rate = 0
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            self._push()
+        log.check_present(('IpaUploader', 'INFO',
+                           'FreeIPA consistent with local config, '
+                           'nothing to do'))
+
+    def test_push_errors(self):
+        self.api.failure, self.api.failure_rate = tool.EmptyModlist, 1
+        with LogCapture():
+            with pytest.raises(ManagerError) as exc:
+                self._push()
+        assert exc.value[0] == 'There were 59 errors executing update'
+
+    def test_pull(self):
+        with LogCapture():
+            self._push()
+        downloader = IpaDownloader(
+            self.settings, self.parsed, CONFIG_CORRECT, dry_run=True,
+            pull_types=['user', 'group', 'hbacrule', 'sudorule'],
+            ipa_api=self.api, api_errors=tool)
+        self.api.Command['user_add'](uid=u'new.user', givenname=u'New')
+        with LogCapture('IpaDownloader', level=logging.INFO) as log:
+            downloader.pull()
+        messages = [i.getMessage() for i in log.records]
+        assert 'Would create user new.user' in messages
+        # no other users, rules & group memberships differ
+        assert not [i for i in messages if i.startswith('Would ') and (
+            'new.user' not in i and 'group' not in i)]
+        assert not [i for i in messages if i.startswith('Would delete')]
+
+
+class TestFakeIpaTool(object):
+    def test_run(self):
+        fake_tool = tool.FakeIpaTool(
+            [CONFIG_CORRECT, '-s', SETTINGS, '-l', '0.001', '-p', 'group'])
+        with LogCapture('FakeIpaTool') as log:
+            fake_tool.run()
+        log.check(
+            ('FakeIpaTool', 'INFO', mock.ANY),
+            ('FakeIpaTool', 'INFO', mock.ANY),
+            ('FakeIpaTool', 'INFO', mock.ANY))
+        messages = [i.getMessage() for i in log.records]
+        assert messages[0].startswith('Push took')
+        assert messages[0].endswith('using 70 API calls')
+        assert messages[1].endswith('using 11 API calls')
+        assert messages[2].endswith('using 11 API calls')
+        assert len(fake_tool.api.entities['group']) == 4
+
+    def test_args(self):
+        args = tool._parse_args([CONFIG_CORRECT, '-vv', '-f', '0.1', '-j', '2'])
+        assert args.loglevel == logging.DEBUG
+        assert args.failure_rate == 0.1
+        assert args.processes == 2
+        assert args.latency == 0
+        assert args.pull_types == ['user']
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2021, GoodData Corporation. All rights reserved.
+
+import mock
+import os
+import pytest
+import requests
+import shutil
+import tempfile
+from testfixtures import LogCapture
+
+import ipamanager.tools.okta_replay as tool
+from ipamanager.okta_loader import OktaLoader
+
+modulename = 'ipamanager.tools.okta_replay'
+OKTA_URL = 'https://testoktaorg.okta.com/api/v1'
+
+
+class TestOktaReplay(object):
+    def setup_method(self, method):
+        self.directory = tool.generate_directory(50, 10, 2)
+        self.adapter = tool.OktaReplayAdapter(self.directory, page_size=20)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+
+    def test_generate_directory(self):
+        assert len(self.directory.users) == 50
+        assert len(self.directory.groups) == 10
+        assert sum(len(i) for i in
+                   self.directory.group_members.itervalues()) == 100
+        assert all(len(i) == 2 for i in
+                   self.directory.user_groups.itervalues())
+
+    def test_generate_directory_reproducible(self):
+        other = tool.generate_directory(50, 10, 2)
+        assert other.users == self.directory.users
+        assert other.group_members == self.directory.group_members
+
+    def test_save_load(self):
+        path = tempfile.mkdtemp()
+        try:
+            self.directory.save(path)
+            loaded = tool.OktaDirectory.load(path)
+        finally:
+            shutil.rmtree(path)
+        assert loaded.users == self.directory.users
+        assert loaded.groups == self.directory.groups
+
+    def test_load_missing(self):
+        with pytest.raises(tool.ManagerError) as exc:
+            tool.OktaDirectory.load('/nonexistent')
+        assert exc.value[0].startswith('Cannot load Okta users')
+
+    def test_pagination(self):
+        resp = self.session.get('%s/users' % OKTA_URL)
+        assert resp.ok
+        assert len(resp.json()) == 20
+        assert resp.headers['X-Rate-Limit-Limit'] == '600'
+        assert resp.headers['X-Rate-Limit-Remaining'] == '599'
+        next_url = resp.links['next']['url']
+        assert 'after=00u00000000000000019' in next_url
+        resp = self.session.get(next_url)
+        assert resp.json()[0]['id'] == '00u00000000000000020'
+        resp = self.session.get(resp.links['next']['url'])
+        assert len(resp.json()) == 10
+        assert 'next' not in resp.links
+
+    def test_pagination_listing_cached(self):
+        with mock.patch.object(self.adapter, '_route',
+                               wraps=self.adapter._route) as mock_route:
+            url = '%s/users' % OKTA_URL
+            while url:
+                resp = self.session.get(url)
+                url = resp.links.get('next', {}).get('url')
+            self.session.get('%s/users' % OKTA_URL, params={
+                'search': 'profile.employeeNumber eq "7"'})
+        assert len(self.adapter.requests) == 4
+        # listing & its ID positions computed once for all pages
+        assert mock_route.call_count == 2
+
+    def test_limit(self):
+        resp = self.session.get('%s/groups' % OKTA_URL, params={'limit': 3})
+        assert len(resp.json()) == 3
+        assert 'limit=3' in resp.links['next']['url']
+
+    def test_memberships(self):
+        group = self.directory.groups[0]
+        resp = self.session.get('%s/groups/%s/users' % (OKTA_URL, group['id']))
+        user_ids = [u['id'] for u in resp.json()]
+        assert user_ids == self.directory.group_members[group['id']][:20]
+        resp = self.session.get(
+            '%s/users/%s/groups' % (OKTA_URL, user_ids[0]))
+        assert group in resp.json()
+
+    def test_search(self):
+        resp = self.session.get('%s/users' % OKTA_URL, params={
+            'search': 'profile.employeeNumber eq "7"'})
+        assert [u['profile']['login'] for u in resp.json()] == [
+            'user7@example.com']
+
+    def test_not_found(self):
+        resp = self.session.get('%s/groups/nonexistent/users' % OKTA_URL)
+        assert resp.status_code == 404
+        assert resp.json()['errorCode'] == 'E0000007'
+        resp = self.session.get('%s/users/nonexistent/groups' % OKTA_URL)
+        assert resp.status_code == 404
+
+    def test_rate_limit(self):
+        self.adapter.rate_limit = 1
+        self.adapter.enforce_rate_limit = True
+        assert self.session.get('%s/groups' % OKTA_URL).ok
+        resp = self.session.get('%s/groups' % OKTA_URL)
+        assert resp.status_code == 429
+
+    @mock.patch('%s.time.sleep' % modulename)
+    def test_latency(self, mock_sleep):
+        self.adapter.latency = 0.5
+        self.session.get('%s/groups' % OKTA_URL)
+        mock_sleep.assert_called_with(0.5)
+
+    def _create_loader(self, group_filter=[]):
+        settings = {'okta': {
+            'auth': {'org': 'testoktaorg', 'token_path': os.devnull},
+            'attributes': ['firstName', 'lastName'],
+            'user_id_regex': '(.+)@example.com',
+            'user_group_filter': group_filter,
+        }}
+        groups = ['group%d' % i for i in range(10)]
+        return OktaLoader(settings, groups, transport=self.adapter)
+
+    def test_okta_loader(self):
+        with LogCapture():
+            users = self._create_loader().load()
+        active = [u for u in self.directory.users
+                  if u['status'] != 'DEPROVISIONED']
+        assert len(users) == len(active)
+        # 3 pages of users + groups of each non-deprovisioned user
+        assert len(self.adapter.requests) == 3 + len(active)
+
+    def test_okta_loader_group_filter(self):
+        group = self.directory.groups[0]
+        members = self.directory.group_members[group['id']]
+        with LogCapture():
+            users = self._create_loader(['group0']).load()
+        assert len(users) <= len(members)
+        # users outside of the filter group cost no requests
+        requested = [path.split('/')[4] for path in self.adapter.requests
+                     if path.startswith('/api/v1/users/')]
+        assert set(requested).issubset(members)
+
+
+class TestOktaReplayTool(object):
+    def test_generate_and_benchmark(self):
+        path = tempfile.mkdtemp()
+        try:
+            with LogCapture() as log:
+                tool.OktaReplayTool(
+                    ['generate', path, '-u', '30', '-g', '5']).run()
+                tool.OktaReplayTool(
+                    ['benchmark', path, '-f', 'group1']).run()
+        finally:
+            shutil.rmtree(path)
+        log.check_present(
+            ('OktaReplayTool', 'INFO',
+             'Generated 30 users & 5 groups into %s' % path))
+        assert any(r.msg.startswith('Loaded %d users in')
+                   for r in log.records if r.name == 'OktaReplayTool')
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import json
+import os
+import pytest
+import sh
+import shutil
+import StringIO
+import tempfile
+from testfixtures import LogCapture
+
+import ipamanager.tools.query_delta as tool
+from ipamanager.errors import ManagerError
+from ipamanager.utils import checkout_revision
+testdir = os.path.dirname(__file__)
+
+modulename = 'ipamanager.tools.query_delta'
+CONFIG_CORRECT = os.path.join(testdir, '../freeipa-manager-config/correct')
+SETTINGS = os.path.join(testdir, '../freeipa-manager-config/settings.yaml')
+
+
+class TestQueryDelta(object):
+    def setup_method(self, method):
+        self.repo = tempfile.mkdtemp()
+        self.config = os.path.join(self.repo, 'config')
+        shutil.copytree(CONFIG_CORRECT, self.config)
+        self.git = sh.git.bake(_cwd=self.repo)
+        self.git.init('-q')
+        self.git.add('.')
+        self.git('-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                 'commit', '-q', '-m', 'initial')
+        # group-four-users moves from group-three-users to group-two
+        # & group-three-hosts is no longer a member of group-two hostgroup
+        self._write('groups/group_four.yaml',
+                    'group-four-users:\n  memberOf:\n    group: [group-two]\n')
+        self._write('hostgroups/group_three.yaml',
+                    'group-three-hosts:\n  description: Sample.\n')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.repo)
+
+    def _write(self, path, content):
+        with open(os.path.join(self.config, path), 'w') as target:
+            target.write('---\n%s' % content)
+
+    def _delta(self, old='HEAD', new=None):
+        delta = tool.QueryDelta(self.config, old, new, SETTINGS)
+        with LogCapture() as self.log:
+            delta.load()
+            return delta.compute()
+
+    def test_compute(self):
+        users = {'users': {'added': ['user:firstname.lastname2']}}
+        both = dict(users, hostgroups={
+            'removed': ['hostgroup:group-three-hosts']})
+        assert self._delta() == {
+            'membership': {
+                'group:group-four-users': {'added': ['group:group-two']},
+                'user:firstname.lastname2': {'added': ['group:group-two']},
+                'hostgroup:group-three-hosts': {'removed': [
+                    'hostgroup:group-one-hosts', 'hostgroup:group-two']}},
+            'access': {
+                'hbacrule:rule_one': both, 'hbacrule:rule_two': both,
+                'hbacrule:rule-three': both, 'sudorule:rule-one': both,
+                'sudorule:rule-two': both, 'sudorule:rule-three': both}}
+        self.log.check_present(
+            ('QueryDelta', 'INFO',
+             'Membership of 3 entities and access of 6 rules changed'))
+
+    def test_compute_reversed(self):
+        self.git('-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                 'commit', '-q', '-a', '-m', 'change')
+        delta = self._delta('HEAD', 'HEAD~1')
+        assert delta['membership']['user:firstname.lastname2'] == {
+            'removed': ['group:group-two']}
+        assert delta['access']['sudorule:rule-one'] == {
+            'users': {'removed': ['user:firstname.lastname2']},
+            'hostgroups': {'added': ['hostgroup:group-three-hosts']}}
+
+    def test_compute_unaffected(self):
+        delta = tool.QueryDelta(self.config, 'HEAD', None, SETTINGS)
+        with LogCapture():
+            delta.load()
+        delta.compute()
+        # only the moved entities & their members had closure recomputed
+        assert sorted(delta.graphs[1]._ancestors) == [
+            ('group', 'group-four-users'), ('group', 'group-three-users'),
+            ('group', 'group-two'), ('hostgroup', 'group-three-hosts'),
+            ('user', 'firstname.lastname2')]
+
+    def test_compute_no_change(self):
+        assert self._delta('HEAD', 'HEAD') == {
+            'membership': {}, 'access': {}}
+
+    def test_rule_change(self):
+        self._write('hbacrules/rule_one.yaml',
+                    'rule_one:\n  memberHost: [group-one-hosts]\n'
+                    '  memberUser: [group-two]\n')
+        assert self._delta()['access']['hbacrule:rule_one'] == {
+            'users': {'added': ['user:firstname.lastname2']},
+            'hostgroups': {'added': ['hostgroup:group-one-hosts'],
+                           'removed': ['hostgroup:group-three-hosts']}}
+
+    def test_run_text(self):
+        output = StringIO.StringIO()
+        with LogCapture():
+            tool.QueryDelta(self.config, 'HEAD', None, SETTINGS).run(
+                output=output)
+        lines = output.getvalue().splitlines()
+        assert lines[:4] == [
+            'group:group-four-users +group:group-two',
+            'hostgroup:group-three-hosts -hostgroup:group-one-hosts',
+            'hostgroup:group-three-hosts -hostgroup:group-two',
+            'user:firstname.lastname2 +group:group-two']
+        assert lines[4:6] == [
+            'hbacrule:rule-three +user:firstname.lastname2',
+            'hbacrule:rule-three -hostgroup:group-three-hosts']
+        assert len(lines) == 16
+
+    def test_run_json(self):
+        output = StringIO.StringIO()
+        with LogCapture():
+            tool.QueryDelta(self.config, 'HEAD', None, SETTINGS).run(
+                'json', output)
+        assert sorted(json.loads(output.getvalue())) == [
+            'access', 'membership']
+
+    def test_checkout_revision(self):
+        with checkout_revision(self.config, 'HEAD') as path:
+            assert path != self.config
+            with open(os.path.join(path, 'groups/group_four.yaml')) as src:
+                assert 'group-three-users' in src.read()
+        assert not os.path.exists(path)
+
+    def test_checkout_revision_working_tree(self):
+        with checkout_revision(self.config) as path:
+            assert path == self.config
+
+    def test_checkout_revision_error(self):
+        with pytest.raises(ManagerError) as exc:
+            with checkout_revision(self.config, 'nonexistent'):
+                pass
+        assert exc.value[0] == (
+            'Cannot check out revision nonexistent of %s: fatal: not a valid '
+            'object name: nonexistent:config/' % self.config)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import json
+import mock
+import os
+import pytest
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from testfixtures import LogCapture
+
+import ipamanager.tools.query_server as tool
+testdir = os.path.dirname(__file__)
+
+modulename = 'ipamanager.tools.query_server'
+CONFIG_CORRECT = os.path.join(testdir, '../freeipa-manager-config/correct')
+SETTINGS = os.path.join(testdir, '../freeipa-manager-config/settings.yaml')
+
+
+class TestQueryServer(object):
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'query.sock')
+        self.server = tool.QueryServer(
+            CONFIG_CORRECT, self.socket_path, SETTINGS, reload_interval=0)
+        self.server._current_revision = mock.Mock(return_value='abc')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def test_load(self):
+        with LogCapture() as log:
+            self.server.load()
+        assert self.server.revision == 'abc'
+        assert self.server.querytool.closure
+        # indexes built before the tool is shared by request threads
+        assert self.server.querytool.descendants is not None
+        assert self.server.querytool.access is not None
+        log.check_present(('QueryServer', 'INFO',
+                           'Loading config repository (revision abc)'))
+
+    def test_answer(self):
+        with LogCapture():
+            self.server.load()
+            response = self.server.answer(json.dumps({
+                'query': 'member', 'member': 'user:firstname.lastname',
+                'entity': 'group:group-two'}))
+        assert json.loads(response) == {'result': True}
+
+    def test_answer_invalid(self):
+        response = json.loads(self.server.answer('{invalid'))
+        assert response['error'].startswith(
+            'Invalid query: Expecting property name')
+        assert json.loads(self.server.answer('[1]')) == {
+            'error': 'Invalid query: query must be a JSON object'}
+
+    def test_answer_wrong_type(self):
+        with LogCapture():
+            self.server.load()
+            with LogCapture('QueryServer') as log:
+                response = json.loads(self.server.answer(json.dumps({
+                    'query': 'member', 'member': 1, 'id': 7,
+                    'entity': 'group:group-two'})))
+        assert response['id'] == 7
+        assert response['error'].startswith('Error answering query: ')
+        log.check(('QueryServer', 'ERROR', mock.ANY))
+
+    def test_reload_not_blocking(self):
+        with LogCapture():
+            self.server.load()
+        old = self.server.querytool
+        self.server._current_revision.return_value = 'def'
+        loading, release = threading.Event(), threading.Event()
+        load = tool.QueryTool.load
+
+        def slow_load(querytool):
+            loading.set()
+            release.wait(5)
+            load(querytool)
+        query = '{"query": "groups", "user": "test.user"}'
+        with mock.patch('%s.QueryTool.load' % modulename, slow_load):
+            with LogCapture():
+                thread = threading.Thread(
+                    target=self.server.answer, args=(query,))
+                thread.start()
+                assert loading.wait(5)
+                # answered by the previous instance during the reload
+                assert json.loads(self.server.answer(query))['result']
+                assert self.server.querytool is old
+                release.set()
+                thread.join()
+        assert self.server.querytool is not old
+        assert self.server.revision == 'def'
+        assert not self.server.reloading
+
+    def test_reload_on_head_change(self):
+        with LogCapture():
+            self.server.load()
+            old = self.server.querytool
+            self.server.answer('{"query": "groups", "user": "test.user"}')
+            assert self.server.querytool is old
+            self.server._current_revision.return_value = 'def'
+            with LogCapture() as log:
+                self.server.answer('{"query": "groups", "user": "test.user"}')
+        assert self.server.querytool is not old
+        assert self.server.revision == 'def'
+        log.check_present(('QueryServer', 'INFO',
+                           'Repository HEAD changed (abc -> def), reloading'))
+
+    def test_reload_interval(self):
+        self.server.reload_interval = 3600
+        with LogCapture():
+            self.server.load()
+            old = self.server.querytool
+            self.server._current_revision.return_value = 'def'
+            self.server.answer('{"query": "groups", "user": "test.user"}')
+        assert self.server.querytool is old
+
+    def test_reload_failed(self):
+        with LogCapture():
+            self.server.load()
+        old = self.server.querytool
+        self.server._current_revision.return_value = 'def'
+        with mock.patch('%s.QueryTool.load' % modulename) as mock_load:
+            mock_load.side_effect = tool.ManagerError('integrity failed')
+            with LogCapture() as log:
+                response = self.server.answer(
+                    '{"query": "groups", "user": "test.user"}')
+        assert self.server.querytool is old
+        assert self.server.revision == 'abc'
+        assert json.loads(response) == {'result': [
+            'group-one-users', 'group-three-users', 'group-two']}
+        log.check_present(
+            ('QueryServer', 'ERROR',
+             'Reload failed, keeping previous config: integrity failed'))
+
+    def test_serve_and_client(self):
+        with LogCapture():
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.start()
+            try:
+                for _ in range(100):
+                    if os.path.exists(self.socket_path):
+                        break
+                    time.sleep(0.05)
+                client = tool.QueryClient(self.socket_path)
+                assert client.query({
+                    'query': 'member', 'member': 'user:firstname.lastname',
+                    'entity': 'group:group-two', 'id': 'q1'}) == {
+                        'id': 'q1', 'result': True}
+                assert list(client.query_all([
+                    {'query': 'groups', 'user': 'firstname.lastname2'},
+                    {'query': 'nonsense'}])) == [
+                        {'result': ['group-four-users', 'group-three-users']},
+                        {'error': 'Unknown query nonsense'}]
+            finally:
+                self.server.shutdown()
+                thread.join()
+        assert not os.path.exists(self.socket_path)
+
+    def test_client_no_daemon(self):
+        client = tool.QueryClient(self.socket_path)
+        with pytest.raises(tool.ManagerError) as exc:
+            client.query({'query': 'groups', 'user': 'user'})
+        assert exc.value[0].startswith('Cannot connect to query daemon at')
+
+    def test_client_daemon_closed(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(1)
+
+        def accept_and_close():
+            conn, _ = listener.accept()
+            conn.makefile().readline()  # request read, no response
+            conn.close()
+        thread = threading.Thread(target=accept_and_close)
+        thread.start()
+        try:
+            client = tool.QueryClient(self.socket_path)
+            with pytest.raises(tool.ManagerError) as exc:
+                client.query({'query': 'groups', 'user': 'user'})
+        finally:
+            thread.join()
+            listener.close()
+        assert exc.value[0] == 'Query daemon closed the connection'
+
+    def test_current_revision(self):
+        server = tool.QueryServer(CONFIG_CORRECT, self.socket_path, SETTINGS)
+        with mock.patch('%s.sh.git' % modulename) as mock_git:
+            mock_git.return_value = 'abc123\n'
+            assert server._current_revision() == 'abc123'
+        mock_git.assert_called_with('rev-parse', 'HEAD', _cwd=CONFIG_CORRECT)
+
+    def test_current_revision_not_repo(self):
+        server = tool.QueryServer(self.tmpdir, self.socket_path, SETTINGS)
+        with LogCapture():
+            assert server._current_revision() is None
@@ -4,11 +4,16 @@
 # Copyright © 2017-2019, GoodData Corporation. All rights reserved.
 
 import argparse
+import json
 import logging
 import mock
 import os
 import pytest
 import re
+import shutil
+import stat
+import StringIO
+import tempfile
 from testfixtures import LogCapture, log_capture
 
 import ipamanager.tools.query_tool as tool
@@ -51,7 +56,8 @@ class TestQueryTool(object):
         self.querytool._query_membership = mock.Mock()
         args = argparse.Namespace(action='member', members=[], entities=[])
         self.querytool.run(args)
-        self.querytool._query_membership.assert_called_with([], [])
+        self.querytool._query_membership.assert_called_with(
+            [], [], 'all', None)
 
     def test_run_labels(self):
         self.querytool._query_labels = mock.Mock()
@@ -74,6 +80,8 @@ class TestQueryTool(object):
         mock_checker.return_value.check.assert_called_with()
         log.check(
             ('QueryTool', 'INFO', 'Running pre-query config load & checks'),
+            ('QueryTool', 'DEBUG',
+             'Membership index built for 0 entities (0 targets)'),
             ('QueryTool', 'INFO', 'Pre-query config load & checks finished'))
 
     def test_resolve_entities(self):
@@ -154,7 +162,7 @@ class TestQueryTool(object):
                        ('group', 'group-three-users')]
         self.querytool.check_membership = mock.Mock()
         self.querytool._query_membership(members, entity_list)
-        assert [tuple(repr(i) for i in j.args) for j
+        assert [tuple(repr(i) for i in j.args[:2]) for j
                 in self.querytool.check_membership.call_args_list] == [
             ('user firstname.lastname2', 'group group-one-users'),
             ('user firstname.lastname2', 'group group-two'),
@@ -191,6 +199,335 @@ class TestQueryTool(object):
         member = self.querytool.entities['user']['firstname.lastname2']
         assert self.querytool._construct_path(entity, member) == []
 
+    def _diamond(self, levels):
+        """
+        Create a diamond-shaped hierarchy: a user member of two groups
+        on each level, both of which are members of both next-level groups.
+        """
+        groups = {'top': entities.FreeIPAUserGroup('top', {}, 'top.yaml')}
+        upper = ['top']
+        for level in range(levels, 0, -1):
+            names = ['g%d-a' % level, 'g%d-b' % level]
+            for name in names:
+                groups[name] = entities.FreeIPAUserGroup(
+                    name, {'memberOf': {'group': upper}}, '%s.yaml' % name)
+            upper = names
+        user = entities.FreeIPAUser('user', {
+            'firstName': 'A', 'lastName': 'B',
+            'memberOf': {'group': upper}}, 'user.yaml')
+        self.querytool.entities = {'group': groups, 'user': {'user': user}}
+        self.querytool.build_index()
+        return user, groups['top']
+
+    def test_construct_path_count(self):
+        user, top = self._diamond(20)
+        assert self.querytool._construct_path(top, user, 'count') == 2 ** 20
+
+    def test_construct_path_first(self):
+        user, top = self._diamond(20)
+        paths = self.querytool._construct_path(top, user, 'first')
+        assert len(paths) == 1
+        assert len(paths[0]) == 22
+        assert paths[0][0] == user and paths[0][-1] == top
+
+    def test_construct_path_shortest(self):
+        user = self.querytool.entities['user']['firstname.lastname2']
+        group = self.querytool.entities['group']['group-three-users']
+        paths = self.querytool._construct_path(group, user, 'shortest', 5)
+        assert [map(repr, p) for p in paths] == [
+            ['user firstname.lastname2', 'group group-three-users'],
+            ['user firstname.lastname2', 'group group-four-users',
+             'group group-three-users']]
+        paths = self.querytool._construct_path(group, user, 'shortest', 1)
+        assert len(paths) == 1 and len(paths[0]) == 2
+
+    def test_construct_path_cache_key(self):
+        user, top = self._diamond(3)
+        self.querytool._construct_path(top, user, 'count', 5)
+        self.querytool._construct_path(top, user, 'count', 7)
+        self.querytool._construct_path(top, user, 'first')
+        self.querytool._construct_path(top, user, 'shortest', 1)
+        self.querytool._construct_path(top, user, 'shortest')
+        # the limit is only part of the key where it affects the result
+        assert sorted(key[2:] for key in self.querytool.paths) == [
+            ('count', None), ('shortest', 1)]
+
+    def test_construct_path_unknown_mode(self):
+        user = self.querytool.entities['user']['firstname.lastname2']
+        group = self.querytool.entities['group']['group-three-users']
+        with pytest.raises(tool.ManagerError) as exc:
+            self.querytool._construct_path(group, user, 'random')
+        assert exc.value[0] == 'Unknown path mode random'
+
+    @log_capture(level=logging.INFO)
+    def test_check_membership_count(self, log):
+        member = self.querytool.entities['user']['firstname.lastname2']
+        entity = self.querytool.entities['group']['group-three-users']
+        assert self.querytool.check_membership(member, entity, 'count') == 2
+        log.check(('QueryTool', 'INFO',
+                   'firstname.lastname2 IS a member of group-three-users; '
+                   '2 possible paths'))
+
+    def test_answer_member(self):
+        assert self.querytool.answer({
+            'query': 'member', 'member': 'user:firstname.lastname',
+            'entity': 'group:group-two', 'id': 1}) == {'id': 1, 'result': True}
+        assert self.querytool.answer({
+            'query': 'member', 'member': 'user:firstname.lastname2',
+            'entity': 'group:group-two'}) == {'result': False}
+
+    def test_answer_member_paths(self):
+        query = {'query': 'member', 'member': 'user:firstname.lastname2',
+                 'entity': 'group:group-three-users', 'paths': 'first'}
+        assert self.querytool.answer(query) == {'result': [
+            ['user:firstname.lastname2', 'group:group-three-users']]}
+        query['paths'] = 'count'
+        assert self.querytool.answer(query) == {'result': 2}
+
+    def test_answer_groups(self):
+        assert self.querytool.answer({
+            'query': 'groups', 'user': 'firstname.lastname'}) == {'result': [
+                'group-one-users', 'group-three-users', 'group-two']}
+
+    def test_answer_labels(self):
+        self.querytool.list_user_missing_labels = mock.Mock(
+            return_value={'label2', 'label1'})
+        assert self.querytool.answer({
+            'query': 'labels', 'subaction': 'missing', 'user': 'user1'}) == {
+                'result': ['label1', 'label2']}
+        self.querytool.list_user_missing_labels.assert_called_with('user1')
+
+    def test_answer_errors(self):
+        assert self.querytool.answer({'query': 'unknown'}) == {
+            'error': 'Unknown query unknown'}
+        assert self.querytool.answer({'query': 'groups'}) == {
+            'error': "Missing query field 'user'"}
+        assert self.querytool.answer({
+            'query': 'groups', 'user': 'nonexistent'}) == {
+                'error': 'User nonexistent does not exist in config'}
+        assert self.querytool.answer({
+            'query': 'labels', 'subaction': 'other'}) == {
+                'error': 'Unknown labels subaction other'}
+
+    def test_members(self):
+        group = self.querytool.entities['group']['group-three-users']
+        assert [repr(i) for i in self.querytool.members(group)] == [
+            'group group-four-users', 'group group-one-users',
+            'group group-two', 'user firstname.lastname',
+            'user firstname.lastname2', 'user test.user']
+        assert [repr(i) for i in self.querytool.members(group, 'group')] == [
+            'group group-four-users', 'group group-one-users',
+            'group group-two']
+        user = self.querytool.entities['user']['test.user']
+        assert self.querytool.members(user) == []
+
+    def test_members_consistent_with_closure(self):
+        for entity in self.querytool.closure:
+            for member in self.querytool.members(entity):
+                assert self.querytool.is_member(member, entity)
+
+    def test_list_members(self):
+        assert list(self.querytool.list_members('group-two')) == [
+            'firstname.lastname', 'test.user']
+        with pytest.raises(tool.ManagerError) as exc:
+            self.querytool.list_members('nonexistent')
+        assert exc.value[0] == 'Group nonexistent does not exist in config'
+
+    def test_query_members(self):
+        args = argparse.Namespace(
+            action='members', entities=[('group', 'group-two')], type='user')
+        with LogCapture() as log:
+            self.querytool.run(args)
+        log.check_present(('QueryTool', 'INFO',
+                           'group-two has 2 members: '
+                           '[user firstname.lastname, user test.user]'))
+
+    def test_answer_members(self):
+        assert self.querytool.answer({
+            'query': 'members', 'entity': 'group:group-one-users'}) == {
+                'result': ['user:firstname.lastname', 'user:test.user']}
+
+    def test_user_access(self):
+        hostgroups = ['group-three-hosts', 'group-two']
+        assert self.querytool.user_access('test.user') == {
+            'hbacrule': dict.fromkeys(
+                ['rule_one', 'rule_two', 'rule-three'], hostgroups),
+            'sudorule': dict.fromkeys(
+                ['rule-one', 'rule-two', 'rule-three'], hostgroups)}
+        assert self.querytool.user_access('firstname.lastname2') == {}
+
+    def test_build_access_published_at_once(self):
+        members = self.querytool.members
+        seen = []
+
+        def check_members(*args):
+            seen.append(self.querytool.access)
+            return members(*args)
+        with mock.patch.object(self.querytool, 'members', check_members):
+            self.querytool.build_access()
+        # a concurrent query never sees a partially built matrix
+        assert seen and all(access is None for access in seen)
+        assert len(self.querytool.access) == 6
+
+    def test_user_access_nonexistent(self):
+        with pytest.raises(tool.ManagerError) as exc:
+            self.querytool.user_access('nonexistent')
+        assert exc.value[0] == 'User nonexistent does not exist in config'
+
+    def test_hostgroup_access(self):
+        users = ['firstname.lastname', 'test.user']
+        assert self.querytool.hostgroup_access('group-three-hosts') == {
+            'hbacrule': dict.fromkeys(
+                ['rule_one', 'rule_two', 'rule-three'], users),
+            'sudorule': dict.fromkeys(
+                ['rule-one', 'rule-two', 'rule-three'], users)}
+        # parent hostgroups are not covered by rules of their members
+        assert self.querytool.hostgroup_access('group-one-hosts') == {}
+        with pytest.raises(tool.ManagerError) as exc:
+            self.querytool.hostgroup_access('nonexistent')
+        assert exc.value[0] == 'Hostgroup nonexistent does not exist in config'
+
+    def test_export_access(self):
+        path = os.path.join(tempfile.mkdtemp(), 'access.json')
+        try:
+            with LogCapture() as log:
+                self.querytool.export_access(path)
+            with open(path) as src:
+                data = json.load(src)
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        assert sorted(data) == ['hbacrule', 'sudorule']
+        assert data['hbacrule']['rule_one'] == {
+            'hostgroups': ['group-three-hosts', 'group-two'],
+            'users': ['firstname.lastname', 'test.user']}
+        log.check_present(('QueryTool', 'INFO',
+                           'Access matrix of 6 rules exported to %s' % path))
+
+    def test_export_access_error(self):
+        with pytest.raises(tool.ManagerError) as exc:
+            self.querytool.export_access('/nonexistent/access.json')
+        assert exc.value[0].startswith('Cannot export access matrix')
+
+    def test_query_access(self):
+        args = argparse.Namespace(
+            action='access', user=None, hostgroup='group-one-hosts',
+            export=None)
+        with LogCapture() as log:
+            self.querytool.run(args)
+            args.hostgroup = None
+            args.user = 'test.user'
+            self.querytool.run(args)
+        log.check_present(
+            ('QueryTool', 'INFO', 'group-one-hosts is covered by NO rules'),
+            ('QueryTool', 'INFO',
+             'User test.user has hbacrule rule-three access to hostgroups: '
+             '[group-three-hosts, group-two]'))
+
+    def test_answer_access(self):
+        assert self.querytool.answer({
+            'query': 'access', 'hostgroup': 'group-one-hosts'}) == {
+                'result': {}}
+        assert self.querytool.answer({'query': 'access'}) == {
+            'error': "Missing query field 'hostgroup'"}
+
+    def test_export_membership(self):
+        path = os.path.join(tempfile.mkdtemp(), 'membership')
+        try:
+            with LogCapture() as log:
+                self.querytool.export_membership(path)
+            with open(path) as src:
+                lines = src.read().splitlines()
+            assert lines == sorted(lines)
+            assert 'user:test.user\t["group-one-users","group-three-users",' \
+                '"group-two"]' in lines
+            assert 'hostgroup:group-two\t["hostgroup:group-three-hosts"]' \
+                in lines
+            for line in lines:
+                key, value = line.split('\t')
+                assert tool.lookup_membership(path, key) == json.loads(value)
+            assert tool.lookup_membership(path, 'group:group') is None
+            assert tool.lookup_membership(path, 'user:zzz') is None
+            assert os.listdir(os.path.dirname(path)) == ['membership']
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        log.check_present(
+            ('QueryTool', 'INFO',
+             'Membership of %d entities exported to %s' % (len(lines), path)))
+
+    def test_export_membership_error(self):
+        with pytest.raises(tool.ManagerError) as exc:
+            self.querytool.export_membership('/nonexistent/membership')
+        assert exc.value[0].startswith('Cannot export membership')
+
+    def test_export_membership_mode(self):
+        path = os.path.join(tempfile.mkdtemp(), 'membership')
+        umask = os.umask(0o022)
+        try:
+            with LogCapture():
+                self.querytool.export_membership(path)
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+        finally:
+            os.umask(umask)
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_export_membership_error_cleanup(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'membership')
+        os.mkdir(path)  # rename over a directory fails
+        try:
+            with pytest.raises(tool.ManagerError) as exc:
+                self.querytool.export_membership(path)
+            assert os.listdir(directory) == ['membership']
+        finally:
+            shutil.rmtree(directory)
+        assert exc.value[0].startswith('Cannot export membership')
+
+    def test_lookup_membership_empty(self):
+        with tempfile.NamedTemporaryFile() as empty:
+            assert tool.lookup_membership(empty.name, 'user:user1') is None
+
+    def test_batch_json(self):
+        source = StringIO.StringIO(
+            '{"query": "groups", "user": "firstname.lastname", "id": 1}\n'
+            '\n'
+            '{"query": "member", "member": "user:firstname.lastname2", '
+            '"entity": "group:group-two"}\n'
+            '[1]\n')
+        output = StringIO.StringIO()
+        with LogCapture() as log:
+            assert self.querytool.batch(source, output=output) == 3
+        assert output.getvalue().splitlines() == [
+            '{"id": 1, "result": ["group-one-users", "group-three-users", '
+            '"group-two"]}',
+            '{"result": false}',
+            '{"error": "Invalid query on line 4: '
+            'query must be a JSON object"}']
+        log.check_present(('QueryTool', 'INFO', 'Answered 3 queries'))
+
+    def test_batch_csv(self):
+        source = StringIO.StringIO(
+            'member,user:firstname.lastname2,group:group-three-users,count\n'
+            'groups,firstname.lastname\n'
+            'labels,other\n'
+            'groups\n')
+        output = StringIO.StringIO()
+        with LogCapture():
+            self.querytool.batch(source, 'csv', output)
+        assert output.getvalue().splitlines() == [
+            '{"id": 1, "result": 2}',
+            '{"id": 2, "result": ["group-one-users", "group-three-users", '
+            '"group-two"]}',
+            '{"error": "Invalid query on line 3: unknown query labels,other"}',
+            '{"error": "Invalid query on line 4: '
+            'wrong number of fields for groups query"}']
+
+    @mock.patch('%s.sys' % modulename)
+    def test_run_batch_stdin(self, mock_sys):
+        self.querytool.batch = mock.Mock()
+        args = argparse.Namespace(action='batch', input='-', format='csv')
+        self.querytool.run(args)
+        self.querytool.batch.assert_called_with(mock_sys.stdin, 'csv')
+
     def _mock_find(self, *missing):
         def f(entities, entity_type, name):
             for t, n in missing:
@@ -199,23 +536,44 @@ class TestQueryTool(object):
             return 'mock_entity: <%s %s>' % (entity_type, name)
         return f
 
+    def test_build_index(self):
+        user = self.querytool.entities['user']['firstname.lastname']
+        assert sorted(repr(i) for i in self.querytool._entities_from_bits(
+            self.querytool.closure[user])) == [
+            'group group-one-users', 'group group-three-users',
+            'group group-two']
+        group = self.querytool.entities['group']['group-three-users']
+        assert self.querytool.closure[group] == 0
+        assert len(self.querytool.index) == len(self.querytool.ids)
+
+    def test_is_member(self):
+        user = self.querytool.entities['user']['firstname.lastname']
+        group = self.querytool.entities['group']['group-three-users']
+        assert self.querytool.is_member(user, group)
+        assert not self.querytool.is_member(group, user)
+
+    def test_is_member_lazy_index(self):
+        self.querytool.closure = None
+        user = self.querytool.entities['user']['firstname.lastname']
+        group = self.querytool.entities['group']['group-two']
+        assert self.querytool.is_member(user, group)
+
+    @log_capture(level=logging.INFO)
+    def test_check_membership_not_member(self, log):
+        member = self.querytool.entities['user']['firstname.lastname2']
+        entity = self.querytool.entities['group']['group-two']
+        assert self.querytool.check_membership(member, entity) == []
+        assert self.querytool.graph == {}
+        log.check(('QueryTool', 'INFO',
+                   'firstname.lastname2 IS NOT a member of group-two'))
+
     def test_check_user_membership(self):
-        self.querytool.check_membership = mock.Mock()
-        self.querytool.check_membership.return_value = [['user1', 'group-one']]
-        with mock.patch('%s.find_entity' % modulename, self._mock_find()):
-            ret = self.querytool.check_user_membership('user1', 'group-one')
-        self.querytool.check_membership.assert_called_with(
-            'mock_entity: <user user1>', 'mock_entity: <group group-one>')
-        assert ret
+        assert self.querytool.check_user_membership(
+            'firstname.lastname', 'group-two')
 
     def test_check_user_membership_not_a_member(self):
-        self.querytool.check_membership = mock.Mock()
-        self.querytool.check_membership.return_value = []
-        with mock.patch('%s.find_entity' % modulename, self._mock_find()):
-            ret = self.querytool.check_user_membership('user1', 'group-one')
-        self.querytool.check_membership.assert_called_with(
-            'mock_entity: <user user1>', 'mock_entity: <group group-one>')
-        assert not ret
+        assert not self.querytool.check_user_membership(
+            'firstname.lastname2', 'group-two')
 
     def test_check_user_membership_user_not_found(self):
         mock_find_inst = self._mock_find(('user', 'user1'))
@@ -232,18 +590,10 @@ class TestQueryTool(object):
         assert exc.value[0] == 'Group group-one does not exist in config'
 
     def test_list_groups(self):
-        self.querytool.build_graph = mock.Mock()
-        self.querytool.build_graph.return_value = set()
-        for i in range(5):
-            mock_group = mock.Mock()
-            mock_group.name = 'group%d' % i
-            self.querytool.build_graph.return_value.add(mock_group)
-        with mock.patch('%s.find_entity' % modulename, self._mock_find()):
-            ret = self.querytool.list_groups('user1')
-        self.querytool.build_graph.assert_called_with(
-            'mock_entity: <user user1>')
+        ret = self.querytool.list_groups('firstname.lastname')
         assert ret.__class__.__name__ == 'generator'
-        assert set(ret) == set('group%d' % i for i in range(5))
+        assert set(ret) == {
+            'group-one-users', 'group-two', 'group-three-users'}
 
     def test_list_groups_user_not_found(self):
         with mock.patch('%s.find_entity' % modulename) as mock_find:
@@ -340,6 +690,53 @@ class TestQueryTool(object):
         assert self.querytool._list_necessary_labels(
             entity, include_self=True) == ['review', 'approval', 'security']
 
+    def test_list_necessary_labels_order(self):
+        entity = self.querytool.entities['group']['group-one-users']
+        entity.metaparams['labels'] = ['security', 'review']
+        # inherited labels first, own labels last, duplicates kept
+        assert self.querytool._list_necessary_labels(
+            entity, include_self=True) == ['review', 'security', 'review']
+
+    def test_list_user_missing_labels_real(self):
+        del self.querytool._list_necessary_labels  # use the label index
+        with LogCapture() as log:
+            assert self.querytool.list_user_missing_labels(
+                'test.user') == {'approval', 'review', 'security'}
+        log.check(('QueryTool', 'INFO', 'User test.user misses labels: '
+                   '{%s}' % ', '.join({'approval', 'review', 'security'})))
+
+    def test_required_labels_index(self):
+        group = self.querytool.entities['group']['group-one-users']
+        assert self.querytool._required_labels(group) == {
+            'approval', 'review', 'security'}
+        assert set(self.querytool.labels) == {
+            group, self.querytool.entities['group']['group-two'],
+            self.querytool.entities['group']['group-three-users']}
+
+    def test_audit_labels(self):
+        with LogCapture() as log:
+            assert self.querytool.audit_labels() == {
+                'firstname.lastname': ['approval', 'review', 'security'],
+                'firstname.lastname2': ['review'],
+                'test.user': ['approval', 'review', 'security']}
+        log.check_present(
+            ('QueryTool', 'INFO',
+             'User firstname.lastname2 misses labels: {review}'),
+            ('QueryTool', 'INFO', '3 of 3 users miss labels'))
+
+    def test_audit_labels_processes(self):
+        with LogCapture():
+            assert self.querytool.audit_labels(
+                processes=2) == self.querytool.audit_labels()
+        assert tool._audit_tool is None
+
+    def test_query_labels_audit(self):
+        self.querytool.audit_labels = mock.Mock()
+        args = argparse.Namespace(
+            action='labels', subaction='audit', processes=4)
+        self.querytool._query_labels(args)
+        self.querytool.audit_labels.assert_called_with(4)
+
     @log_capture()
     @mock.patch('%s.find_entity' % modulename)
     def test_check_label_necessary(self, mock_find, log):
@@ -369,10 +766,10 @@ class TestQueryTool(object):
         mock_find.return_value = 'user'
         self.querytool._get_labels = mock.Mock()
         self.querytool._get_labels.return_value = ['label1', 'label2']
-        self.querytool.list_necessary_labels = mock.Mock()
-        self.querytool.list_necessary_labels.return_value = [
+        self.querytool._list_necessary_labels.return_value = [
             'label1', 'label3']
         assert self.querytool.list_user_missing_labels('user1') == {'label3'}
+        self.querytool._list_necessary_labels.assert_called_with('user')
         log.check(('QueryTool', 'INFO', 'User user1 misses labels: {label3}'))
 
     @log_capture()
@@ -381,8 +778,8 @@ class TestQueryTool(object):
         mock_find.return_value = 'user'
         self.querytool._get_labels = mock.Mock()
         self.querytool._get_labels.return_value = ['label']
-        self.querytool.list_necessary_labels = mock.Mock()
-        self.querytool.list_necessary_labels.return_value = ['label', 'label3']
+        self.querytool._list_necessary_labels.return_value = [
+            'label', 'label3']
         assert self.querytool.list_user_missing_labels('user1') == {'label3'}
         log.check(('QueryTool', 'INFO', 'User user1 misses labels: {label3}'))
 
@@ -465,6 +862,42 @@ class TestQueryTool(object):
 
 
 class TestQueryToolTopLevel(object):
+    @mock.patch('ipamanager.tools.query_server.QueryServer')
+    @mock.patch('%s._parse_args' % modulename)
+    def test_main_serve(self, mock_parse_args, mock_server):
+        mock_parse_args.return_value = argparse.Namespace(
+            action='serve', config='config', socket='/tmp/sock',
+            settings='settings.yaml', loglevel=logging.WARNING,
+            reload_interval=5)
+        tool.main()
+        mock_server.assert_called_with(
+            'config', '/tmp/sock', 'settings.yaml', logging.WARNING, 5)
+        mock_server.return_value.serve_forever.assert_called_with()
+
+    @mock.patch('ipamanager.tools.query_delta.QueryDelta')
+    def test_main_delta(self, mock_delta):
+        args = tool._parse_args(['delta', 'config', '-o', 'HEAD~1'])
+        with mock.patch('%s._parse_args' % modulename, return_value=args):
+            tool.main()
+        mock_delta.assert_called_with(
+            'config', 'HEAD~1', None, None, logging.WARNING)
+        mock_delta.return_value.run.assert_called_with('text')
+
+    @mock.patch('ipamanager.tools.query_server.QueryClient')
+    def test_run_client(self, mock_client, capsys):
+        mock_client.return_value.query_all.return_value = [{'result': True}]
+        args = tool._parse_args(['client', '-S', '/tmp/sock', '{"query": 1}'])
+        tool._run_client(args)
+        mock_client.assert_called_with('/tmp/sock')
+        mock_client.return_value.query_all.assert_called_with([{'query': 1}])
+        assert capsys.readouterr()[0] == '{"result": true}\n'
+
+    def test_run_client_invalid_query(self):
+        args = tool._parse_args(['client', '-S', '/tmp/sock', '{query'])
+        with pytest.raises(tool.ManagerError) as exc:
+            tool._run_client(args)
+        assert exc.value[0].startswith('Invalid query {query:')
+
     @mock.patch('%s.QueryTool' % modulename)
     def test_load_query_tool(self, mock_querytool):
         querytool = tool.load_query_tool('config', 'settings')
@@ -485,6 +918,39 @@ class TestQueryToolTopLevel(object):
             tool._entity_type('sometype:somename:something')
         assert exc.value[0] == 'too many values to unpack'
 
+    def test_parse_csv_query(self):
+        assert tool._parse_csv_query(
+            ['member', 'user:user1', ' group:group1']) == {
+                'query': 'member', 'member': 'user:user1',
+                'entity': 'group:group1'}
+        assert tool._parse_csv_query(
+            ['labels', 'user', 'user1', 'group1']) == {
+                'query': 'labels', 'subaction': 'user',
+                'user': 'user1', 'group': 'group1'}
+
+    def test_parse_csv_query_members(self):
+        assert tool._parse_csv_query(['members', 'group:group1']) == {
+            'query': 'members', 'entity': 'group:group1'}
+
+    def test_parse_args_export(self):
+        args = tool._parse_args(['export', 'config', '-o', 'membership'])
+        assert (args.action, args.output) == ('export', 'membership')
+
+    def test_parse_args_access(self):
+        args = tool._parse_args(['access', 'config', '-H', 'hostgroup1'])
+        assert (args.action, args.user, args.hostgroup, args.export) == (
+            'access', None, 'hostgroup1', None)
+
+    def test_parse_csv_query_error(self):
+        with pytest.raises(ValueError) as exc:
+            tool._parse_csv_query(['member', 'user:user1'])
+        assert exc.value[0] == 'wrong number of fields for member query'
+
+    def test_parse_args_batch(self):
+        args = tool._parse_args(['batch', 'config', '-i', 'q.csv', '-f', 'csv'])
+        assert (args.action, args.input, args.format) == (
+            'batch', 'q.csv', 'csv')
+
     def test_parse_args(self):
         assert tool._parse_args([
             'member', 'config', '-m', 'group:group1', 'user:user1',
@@ -493,7 +959,14 @@ class TestQueryToolTopLevel(object):
             action='member', config='config', loglevel=logging.INFO,
             members=[('group', 'group1'), ('user', 'user1')],
             pull_types=['user'], settings='settings.yam',
-            entities=[('group', 'group2')])
+            entities=[('group', 'group2')], paths='all', limit=3)
+
+    def test_parse_args_paths(self):
+        args = tool._parse_args([
+            'member', 'config', '-m', 'user:user1', '-e', 'group:group2',
+            '--paths', 'shortest', '-k', '5'])
+        assert args.paths == 'shortest'
+        assert args.limit == 5
 
     @mock.patch('%s.QueryTool' % modulename)
     @mock.patch('%s._parse_args' % modulename)